@@ -3,6 +3,8 @@ import logging
 from flask import Flask, render_template, request
 
 app = Flask(__name__)
+# Upper bound for every request body, API routes have their own (smaller) limits, see eledina/api/schemas.py
+app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024
 logging.basicConfig(level=logging.INFO)
 
 
@@ -12,6 +14,23 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
+# REDIS COMMAND TRACING
+from eledina.flask_util import install_command_tracing, install_read_your_writes
+install_command_tracing(app)
+
+# READ-YOUR-WRITES for RedisData replicas
+install_read_your_writes(app)
+
+# SAMPLING PROFILER (disabled unless enabled in server.ini)
+from eledina.flask_util import install_profiler
+install_profiler(app)
+
+# UNIT OF WORK: queued Redis commands are sent in one pipeline per store at the end of a request
+# (installed last, so it commits before the hooks above finish the request)
+from eledina.flask_util import install_unit_of_work
+install_unit_of_work(app)
+
+
 # REGISTER BLUEPRINTS
 from eledina.pages import pages
 app.register_blueprint(pages)
@@ -20,4 +39,8 @@ from eledina.api.api_blueprint import api
 app.register_blueprint(api)
 
 if __name__ == '__main__':
+    # SIGHUP reloads the live config (see core/live_config.py)
+    from core.live_config import install_signal_handler
+    install_signal_handler()
+
     app.run(load_dotenv=True)
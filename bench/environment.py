@@ -0,0 +1,112 @@
+# coding=utf-8
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+
+"""
+Sets up an isolated environment for benchmarks:
+    a storage engine (the in-process memory engine or a throwaway redis-server without persistence)
+    and a temporary data dir with redis.ini/auth.ini/server.ini, which is passed to core.config
+    via ELEDINA_DATA_DIR.
+
+This has to happen before anything from core/ is imported, because core.storage connects on import.
+"""
+
+REDIS_INI = """[RedisData]
+host={host}
+port={port}
+password=
+db=0
+
+[RedisCache]
+host={host}
+port={port}
+password=
+db=1
+"""
+
+AUTH_INI = """[Crypto]
+salt=benchmarksalt
+rounds={rounds}
+"""
+
+# Tracing is disabled so benchmarks measure the plain code path
+SERVER_INI = """[Tracing]
+enabled=false
+
+[Storage]
+engine={engine}
+"""
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class BenchEnvironment:
+    """
+    Context manager that provides the storage engine and config files
+    """
+    def __init__(self, rounds: int, engine: str="memory", redis_address: str=None):
+        self.rounds = rounds
+        self.engine = engine
+        self.redis_address = redis_address
+
+        self.data_dir = None
+        self.process = None
+
+    def _start_redis(self) -> tuple:
+        binary = shutil.which("redis-server")
+        if binary is None:
+            raise RuntimeError("redis-server was not found in PATH, pass --redis host:port instead")
+
+        port = _free_port()
+        self.process = subprocess.Popen(
+            [binary, "--port", str(port), "--bind", "127.0.0.1",
+             "--save", "", "--appendonly", "no"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+        # Wait for the server to accept connections
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+                return "127.0.0.1", port
+            except OSError:
+                time.sleep(0.05)
+
+        raise RuntimeError("redis-server did not start in time")
+
+    def __enter__(self):
+        if self.engine == "memory":
+            # redis.ini is still required by core.config, but never used
+            host, port = "127.0.0.1", 6379
+        elif self.redis_address:
+            host, port = self.redis_address.rsplit(":", maxsplit=1)
+        else:
+            host, port = self._start_redis()
+
+        self.data_dir = tempfile.mkdtemp(prefix="eledina-bench-")
+        with open(os.path.join(self.data_dir, "redis.ini"), "w") as f:
+            f.write(REDIS_INI.format(host=host, port=port))
+        with open(os.path.join(self.data_dir, "auth.ini"), "w") as f:
+            f.write(AUTH_INI.format(rounds=self.rounds))
+        with open(os.path.join(self.data_dir, "server.ini"), "w") as f:
+            f.write(SERVER_INI.format(engine=self.engine))
+
+        os.environ["ELEDINA_DATA_DIR"] = self.data_dir
+        return self
+
+    def __exit__(self, *_):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+
+        shutil.rmtree(self.data_dir, ignore_errors=True)
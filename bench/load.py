@@ -0,0 +1,434 @@
+# coding=utf-8
+import argparse
+import importlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from .environment import BenchEnvironment
+
+
+"""
+End-to-end load generator.
+
+Usage:
+    python -m bench.load [--target app|wsgi] [--url http://host:port | --gunicorn]
+                         [--rate 50,100,200] [--duration 10] [--mix login=1,register=1,ping=5,blog_list=3]
+                         [--engine memory|redis] [--output results.json]
+
+Requests arrive open-loop: arrival times follow a Poisson process at the given rate, no matter how fast
+the server answers. Latency is measured from the scheduled arrival, so time spent waiting for a free
+client thread counts as well (no coordinated omission). Every rate in --rate is one stage, so a ramp
+shows where latency breaks down.
+
+Targets:
+    in-process (default): the Flask app from app.py (--target app) or the production entry point wsgi.py
+                          (--target wsgi) through the test client, every request from a random client IP
+    --url:                a running server (all requests come from this machine's IP, so IP rate limits apply)
+    --gunicorn:           starts gunicorn -c gunicorn.conf.py wsgi:app in the benchmark environment and uses it
+
+The report (JSON) has throughput, p50/p95/p99/p999 latency and error, 429 and 503 (shed) rates
+for every route and stage.
+"""
+
+DEFAULT_MIX = "login=1,register=1,ping=5,blog_list=3"
+PERCENTILES = (50, 95, 99, 99.9)
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    if not values:
+        return None
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ROUTES:
+            raise ValueError(f"unknown route in mix: {name} (known: {', '.join(ROUTES)})")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+#################
+# CLIENTS
+#################
+class InProcessClient:
+    """
+    Calls the WSGI app directly through Flask's test client (one per thread)
+    """
+    def __init__(self, app, client_ips: int):
+        self.app = app
+        self.client_ips = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(1, client_ips + 1)]
+        self._local = threading.local()
+
+    def request(self, method: str, path: str, body: dict=None, headers: dict=None) -> tuple:
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+
+        response = client.open(path, method=method, headers=headers,
+                               data=json.dumps(body) if body is not None else None,
+                               environ_base={"REMOTE_ADDR": random.choice(self.client_ips)})
+        return response.status_code, response.get_data()
+
+
+class HttpClient:
+    """
+    Sends real HTTP requests to a running server
+    """
+    def __init__(self, base_url: str, timeout: float=30):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def request(self, method: str, path: str, body: dict=None, headers: dict=None) -> tuple:
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method, headers=headers or {})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+#################
+# TRAFFIC
+#################
+class Traffic:
+    """
+    Seeded users and blogs the requests of the mix use
+    """
+    def __init__(self, client, users: int, blogs: int):
+        self.client = client
+        self.seed_users = users
+        self.seed_blogs = blogs
+
+        self.accounts = []
+        self.tokens = []
+        self.blog_ids = []
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def next_number(self) -> int:
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def _seed_request(self, method: str, path: str, body: dict=None, headers: dict=None) -> bytes:
+        # Seeding waits out rate limits instead of failing
+        for _ in range(100):
+            status, data = self.client.request(method, path, body, headers)
+            if status != 429:
+                if status != 200:
+                    raise RuntimeError(f"seeding failed: {method} {path} returned {status}: {data[:200]}")
+                return data
+            time.sleep(min(json.loads(data).get("try_in") or 1, 10))
+
+        raise RuntimeError(f"seeding failed: {method} {path} is rate limited")
+
+    def seed(self):
+        run = random.randrange(1 << 30)
+        for i in range(self.seed_users):
+            account = (f"load{run}u{i}", f"load{run}u{i}@example.com", "loadpassword")
+            data = self._seed_request("POST", "/api/register", {
+                "username": account[0], "name": "Load", "surname": "User",
+                "email": account[1], "password": account[2]
+            })
+            self.accounts.append(account)
+            self.tokens.append(json.loads(data)["token"])
+
+        for i in range(self.seed_blogs):
+            data = self._seed_request("POST", "/api/blog/new", {
+                "title": f"Load test {i}", "content": "Lorem ipsum " * 40, "date": "1536000000"
+            })
+            self.blog_ids.append(json.loads(data)["id"])
+
+
+def _login(traffic: Traffic):
+    index = random.randrange(len(traffic.accounts))
+    username, _, password = traffic.accounts[index]
+
+    def on_response(data: bytes):
+        # Logging in replaces the user's token (stored tokens), ping and user_info need the new one
+        traffic.tokens[index] = json.loads(data)["token"]
+
+    return "POST", "/api/login", {"primary": username, "password": password}, None, on_response
+
+
+def _register(traffic: Traffic):
+    n = traffic.next_number()
+    name = f"r{os.getpid()}x{random.randrange(1 << 30)}x{n}"
+    return "POST", "/api/register", {
+        "username": name[:32], "name": "Load", "surname": "User",
+        "email": f"{name[:32]}@example.com", "password": "loadpassword"
+    }, None, None
+
+
+def _ping(traffic: Traffic):
+    return "GET", "/api/ping", None, {"Authorization": random.choice(traffic.tokens)}, None
+
+
+def _user_info(traffic: Traffic):
+    return "GET", "/api/user", None, {"Authorization": random.choice(traffic.tokens)}, None
+
+
+def _blog_list(_: Traffic):
+    return "GET", "/api/blog/list?limit=20", None, None, None
+
+
+def _blog_get(traffic: Traffic):
+    return "GET", f"/api/blog/{random.choice(traffic.blog_ids)}", None, None, None
+
+
+# route name: builder of (method, path, body, headers, callback for the body of a 200 response)
+ROUTES = {
+    "login": _login,
+    "register": _register,
+    "ping": _ping,
+    "user_info": _user_info,
+    "blog_list": _blog_list,
+    "blog_get": _blog_get,
+}
+
+
+class _RouteStats:
+    __slots__ = ("latencies", "statuses", "exceptions")
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.exceptions = 0
+
+    def report(self, duration: float) -> dict:
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        # 503s are load shedding (see eledina/api/admission.py), not failures
+        errors = sum(c for s, c in self.statuses.items() if s >= 500 and s != 503) + self.exceptions
+        limited = self.statuses.get(429, 0)
+        shed = self.statuses.get(503, 0)
+
+        result = {
+            "requests": count,
+            "throughput": round(count / duration, 2),
+            "statuses": {str(s): c for s, c in sorted(self.statuses.items())},
+            "exceptions": self.exceptions,
+            "error_rate": round(errors / count, 4) if count else 0,
+            "rate_limited_rate": round(limited / count, 4) if count else 0,
+            "shed_rate": round(shed / count, 4) if count else 0,
+        }
+        for p in PERCENTILES:
+            value = percentile(latencies, p)
+            result[f"p{p:g}_ms".replace(".", "")] = round(value * 1000, 3) if value is not None else None
+
+        return result
+
+
+def run_stage(client, traffic: Traffic, mix: dict, rate: float, duration: float, concurrency: int) -> dict:
+    """
+    Sends requests at `rate` per second (Poisson arrivals) for `duration` seconds
+    """
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    stats = {name: _RouteStats() for name in names}
+    lock = threading.Lock()
+
+    def send(name: str, scheduled: float):
+        method, path, body, headers, on_response = ROUTES[name](traffic)
+        try:
+            status, data = client.request(method, path, body, headers)
+        except Exception:
+            status = None
+        else:
+            if status == 200 and on_response is not None:
+                on_response(data)
+        # Measured from the scheduled arrival, including time spent queued
+        latency = time.perf_counter() - scheduled
+
+        with lock:
+            route = stats[name]
+            route.latencies.append(latency)
+            if status is None:
+                route.exceptions += 1
+            else:
+                route.statuses[status] = route.statuses.get(status, 0) + 1
+
+    # Dispatch lag tells whether the generator itself kept up
+    max_lag = 0.0
+    sent = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        started = time.perf_counter()
+        next_arrival = started
+        end = started + duration
+
+        while True:
+            next_arrival += random.expovariate(rate)
+            if next_arrival >= end:
+                break
+
+            now = time.perf_counter()
+            if next_arrival > now:
+                time.sleep(next_arrival - now)
+            else:
+                max_lag = max(max_lag, now - next_arrival)
+
+            executor.submit(send, random.choices(names, weights)[0], next_arrival)
+            sent += 1
+
+    elapsed = time.perf_counter() - started
+
+    routes = {name: route.report(elapsed) for name, route in stats.items()}
+    overall = _RouteStats()
+    for route in stats.values():
+        overall.latencies.extend(route.latencies)
+        overall.exceptions += route.exceptions
+        for status, count in route.statuses.items():
+            overall.statuses[status] = overall.statuses.get(status, 0) + count
+
+    return {
+        "target_rate": rate,
+        "duration_s": round(elapsed, 3),
+        "sent": sent,
+        "max_dispatch_lag_ms": round(max_lag * 1000, 3),
+        "overall": overall.report(elapsed),
+        "routes": routes,
+    }
+
+
+def find_breakdown(stages: list, p99_slo_ms: float, max_error_rate: float):
+    """
+    :return: the first rate at which p99 latency or the error rate exceeded the limits (or None)
+    """
+    for stage in stages:
+        overall = stage["overall"]
+        if (overall["p99_ms"] or 0) > p99_slo_ms or overall["error_rate"] > max_error_rate:
+            return stage["target_rate"]
+    return None
+
+
+#################
+# TARGETS
+#################
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(engine: str) -> tuple:
+    """
+    Starts the production entry point with gunicorn.conf.py, returns (process, base url)
+    """
+    binary = shutil.which("gunicorn")
+    if binary is None:
+        raise RuntimeError("gunicorn was not found in PATH")
+
+    port = _free_port()
+    env = dict(os.environ, ELEDINA_BIND=f"127.0.0.1:{port}")
+    # The memory engine keeps data per process, every worker would have its own users
+    if engine == "memory":
+        env["ELEDINA_WORKERS"] = "1"
+
+    process = subprocess.Popen([binary, "-c", "gunicorn.conf.py", "wsgi:app"], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError("gunicorn exited on startup")
+            time.sleep(0.1)
+
+    process.terminate()
+    raise RuntimeError("gunicorn did not start in time")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="eLedina backend open-loop load generator")
+    parser.add_argument("--target", choices=("app", "wsgi"), default="app", help="in-process entry point")
+    parser.add_argument("--url", help="load a running server instead (its storage isn't touched)")
+    parser.add_argument("--gunicorn", action="store_true", help="start gunicorn (wsgi:app) and load it")
+    parser.add_argument("--rate", default="50", help="requests per second, a comma separated list is a ramp")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per stage")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"route weights (routes: {', '.join(ROUTES)})")
+    parser.add_argument("--concurrency", type=int, default=64, help="maximum requests in flight")
+    parser.add_argument("--users", type=int, default=50, help="seeded users (login, ping and user_info use them)")
+    parser.add_argument("--blogs", type=int, default=200, help="seeded blogs")
+    parser.add_argument("--client-ips", type=int, default=1000, help="distinct client IPs (in-process only)")
+    parser.add_argument("--engine", choices=("memory", "redis"), default="memory")
+    parser.add_argument("--redis", help="host:port of a throwaway Redis (gets flushed!) instead of starting one")
+    parser.add_argument("--rounds", type=int, default=29000, help="PBKDF2 rounds")
+    parser.add_argument("--p99-slo", type=float, default=200, help="p99 latency (ms) considered broken down")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="error rate considered broken down")
+    parser.add_argument("--output", help="write the report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    rates = [float(r) for r in args.rate.split(",")]
+
+    process = None
+    with BenchEnvironment(rounds=args.rounds, engine=args.engine, redis_address=args.redis):
+        try:
+            if args.url:
+                client, target = HttpClient(args.url), args.url
+            elif args.gunicorn:
+                process, url = start_gunicorn(args.engine)
+                client, target = HttpClient(url), "gunicorn wsgi:app"
+            else:
+                # Imported here - core connects to storage on import, so the environment has to exist first
+                app = importlib.import_module(args.target).app
+                client, target = InProcessClient(app, args.client_ips), f"{args.target}:app (in-process)"
+
+            traffic = Traffic(client, args.users, args.blogs)
+            traffic.seed()
+
+            stages = [run_stage(client, traffic, mix, rate, args.duration, args.concurrency) for rate in rates]
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+
+    report = {
+        "meta": {
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "target": target,
+            "engine": args.engine if not args.url else None,
+            "mix": mix,
+            "concurrency": args.concurrency,
+            "rounds": args.rounds,
+        },
+        "stages": stages,
+        "breakdown_rate": find_breakdown(stages, args.p99_slo, args.max_error_rate),
+    }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
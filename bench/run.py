@@ -0,0 +1,238 @@
+# coding=utf-8
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+from .environment import BenchEnvironment
+
+
+"""
+Micro-benchmarks for the hot paths of the backend.
+
+Usage:
+    python -m bench.run [--quick] [--engine memory|redis] [--output results.json]
+                        [--baseline bench/baseline.json] [--save-baseline] [--tolerance 0.25]
+
+Runs against the in-process memory engine or, with --engine redis, a throwaway redis-server
+(or --redis host:port, which gets FLUSHED!) and prints machine-readable JSON.
+With --baseline, results are compared against a stored run and the exit code is 1
+if any benchmark got slower than the tolerance allows.
+"""
+
+DEFAULT_BASELINE = "bench/baseline.json"
+
+
+def measure(fn, number: int, repeat: int=5) -> dict:
+    """
+    Runs `fn` `number` times per round for `repeat` rounds, returns per-call timings in seconds
+    """
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - start) / number)
+
+    median = statistics.median(rounds)
+    return {
+        "calls": number * repeat,
+        "median_s": median,
+        "min_s": min(rounds),
+        "max_s": max(rounds),
+        "ops_per_s": 1 / median if median else None,
+    }
+
+
+class Counter:
+    """
+    Hands out unique suffixes for usernames/emails
+    """
+    def __init__(self):
+        self.n = 0
+
+    def next(self) -> int:
+        self.n += 1
+        return self.n
+
+
+def _seed_blogs(rd, rc, count: int):
+    from core import keys
+    from core.util import gen_id
+
+    pipe = rd.pipeline(transaction=False)
+    index = rc.pipeline(transaction=False)
+    for i in range(count):
+        blog_id = gen_id()
+        pipe.hmset(keys.blog(blog_id), {"title": f"Title {i}", "content": "Lorem ipsum " * 40, "date": "1536000000"})
+        index.zadd(keys.BLOG_INDEX, keys.blog_index_member(blog_id), 0)
+        if i % 1000 == 999:
+            pipe.execute()
+            index.execute()
+    pipe.execute()
+    index.execute()
+
+
+def _seed_users(rd, count: int):
+    from core import keys
+    from core.util import gen_id
+
+    pipe = rd.pipeline(transaction=False)
+    for i in range(count):
+        pipe.hmset(keys.user(gen_id()), {
+            "username": f"seeduser{i}",
+            "fullname": "Seed|User",
+            "email": f"seed{i}@example.com",
+            "password": "not-a-hash",
+            "reg_on": 1536000000,
+        })
+        if i % 1000 == 999:
+            pipe.execute()
+    pipe.execute()
+
+
+def run_benchmarks(quick: bool) -> dict:
+    # Imported here - core connects to Redis on import, so the environment has to exist first
+    from core.models import Users, Blogs
+    from core.cachemanager import CacheGenerator
+    from core.storage import get_data_store, get_cache_store
+    from core.util import decode_auto
+    from eledina.api.bucket import Bucket
+    from eledina.flask_util import jsonify_response
+
+    rd, rc = get_data_store(), get_cache_store()
+    users, blogs, cache = Users(), Blogs(), CacheGenerator()
+    counter = Counter()
+
+    def flush():
+        rd.flushdb()
+        # Wipes RedisCache and marks the (empty) index as ready for claims
+        cache.generate_cache()
+
+    scale = 10 if quick else 1
+    results = {}
+
+    # USERS
+    flush()
+
+    def register():
+        n = counter.next()
+        return users.register_user(f"benchuser{n}", "Bench|User", f"bench{n}@example.com", "benchpassword")
+
+    results["users.register_user"] = measure(register, number=max(20 // scale, 2))
+
+    users.register_user("loginuser", "Login|User", "login@example.com", "benchpassword")
+    results["users.login_user"] = measure(lambda: users.login_user("loginuser", "benchpassword"),
+                                          number=max(20 // scale, 2))
+
+    token = users.login_user("loginuser", "benchpassword")
+    user_id = int(users.verify_token(token))
+    results["users.verify_token"] = measure(lambda: users.verify_token(token), number=2000 // scale)
+    results["users.get_user_info"] = measure(lambda: users.get_user_info(user_id), number=2000 // scale)
+
+    # BLOGS
+    for size in (10, 1000) if quick else (10, 1000, 100000):
+        flush()
+        _seed_blogs(rd, rc, size)
+        number = max(1000 // size, 1)
+        results[f"blogs.get_blog[{size}]"] = measure(blogs.get_blog, number=number, repeat=3 if size >= 100000 else 5)
+        # One page, should not depend on size
+        results[f"blogs.get_blog_page[{size}]"] = measure(lambda: blogs.get_blog(limit=20), number=200 // scale)
+
+    # CACHE
+    for size in (100, 1000) if quick else (100, 1000, 10000):
+        flush()
+        _seed_users(rd, size)
+        results[f"cache.generate_cache[{size}]"] = measure(cache.generate_cache, number=1, repeat=3)
+
+    # PURE PYTHON
+    reply = {b"username": b"benchuser", b"fullname": b"Bench|User", b"about": b"",
+             b"email": b"bench@example.com", b"role": b"0", b"reg_on": b"1536000000"}
+    results["util.decode_auto"] = measure(lambda: decode_auto(reply), number=20000 // scale)
+
+    bucket = Bucket(limit=10 ** 9, per=10 ** 9)
+    results["bucket.action"] = measure(bucket.action, number=100000 // scale)
+
+    payload = {"status": "ok", "token": "x" * 86}
+    results["flask_util.jsonify_response"] = measure(lambda: jsonify_response(payload), number=20000 // scale)
+
+    flush()
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> dict:
+    """
+    Compares median timings against the baseline, returns {name: ratio} for regressions
+    """
+    regressions = {}
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base or not base.get("median_s"):
+            continue
+
+        ratio = result["median_s"] / base["median_s"]
+        result["baseline_ratio"] = ratio
+        if ratio > 1 + tolerance:
+            regressions[name] = ratio
+
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="eLedina backend micro-benchmarks")
+    parser.add_argument("--quick", action="store_true", help="smaller data sets and fewer iterations")
+    parser.add_argument("--engine", choices=("memory", "redis"), default="memory",
+                        help="storage engine to benchmark against")
+    parser.add_argument("--redis", help="host:port of a throwaway Redis (gets flushed!) instead of starting one")
+    parser.add_argument("--rounds", type=int, default=29000, help="PBKDF2 rounds used for the benchmark")
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    parser.add_argument("--baseline", help=f"compare against a stored run (e.g. {DEFAULT_BASELINE})")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    with BenchEnvironment(rounds=args.rounds, engine=args.engine, redis_address=args.redis):
+        results = run_benchmarks(args.quick)
+
+    report = {
+        "meta": {
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": args.quick,
+            "engine": args.engine,
+            "rounds": args.rounds,
+        },
+        "results": results,
+    }
+
+    regressions = {}
+    if args.baseline and os.path.isfile(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.save_baseline:
+        with open(args.baseline or DEFAULT_BASELINE, "w") as f:
+            f.write(output)
+
+    if regressions:
+        for name, ratio in sorted(regressions.items()):
+            print(f"REGRESSION: {name} is {round(ratio, 2)}x slower than the baseline", file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,15 @@
 # coding=utf-8
 import logging
+import os
+import socket
+import threading
+import time
 
-from .util import Singleton, decode
-from .redis import RedisData, RedisCache
-from .types_ import FieldUpdateType
+from . import keys
+from .exceptions import StorageUnavailable
+from .util import Singleton, after_fork, decode
+from .storage import get_data_store, get_cache_store
+from .replicas import primary_reads
 
 
 log = logging.getLogger(__name__)
@@ -14,18 +20,32 @@ class CacheGenerator(metaclass=Singleton):
     """
     This class is used for generating cache from RedisData.
 
-    RedisCache layout:
+    RedisCache layout (see core/keys.py):
 
-        user:by_username (Hash)
-            <username>:<user_id>
-        user:by_email (Hash)
-            <email>:<user_id>
+        idx:username:<username> (String)
+            <user_id>
+        idx:email:<email> (String)
+            <user_id>
+        blogs:by_id (Sorted set)
+            every blog id (see keys.blog_index_member)
 
         # TODO
     """
+    # Seconds a process may take to generate the cache before another one takes over
+    REBUILD_TIMEOUT = 600
+
     def __init__(self):
-        self.rd = RedisData()
-        self.rc = RedisCache()
+        self.rd = get_data_store()
+        self.rc = get_cache_store()
+
+        self._rebuild = None
+        self._rebuild_lock = threading.Lock()
+        after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # Threads don't survive a fork
+        self._rebuild = None
+        self._rebuild_lock = threading.Lock()
 
     def _wipe_cache(self):
         """
@@ -42,47 +62,110 @@ class CacheGenerator(metaclass=Singleton):
     # All of these functions should have a prefix: cache_single_<type>
     ##############################
     def cache_single_user(self, user_id: int):
-        user = decode(self.rd.hgetall(f"user:{user_id}"))
+        user = decode(self.rd.hmget(keys.user(user_id), "username", "email"))
+        username, email = user
 
-        username = user["username"]
-        email = user["email"]
+        # Index links are in different slots, so no transaction.
+        # Links that exist already are kept, they may have been claimed after the user was read
+        pipe = self.rc.pipeline(transaction=False)
 
-        pipe = self.rc.pipeline()
-
-        pipe.hset("user:by_username", username, user_id)
-        pipe.hset("user:by_email", email, user_id)
+        pipe.set(keys.username_index(username), user_id, nx=True)
+        pipe.set(keys.email_index(email), user_id, nx=True)
 
         pipe.execute()
 
-    def cache_user_field_update(self, user_id: int, update_type: FieldUpdateType, previous: str, new: str):
+    def release_user_links(self, releases: list, grace: float=0) -> list:
         """
-        Caches only one field update. Deletes the old cached field and puts the new one in.
+        Deletes index links users don't use anymore (after username/email updates, see core/outbox.py).
+        The new links are claimed by Users when updating, this only cleans up.
+
+        A link is only deleted if it still points to the user and the user's field has a different value now.
 
-        This function is necessary for fields:
-            username: str
-            email: str
+        :param releases: list of (user_id, field, previous value, unix time of the update)
+        :param grace: seconds during which a release of a still current value is retried
+        :return: list of bools, False if the release has to be retried later
         """
-        # This should be called when the 'username' field is updated
-        pipe = self.rc.pipeline()
+        index_key = {"username": keys.username_index, "email": keys.email_index}
 
-        pipe.hdel(update_type, previous)
-        pipe.hset(update_type, new, user_id)
+        # Replicas could still have the previous value
+        with primary_reads():
+            pipe = self.rd.pipeline(transaction=False)
+            for user_id, field, _, _ in releases:
+                pipe.hget(keys.user(user_id), field)
+            current = pipe.execute()
 
-        pipe.execute()
-        log.debug(f"Updated single user field: {update_type}")
+        now = time.time()
+        finished = []
+        stale = []
+        stale_values = []
+        for (user_id, field, previous, at), value in zip(releases, current):
+            if value == previous.encode("utf-8"):
+                # Not written yet or the update failed
+                finished.append(now - at >= grace)
+            else:
+                finished.append(True)
+                stale.append((index_key[field](previous), user_id))
+                stale_values.append((field, previous))
+
+        if stale:
+            pipe = self.rc.pipeline(transaction=False)
+            for key, _ in stale:
+                pipe.get(key)
+            owners = pipe.execute()
+
+            # Nobody else can claim a link before it's deleted, so checking the owner first is safe
+            deleted = [(key, user_id, field, previous)
+                       for (key, user_id), owner, (field, previous) in zip(stale, owners, stale_values)
+                       if owner == str(user_id).encode()]
+            pipe = self.rc.pipeline(transaction=False)
+            for key, _, _, _ in deleted:
+                pipe.delete(key)
+            pipe.execute()
+            log.debug(f"Released {len(deleted)} index links")
+
+            if deleted:
+                self._restore_reclaimed(deleted)
+
+        return finished
+
+    def _restore_reclaimed(self, deleted: list):
+        """
+        Links back values the users changed back to while their links were being released
+        (an update that reclaimed its own link and was written between the check and the delete)
+
+        :param deleted: list of (index key, user_id, field, value) of deleted links
+        """
+        with primary_reads():
+            pipe = self.rd.pipeline(transaction=False)
+            for _, user_id, field, _ in deleted:
+                pipe.hget(keys.user(user_id), field)
+            current = pipe.execute()
+
+        restore = [(key, user_id) for (key, user_id, _, previous), value in zip(deleted, current)
+                   if value == previous.encode("utf-8")]
+        if not restore:
+            return
+
+        pipe = self.rc.pipeline(transaction=False)
+        for key, user_id in restore:
+            pipe.set(key, user_id, nx=True)
+        for (key, user_id), restored in zip(restore, pipe.execute()):
+            if not restored:
+                log.warning(f"Index link {key} of user {user_id} was claimed by someone else after its release")
 
     ##############################
     # CACHE GENERATORS
     ##############################
     def _gen_user_cache(self):
         # USER cache
-        # user:by_username and user:by_email
+        # idx:username:* and idx:email:*
         count = 0
         log.info("Generating user cache...")
 
-        for key in self.rd.scan_iter(match="user:*"):
-            key = bytes(key).decode(encoding="utf-8")
-            user_id = int(key.split(":", maxsplit=1)[1])
+        for key in self.rd.scan_iter(match=keys.USER_PATTERN):
+            user_id = keys.parse_id(key)
+            if user_id is None:
+                continue
 
             log.debug(f"Processing {user_id}")
             count += 1
@@ -90,6 +173,88 @@ class CacheGenerator(metaclass=Singleton):
 
         log.info(f"Generated user cache with {count} entries.")
 
+    def _gen_blog_cache(self, batch_size: int=1000):
+        # BLOG index
+        # blogs:by_id
+        count = 0
+        log.info("Generating blog index...")
+
+        members = []
+        for key in self.rd.scan_iter(match=keys.BLOG_PATTERN):
+            blog_id = keys.parse_id(key)
+            if blog_id is None:
+                continue
+
+            count += 1
+            members.extend((keys.blog_index_member(blog_id), 0))
+            if len(members) >= 2 * batch_size:
+                self.rc.zadd(keys.BLOG_INDEX, *members)
+                members = []
+
+        if members:
+            self.rc.zadd(keys.BLOG_INDEX, *members)
+
+        log.info(f"Generated blog index with {count} entries.")
+
+    def generate_cache_when_available(self, retry_interval: float=5):
+        """
+        Generates the cache now or, if Redis is unavailable (degraded start), in the background once it's back
+        """
+        try:
+            self.generate_cache()
+        except StorageUnavailable as e:
+            log.error(f"Cache generation postponed: {e}")
+            threading.Thread(target=self._generate_later, args=(retry_interval,),
+                             name="cache-generator", daemon=True).start()
+
+    def _generate_later(self, retry_interval: float):
+        while True:
+            time.sleep(retry_interval)
+            try:
+                # Workers are serving by now, a wipe would drop the index links they just claimed.
+                # Generating only adds links, and claims wait for cache:ready (see is_ready) until it's done
+                self.generate_cache(wipe_first=False)
+                return
+            except StorageUnavailable:
+                pass
+
+    def ensure_generated(self):
+        """
+        Generates the cache again (without a wipe, in the background) after RedisCache lost its data
+        while the app was running - noticed by a missing cache:ready (see is_ready).
+        Only one process of all generates it at a time.
+        """
+        with self._rebuild_lock:
+            if self._rebuild is not None and self._rebuild.is_alive():
+                return
+
+            self._rebuild = threading.Thread(target=self._regenerate, name="cache-generator", daemon=True)
+            self._rebuild.start()
+
+    def _regenerate(self):
+        owner = f"{socket.gethostname()}:{os.getpid()}"
+        try:
+            # Another process may be generating it already
+            if not self.rc.set(keys.CACHE_REBUILDING, owner, ex=self.REBUILD_TIMEOUT, nx=True):
+                return
+            try:
+                if not self.is_ready():
+                    log.warning("RedisCache lost its data, generating the cache again")
+                    self.generate_cache(wipe_first=False)
+            finally:
+                self.rc.delete(keys.CACHE_REBUILDING)
+        except Exception:
+            log.exception("Generating the cache again failed, retried with the next request that needs it")
+
+    def is_ready(self, pipe=None):
+        """
+        Whether the cache is completely generated: index links can't be claimed before, the index
+        doesn't know every taken username/email yet
+
+        :param pipe: RedisCache pipeline to add the check to, the reply is its result
+        """
+        return (pipe if pipe is not None else self.rc).exists(keys.CACHE_READY)
+
     def generate_cache(self, wipe_first=True):
         if wipe_first:
             self._wipe_cache()
@@ -99,4 +264,9 @@ class CacheGenerator(metaclass=Singleton):
         # USER CACHE
         self._gen_user_cache()
 
+        # BLOG INDEX
+        self._gen_blog_cache()
+
         # TODO other types of cache
+
+        self.rc.set(keys.CACHE_READY, int(time.time()))
@@ -0,0 +1,127 @@
+# coding=utf-8
+import logging
+import random
+import threading
+import time
+
+from .config import server_config
+from .exceptions import StorageUnavailable
+from .metrics import Metrics
+from .util import after_fork
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+"""
+Circuit breaker for Redis clients (see CircuitBreaking in core/redis.py).
+
+    closed     commands go through; FAILURE_THRESHOLD connection errors in a row open the breaker
+    open       commands fail right away with StorageUnavailable, nothing waits on a socket timeout
+    half-open  after the backoff, one command goes through as a probe (redis-py reconnects for it):
+               success closes the breaker, failure opens it again for twice as long (up to BACKOFF_MAX)
+
+Backoffs are jittered (between half and all of the delay), so workers don't all reconnect at the same moment.
+Every worker has its own breakers.
+"""
+
+FAILURE_THRESHOLD = server_config.getint("CircuitBreaker", "failure_threshold", fallback=3)
+BACKOFF_BASE = server_config.getfloat("CircuitBreaker", "backoff_base", fallback=0.5)
+BACKOFF_MAX = server_config.getfloat("CircuitBreaker", "backoff_max", fallback=30)
+
+
+class CircuitBreaker:
+    """
+    Guards calls to one server
+
+    :param name: used in logs, metrics and errors
+    :param failures: exception types that mean the server is unreachable (others are passed through)
+    """
+    def __init__(self, name: str, failures: tuple):
+        self.name = name
+        self.failures = failures
+        self.metrics = Metrics()
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._openings = 0
+        # Monotonic time of the next probe, 0 while closed
+        self._retry_at = 0
+        self._probing = False
+
+        after_fork(self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._probing = False
+
+    def is_open(self) -> bool:
+        return self._retry_at != 0
+
+    def retry_in(self) -> float:
+        return max(self._retry_at - time.monotonic(), 0)
+
+    def _before_call(self):
+        with self._lock:
+            if self._retry_at == 0:
+                return
+
+            if self._probing or time.monotonic() < self._retry_at:
+                self.metrics.inc(f"storage.rejected.{self.name}")
+                raise StorageUnavailable(self.name, max(self.retry_in(), BACKOFF_BASE))
+
+            # This call is the probe, everything else keeps failing fast until it's done
+            self._probing = True
+
+    def _on_success(self):
+        with self._lock:
+            if self._retry_at:
+                log.info(f"{self.name} is reachable again, closing the circuit breaker")
+                self.metrics.inc(f"storage.recovered.{self.name}")
+
+            self._failures = 0
+            self._openings = 0
+            self._retry_at = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+
+            if self._retry_at or self._failures >= FAILURE_THRESHOLD:
+                delay = min(BACKOFF_BASE * 2 ** self._openings, BACKOFF_MAX)
+                delay = random.uniform(delay / 2, delay)
+                self._openings += 1
+                self._retry_at = time.monotonic() + delay
+
+                log.warning(f"{self.name} is unreachable ({self._failures} failures), "
+                            f"failing fast for {round(delay, 2)}s")
+                self.metrics.inc(f"storage.opened.{self.name}")
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Calls fn through the breaker
+
+        :raise: StorageUnavailable if the breaker is open or fn failed to reach the server
+        """
+        self._before_call()
+
+        try:
+            reply = fn(*args, **kwargs)
+        except self.failures as e:
+            self.record_failure()
+            raise StorageUnavailable(self.name, max(self.retry_in(), BACKOFF_BASE)) from e
+        except Exception:
+            # The server answered (with an error), so it's reachable
+            self._reachable()
+            raise
+
+        self._reachable()
+        return reply
+
+    def _reachable(self):
+        # Only takes the lock when there is something to reset
+        if self._failures or self._probing:
+            self._on_success()
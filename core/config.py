@@ -4,10 +4,13 @@ import os
 import shutil
 
 # Verify data dir exists
-DATA_DIR = "data"
+# ELEDINA_DATA_DIR allows running against a different set of config files (benchmarks, ...)
+DATA_DIR = os.environ.get("ELEDINA_DATA_DIR", "data")
 
 REDIS_CONFIG_PATH = os.path.join(DATA_DIR, "redis.ini")
 AUTH_CONFIG_PATH = os.path.join(DATA_DIR, "auth.ini")
+# Optional, every value in it has a fallback (see server_example.ini)
+SERVER_CONFIG_PATH = os.path.join(DATA_DIR, "server.ini")
 
 
 if not os.path.isdir(DATA_DIR):
@@ -31,6 +34,10 @@ redis_config.read(REDIS_CONFIG_PATH)
 auth_config = configparser.ConfigParser()
 auth_config.read(AUTH_CONFIG_PATH)
 
+server_config = configparser.ConfigParser()
+server_config.read(SERVER_CONFIG_PATH)
+
 # For convenience
-SALT = bytes(auth_config.get("Crypto", "salt"), encoding="utf-8")
+# Global salt of hashes from before per-user salts, only used to find hashes that need an upgrade
+SALT = bytes(auth_config.get("Crypto", "salt", fallback=""), encoding="utf-8")
 ROUNDS = auth_config.getint("Crypto", "rounds")
@@ -22,6 +22,15 @@ class LoginFailed(BackendException):
     pass
 
 
+class LoginThrottled(BackendException):
+    """
+    Raised when logging into an account that is locked after too many failed logins
+    """
+    def __init__(self, retry_after: float):
+        super().__init__(f"too many failed logins, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
 class UsernameAlreadyExists(BackendException):
     """
     Raised while registering when a username already exists
@@ -32,4 +41,21 @@ class UsernameAlreadyExists(BackendException):
 class EmailAlreadyRegistered(BackendException):
     """
     Raised while registering when an email is already reigstered
-    """
\ No newline at end of file
+    """
+
+
+class StorageError(BackendException):
+    """
+    Raised by storage engines on invalid commands (unsupported command, wrong type, ...)
+    """
+    pass
+
+
+class StorageUnavailable(BackendException):
+    """
+    Raised when Redis can't be reached, right away while the circuit breaker is open (see core/circuit_breaker.py)
+    """
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is unavailable, retry in {round(retry_after, 1)}s")
+        self.name = name
+        self.retry_after = retry_after
@@ -14,3 +14,16 @@ class UserLimits:
     PASSWORD_MIN_LENGTH = 8
     PASSWORD_MAX_LENGTH = 254
 
+
+class BlogLimits:
+    TITLE_MIN_LENGTH = 1
+    TITLE_MAX_LENGTH = 200
+
+    CONTENT_MIN_LENGTH = 1
+    CONTENT_MAX_LENGTH = 100000
+
+    DATE_MAX_LENGTH = 32
+
+    # Batch ingestion
+    BATCH_MAX_POSTS = 500
+    IDEMPOTENCY_KEY_MAX_LENGTH = 128
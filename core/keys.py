@@ -0,0 +1,148 @@
+# coding=utf-8
+"""
+Key names for RedisData and RedisCache.
+
+Everything is named so it works on a Redis Cluster: keys that belong to one user share the hash tag
+{<user_id>}, so they live in the same slot (on the same node) and can be used together in one pipeline.
+Index links are keyed by the indexed value (idx:username:<username>), so they spread over the cluster
+instead of one big hash on one node; each of them is a single key, so claiming one with SET NX is atomic.
+
+RedisData:
+    user:{<user_id>} (Hash) - profile
+    auth:{<user_id>} (String) - current token
+    ver:{<user_id>} (String) - profile version, bumped by every profile write (ETag of /api/user)
+    rw:{pins} (Sorted set) - <user_id>: time until which the user's reads go to the primary (see core/read_pins.py)
+    blog:<blog_id> (Hash)
+    idem:blog:<key> (String) - idempotency keys of batch uploads
+    revoked:{auth}:tokens, revoked:{auth}:users (Sorted set) - revoked signed tokens (see core/signed_tokens.py)
+    config:live (Hash) - runtime overrides of limits (see core/live_config.py)
+    ids:worker:<n> (String) - owner of the lease on worker id n (see core/worker_ids.py)
+    hll:{stats}:<users|ips>:<day|hour>:<date> (HyperLogLog) - distinct users and IPs (see core/analytics.py)
+
+RedisCache:
+    idx:username:<username> (String) - user id
+    idx:email:<email> (String) - user id
+    login:{<user_id>}:fails, login:{<user_id>}:lock (String) - failed login throttling
+    login:{name:<primary>}:fails, login:{name:<primary>}:lock (String) - same for names of no account
+    outbox:{cache}, outbox:{cache}:dead (Stream) - index maintenance events (see core/outbox.py)
+    blogs:by_id (Sorted set) - every blog id in creation order, see blog_index_member
+    cache:ready (String) - set once the cache is completely generated, index links are only claimed after that
+    cache:rebuilding (String) - held by the process generating a cache that lost its data
+"""
+from .types_ import FieldUpdateType
+
+# Revoked signed tokens, share a slot so they're synced together
+REVOKED_TOKENS = "revoked:{auth}:tokens"
+REVOKED_USERS = "revoked:{auth}:users"
+
+# Runtime config overrides and the pub/sub channel announcing changes to them
+LIVE_CONFIG = "config:live"
+LIVE_CONFIG_CHANNEL = "config:live:changed"
+
+# Outbox streams
+OUTBOX = "outbox:{cache}"
+OUTBOX_DEAD = "outbox:{cache}:dead"
+
+# Distinct users/IPs per day and hour, share a slot so PFCOUNT can merge them on a cluster
+USERS_SEEN = "users"
+IPS_SEEN = "ips"
+
+# Blog ids, all with score 0 and ordered by their members (ZREVRANGEBYLEX)
+BLOG_INDEX = "blogs:by_id"
+
+# Users whose reads are pinned to the primary after a write
+READ_PINS = "rw:{pins}"
+
+# Marks a completely generated RedisCache (gone after a wipe or a restart of RedisCache)
+CACHE_READY = "cache:ready"
+CACHE_REBUILDING = "cache:rebuilding"
+
+# SCAN patterns
+USER_PATTERN = "user:{*}"
+BLOG_PATTERN = "blog:*"
+
+
+def user(user_id: int) -> str:
+    return f"user:{{{user_id}}}"
+
+
+def user_token(user_id: int) -> str:
+    return f"auth:{{{user_id}}}"
+
+
+def user_version(user_id: int) -> str:
+    return f"ver:{{{user_id}}}"
+
+
+def login_fails(subject) -> str:
+    """
+    :param subject: user id, or name:<primary> for logins to accounts that don't exist
+    """
+    return f"login:{{{subject}}}:fails"
+
+
+def login_lock(subject) -> str:
+    return f"login:{{{subject}}}:lock"
+
+
+def username_index(username: str) -> str:
+    return f"{FieldUpdateType.USERNAME_UPDATE}:{username}"
+
+
+def email_index(email: str) -> str:
+    return f"{FieldUpdateType.EMAIL_UPDATE}:{email}"
+
+
+def blog(blog_id: int) -> str:
+    return f"blog:{blog_id}"
+
+
+def worker_id_lease(worker_id: int) -> str:
+    return f"ids:worker:{worker_id}"
+
+
+def blog_index_member(blog_id: int) -> str:
+    """
+    Member of BLOG_INDEX: members sort lexicographically in creation order.
+    Legacy ids (20 digits, no timestamp) get prefix 0, so they sort before every newer id (and by value
+    between themselves), IdGenerator ids get prefix 1. Both are zero-padded to 20 digits.
+    """
+    prefix = "0" if int(blog_id) >= 10 ** 19 else "1"
+    return f"{prefix}{int(blog_id):020d}"
+
+
+def parse_blog_index_member(member) -> int:
+    if isinstance(member, bytes):
+        member = member.decode("utf-8")
+
+    return int(member[1:])
+
+
+def blog_idempotency(key: str) -> str:
+    return f"idem:blog:{key}"
+
+
+def seen(kind: str, period: str, stamp: str) -> str:
+    """
+    :param kind: USERS_SEEN or IPS_SEEN
+    :param period: day or hour
+    :param stamp: UTC date (20181231) or date and hour (2018123123)
+    """
+    return f"hll:{{stats}}:{kind}:{period}:{stamp}"
+
+
+def parse_id(key) -> int:
+    """
+    Extracts the id from a key: user:{123} -> 123, blog:123 -> 123
+
+    :return: the id or None if the key doesn't end with one
+    """
+    if isinstance(key, bytes):
+        key = key.decode("utf-8")
+
+    if "{" in key:
+        key = key[key.index("{") + 1:key.index("}")]
+    else:
+        key = key.rsplit(":", maxsplit=1)[-1]
+
+    return int(key) if key.isdigit() else None
@@ -0,0 +1,296 @@
+# coding=utf-8
+import configparser
+import logging
+import signal
+import threading
+import time
+
+from . import keys
+from .exceptions import StorageUnavailable
+from .config import AUTH_CONFIG_PATH, SERVER_CONFIG_PATH
+from .input_limits import UserLimits
+from .storage import get_data_store
+from .util import Singleton, after_fork, decode
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+"""
+Parameters that can be tuned at runtime, without a restart (and the cache rebuild that comes with it).
+
+Every parameter has three layers, the later ones win:
+    the default (code)
+    the config files: [Limits] in server.ini, rounds from [Crypto] in auth.ini - re-read on SIGHUP
+    overrides in RedisData (see core/keys.py) - set by admins through /api/admin/config, shared by every worker
+
+A change is announced on a Redis pub/sub channel, every worker listens on it (in a thread) and reloads both
+the files and the overrides, so all of them apply a change within moments. A SIGHUP to any worker
+(or the dev server) is announced the same way. Workers that start later read the current state on their own.
+
+Consumers read values with LiveConfig().get(name) when they need them, or register a callback with on_change
+(UserLimits is updated in place, see _apply_user_limits).
+"""
+
+# name: (section of the config file, default)
+PARAMETERS = {
+    # PBKDF2 rounds of new hashes; hashes with other rounds are upgraded on login (see core/passwords.py)
+    "rounds": ("Crypto", None),
+    # Rate-limit buckets (see eledina/api/bucket.py): `limit` requests per `per` seconds
+    "ip_bucket_limit": ("Limits", 7),
+    "ip_bucket_per": ("Limits", 8),
+    "token_bucket_limit": ("Limits", 7),
+    "token_bucket_per": ("Limits", 8),
+}
+
+# Seconds the listener waits for a message at a time, below the socket timeout of RedisData
+_LISTEN_POLL = 1
+
+# Input limits of users: username_min_length, ..., password_max_length
+USER_LIMITS = {name.lower(): name for name in vars(UserLimits) if name.endswith("_LENGTH")}
+for _name, _attribute in USER_LIMITS.items():
+    PARAMETERS[_name] = ("Limits", getattr(UserLimits, _attribute))
+
+# Fewer rounds make stolen hashes cheap to crack, many more make every login and registration a CPU burn
+MIN_ROUNDS = 10000
+MAX_ROUNDS = 10000000
+
+# Parameters that need more than a positive int - name: (minimum, maximum)
+BOUNDS = {
+    "rounds": (MIN_ROUNDS, MAX_ROUNDS),
+}
+
+# (minimum, maximum) pairs that must stay in order: (username_min_length, username_max_length), ...
+ORDERED_PAIRS = [(name, name.replace("_min_", "_max_")) for name in USER_LIMITS if "_min_" in name]
+
+
+def _read_files() -> dict:
+    """
+    Reads the parameters set in the config files
+    """
+    server = configparser.ConfigParser()
+    server.read(SERVER_CONFIG_PATH)
+    auth = configparser.ConfigParser()
+    auth.read(AUTH_CONFIG_PATH)
+
+    values = {}
+    for name, (section, default) in PARAMETERS.items():
+        parser = auth if section == "Crypto" else server
+        values[name] = parser.getint(section, name, fallback=default)
+
+    return values
+
+
+def validate(name: str, value) -> int:
+    """
+    :raise: ValueError if the parameter doesn't exist, the value is not a positive int or outside of its BOUNDS
+    """
+    if name not in PARAMETERS:
+        raise ValueError(f"unknown parameter: {name}")
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise ValueError(f"{name} must be a positive integer")
+
+    minimum, maximum = BOUNDS.get(name, (1, None))
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ValueError(f"{name} must be between {minimum} and {maximum}")
+
+    return value
+
+
+def validate_pairs(values: dict):
+    """
+    :param values: value of every parameter
+    :raise: ValueError if a minimum is greater than its maximum
+    """
+    for low, high in ORDERED_PAIRS:
+        if values[low] > values[high]:
+            raise ValueError(f"{low} ({values[low]}) must not be greater than {high} ({values[high]})")
+
+
+class LiveConfig(metaclass=Singleton):
+    """
+    Current values of runtime parameters
+    """
+    def __init__(self):
+        self.rd = get_data_store()
+
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._overrides = {}
+        self._values = _read_files()
+        # The memory engine is one process, nothing to listen to
+        self._has_pubsub = hasattr(self.rd, "pubsub")
+        self._listener = None
+
+        self.on_change(_apply_user_limits)
+        try:
+            self.reload()
+        except StorageUnavailable:
+            # The listener loads the overrides once RedisData is back
+            log.warning("RedisData is unavailable, live config overrides aren't loaded yet")
+
+        after_fork(self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        # Threads don't survive a fork, every worker starts its own listener
+        self._listener = None
+
+    def get(self, name: str) -> int:
+        # Started on first use, so a preloading master (see gunicorn.conf.py) doesn't run one while forking
+        if self._listener is None and self._has_pubsub:
+            self.ensure_listener()
+
+        return self._values[name]
+
+    def values(self) -> dict:
+        return dict(self._values)
+
+    def overrides(self) -> dict:
+        return dict(self._overrides)
+
+    def on_change(self, callback):
+        """
+        Registers callback(values) to run after every reload (and right away)
+        """
+        self._callbacks.append(callback)
+        callback(self.values())
+        return callback
+
+    def reload(self):
+        """
+        Reads the config files and the overrides from RedisData, then applies them
+        """
+        files = _read_files()
+        stored = self.rd.hgetall(keys.LIVE_CONFIG)
+
+        overrides = {}
+        for name, value in stored.items():
+            name = decode(name)
+            try:
+                overrides[name] = validate(name, int(value))
+            except ValueError:
+                log.warning(f"Ignoring invalid live config override {name}={decode(value)}")
+
+        # Overrides stored by an older version or paired with a changed config file can be out of order
+        for low, high in ORDERED_PAIRS:
+            values = dict(files, **overrides)
+            if values[low] > values[high] and (low in overrides or high in overrides):
+                log.warning(f"Ignoring live config overrides of {low} and {high}, {low} is greater than {high}")
+                overrides.pop(low, None)
+                overrides.pop(high, None)
+
+        with self._lock:
+            changed = {name: value for name, value in dict(files, **overrides).items()
+                       if self._values.get(name) != value}
+            self._overrides = overrides
+            self._values = dict(files, **overrides)
+
+            if changed:
+                log.info(f"Live config changed: {changed}")
+                for callback in self._callbacks:
+                    try:
+                        callback(self.values())
+                    except Exception:
+                        log.exception(f"Live config callback {callback.__name__} failed")
+
+    def set_overrides(self, changes: dict, reset: list=()):
+        """
+        Stores overrides in RedisData and announces them to every worker
+
+        :param changes: name: value
+        :param reset: names of overrides to remove (back to the config files)
+        :raise: ValueError if a parameter or value is invalid
+        """
+        for name, value in changes.items():
+            validate(name, value)
+        for name in reset:
+            if not isinstance(name, str) or name not in PARAMETERS:
+                raise ValueError(f"unknown parameter: {name}")
+
+        overrides = {name: value for name, value in self.overrides().items() if name not in reset}
+        overrides.update(changes)
+        validate_pairs(dict(_read_files(), **overrides))
+
+        pipe = self.rd.pipeline(transaction=False)
+        if changes:
+            pipe.hmset(keys.LIVE_CONFIG, changes)
+        if reset:
+            pipe.hdel(keys.LIVE_CONFIG, *reset)
+        pipe.execute()
+
+        self.reload()
+        self.announce()
+
+    def announce(self):
+        """
+        Tells every worker to reload
+        """
+        self.rd.publish(keys.LIVE_CONFIG_CHANNEL, "reload")
+
+    def reload_and_announce(self):
+        try:
+            self.reload()
+            self.announce()
+        except Exception:
+            log.exception("Reloading the live config failed")
+
+    # LISTENER
+    def ensure_listener(self):
+        """
+        Starts the thread listening for changes
+        """
+        with self._lock:
+            if self._listener is not None:
+                return
+
+            self._listener = threading.Thread(target=self._listen, name="live-config", daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.rd.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(keys.LIVE_CONFIG_CHANNEL)
+                # Changes made while (re)connecting weren't received
+                self.reload()
+
+                # listen() would block on the socket and fail with its socket_timeout (core/redis.py)
+                # whenever nothing is announced for that long, get_message waits with a poll instead
+                while True:
+                    message = pubsub.get_message(timeout=_LISTEN_POLL)
+                    if message is not None and message["type"] == "message":
+                        self.reload()
+            except Exception as e:
+                # Usually RedisData being down, which is logged by its circuit breaker already
+                log.warning(f"Live config listener failed ({e}), reconnecting in 5 seconds")
+                time.sleep(5)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+
+def _apply_user_limits(values: dict):
+    # Users and the API schemas read these attributes, schemas have to be recompiled (see eledina/api/schemas.py)
+    for name, attribute in USER_LIMITS.items():
+        setattr(UserLimits, attribute, values[name])
+
+
+def install_signal_handler():
+    """
+    Reloads the live config on SIGHUP and announces it to every worker.
+    Must run in the main thread; gunicorn resets signals in workers, so it's installed in post_worker_init.
+    """
+    if not hasattr(signal, "SIGHUP"):
+        return
+
+    def handler(*_):
+        # Redis can't be used from a signal handler, the interrupted code may hold a connection
+        threading.Thread(target=LiveConfig().reload_and_announce, name="live-config-reload", daemon=True).start()
+
+    signal.signal(signal.SIGHUP, handler)
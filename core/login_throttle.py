@@ -0,0 +1,119 @@
+# coding=utf-8
+import threading
+import time
+
+from . import keys
+from .config import server_config
+from .exceptions import LoginThrottled
+from .storage import get_cache_store
+from .util import Singleton, after_fork, decode
+
+
+class LoginThrottle(metaclass=Singleton):
+    """
+    Per-account throttling of failed logins, checked before the password is hashed.
+
+    RedisCache layout:
+        login:{<user_id>}:fails (String, expires after WINDOW seconds without failures)
+            amount of failed logins
+        login:{<user_id>}:lock (String, expires when the lockout ends)
+            lockout length in seconds
+
+    After FREE_ATTEMPTS failures every further failure locks the account for
+    BASE_LOCKOUT * 2^(failures - FREE_ATTEMPTS) seconds, up to MAX_LOCKOUT.
+    Lockouts are also mirrored in the worker (at most MIRROR_SIZE of them), so repeated attempts
+    against a locked account are rejected without a Redis round trip.
+
+    Names without an account are throttled the same way (subject name:<primary>), otherwise
+    the 429 of a locked account would tell that the account exists.
+    """
+    FREE_ATTEMPTS = server_config.getint("LoginThrottle", "free_attempts", fallback=5)
+    WINDOW = server_config.getint("LoginThrottle", "window", fallback=900)
+    BASE_LOCKOUT = server_config.getint("LoginThrottle", "base_lockout", fallback=1)
+    MAX_LOCKOUT = server_config.getint("LoginThrottle", "max_lockout", fallback=900)
+    # Lockouts mirrored per worker
+    MIRROR_SIZE = server_config.getint("LoginThrottle", "mirror_size", fallback=10000)
+
+    def __init__(self):
+        self.rc = get_cache_store()
+        # subject: unix time when the lockout ends, oldest lockouts first (shared by the request threads)
+        self._locked_until = {}
+        self._lock = threading.Lock()
+
+        after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # The parent's lock may have been held by another thread while forking
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def unknown(primary: str) -> str:
+        """
+        Subject for logins with a name (email or username) of no account
+        """
+        return f"name:{primary}"
+
+    def _mirror(self, subject, until: float):
+        with self._lock:
+            self._locked_until.pop(subject, None)
+            self._locked_until[subject] = until
+
+            if len(self._locked_until) > self.MIRROR_SIZE:
+                # Drop ended lockouts, then the oldest ones (they're still enforced through Redis),
+                # down to 3/4 so the sweep doesn't run on every new lockout
+                now = time.time()
+                self._locked_until = {s: u for s, u in self._locked_until.items() if u > now}
+                while len(self._locked_until) > self.MIRROR_SIZE * 3 // 4:
+                    del self._locked_until[next(iter(self._locked_until))]
+
+    def check(self, user_id) -> int:
+        """
+        :param user_id: user id or unknown(primary)
+        :raise: LoginThrottled if the account is locked
+        :return: amount of recent failed logins
+        """
+        now = time.time()
+
+        with self._lock:
+            until = self._locked_until.get(user_id)
+            if until is not None and until <= now:
+                self._locked_until.pop(user_id, None)
+        if until is not None and until > now:
+            raise LoginThrottled(until - now)
+
+        pipe = self.rc.pipeline(transaction=False)
+        pipe.ttl(keys.login_lock(user_id))
+        pipe.get(keys.login_fails(user_id))
+        ttl, failures = decode(pipe.execute())
+
+        # ttl is negative (or None) if there is no lock
+        if ttl and ttl > 0:
+            self._mirror(user_id, now + ttl)
+            raise LoginThrottled(ttl)
+
+        return failures or 0
+
+    def failed(self, user_id):
+        """
+        Records a failed login and locks the account if needed
+        """
+        pipe = self.rc.pipeline()
+        pipe.incr(keys.login_fails(user_id))
+        pipe.expire(keys.login_fails(user_id), self.WINDOW)
+        failures = pipe.execute()[0]
+
+        over = failures - self.FREE_ATTEMPTS
+        if over <= 0:
+            return
+
+        lockout = min(self.BASE_LOCKOUT * 2 ** min(over - 1, 32), self.MAX_LOCKOUT)
+        self.rc.set(keys.login_lock(user_id), lockout, ex=lockout)
+        self._mirror(user_id, time.time() + lockout)
+
+    def succeeded(self, user_id):
+        """
+        Resets failures after a successful login, only needed if check() returned any
+        """
+        self.rc.delete(keys.login_fails(user_id), keys.login_lock(user_id))
+        with self._lock:
+            self._locked_until.pop(user_id, None)
@@ -0,0 +1,244 @@
+# coding=utf-8
+import argparse
+import math
+import random
+import sys
+import time
+
+from . import keys
+from .storage import get_data_store, get_cache_store, ENGINE
+from .tracing import key_pattern
+
+
+"""
+Memory footprint of RedisData and RedisCache, by key group.
+
+Keys are walked with SCAN, a sample of them is measured with MEMORY USAGE and OBJECT ENCODING.
+Every group gets a key count, average and p99 size, estimated total and the total after GROWTH times more keys.
+Hashes, sets and sorted sets that are no longer in a compact encoding (ziplist, listpack, intset) are counted,
+they take several times more memory - usually because a field got longer than hash-max-ziplist-value.
+
+Commands are rate limited (--rate), so it's safe to run against production:
+    python -m core.memory_report --store data --sample 0.1 --rate 500
+"""
+
+COMPACT_ENCODINGS = {"ziplist", "listpack", "intset"}
+# Types that have a compact encoding
+COMPACTABLE_TYPES = {"hash", "set", "zset", "list"}
+
+# Keys named after a value instead of an id, grouped by prefix
+VALUE_KEYED_PREFIXES = (
+    keys.username_index(""),
+    keys.email_index(""),
+    keys.blog_idempotency(""),
+)
+
+
+def key_group(key) -> str:
+    """
+    Group of a key: blog:123 -> blog:*, user:{123} -> user:{*}, idx:username:alice -> idx:username:*
+    """
+    if isinstance(key, bytes):
+        key = key.decode(errors="replace")
+
+    for prefix in VALUE_KEYED_PREFIXES:
+        if key.startswith(prefix):
+            return prefix + "*"
+
+    return key_pattern(key)
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    if not values:
+        return 0
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+class RateLimiter:
+    """
+    Sleeps so that no more than `rate` commands are sent per second
+    """
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = time.perf_counter()
+
+    def wait(self, commands: int=1):
+        now = time.perf_counter()
+        if self._next > now:
+            time.sleep(self._next - now)
+        self._next = max(self._next, now) + commands * self.interval
+
+
+class _Group:
+    __slots__ = ("type", "count", "sizes", "non_compact", "sampled_compactable", "encodings")
+
+    def __init__(self):
+        self.type = None
+        self.count = 0
+        self.sizes = []
+        self.non_compact = 0
+        self.sampled_compactable = 0
+        self.encodings = {}
+
+
+def analyze(store, sample: float=1.0, rate: float=1000, scan_count: int=100, batch: int=50,
+            growth: float=10) -> dict:
+    """
+    Walks the whole keyspace of the store and measures a sample of the keys
+
+    :param sample: fraction of keys measured (counts always include every key)
+    :param rate: maximum commands per second
+    :param scan_count: COUNT hint of SCAN
+    :param batch: keys measured per pipeline
+    :return: dict with totals and a list of groups, largest first
+    """
+    limiter = RateLimiter(rate)
+    groups = {}
+    pending = []
+
+    def measure(batch_keys):
+        # Three commands per key, sent in one round trip
+        limiter.wait(len(batch_keys) * 3)
+
+        pipe = store.pipeline(transaction=False)
+        for key in batch_keys:
+            pipe.execute_command("MEMORY", "USAGE", key, "SAMPLES", "0")
+            pipe.execute_command("TYPE", key)
+            pipe.execute_command("OBJECT", "ENCODING", key, infotype="ENCODING")
+        # Keys can expire or be deleted between SCAN and the measurement
+        replies = pipe.execute(raise_on_error=False)
+
+        for i, key in enumerate(batch_keys):
+            size, type_, encoding = replies[i * 3:i * 3 + 3]
+            if size is None or isinstance(size, Exception):
+                continue
+
+            group = groups[key_group(key)]
+            group.type = type_.decode() if isinstance(type_, bytes) else type_
+            group.sizes.append(size)
+
+            if isinstance(encoding, bytes):
+                encoding = encoding.decode()
+                group.encodings[encoding] = group.encodings.get(encoding, 0) + 1
+                if group.type in COMPACTABLE_TYPES:
+                    group.sampled_compactable += 1
+                    if encoding not in COMPACT_ENCODINGS:
+                        group.non_compact += 1
+
+    scanned = 0
+    for key in store.scan_iter(count=scan_count):
+        # One SCAN call returns about scan_count keys
+        if scanned % scan_count == 0:
+            limiter.wait()
+        scanned += 1
+
+        name = key_group(key)
+        group = groups.get(name)
+        if group is None:
+            group = groups[name] = _Group()
+        group.count += 1
+
+        if sample >= 1 or random.random() < sample:
+            pending.append(key)
+            if len(pending) >= batch:
+                measure(pending)
+                pending = []
+
+    if pending:
+        measure(pending)
+
+    report = []
+    for name, group in groups.items():
+        sizes = sorted(group.sizes)
+        average = sum(sizes) / len(sizes) if sizes else 0
+        total = average * group.count
+
+        report.append({
+            "group": name,
+            "type": group.type,
+            "keys": group.count,
+            "sampled": len(sizes),
+            "avg_bytes": round(average, 1),
+            "p99_bytes": percentile(sizes, 99),
+            "total_bytes": int(total),
+            "projected_bytes": int(total * growth),
+            "encodings": group.encodings,
+            "non_compact": group.non_compact,
+            # Share of sampled keys that lost their compact encoding
+            "non_compact_ratio": round(group.non_compact / group.sampled_compactable, 3)
+            if group.sampled_compactable else 0,
+        })
+
+    report.sort(key=lambda g: g["total_bytes"], reverse=True)
+
+    return {
+        "keys": scanned,
+        "total_bytes": sum(g["total_bytes"] for g in report),
+        "projected_bytes": sum(g["projected_bytes"] for g in report),
+        "growth": growth,
+        "groups": report,
+    }
+
+
+def _human(size: float) -> str:
+    size = float(size)
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{round(size, 1)} {unit}"
+        size /= 1024
+    return f"{round(size, 1)} TiB"
+
+
+def print_report(name: str, report: dict):
+    print(f"{name}: {report['keys']} keys, {_human(report['total_bytes'])} "
+          f"(at {report['growth']}x: {_human(report['projected_bytes'])})")
+
+    print(f"{'group':<28} {'type':<6} {'keys':>10} {'sampled':>8} {'avg':>10} {'p99':>10} "
+          f"{'total':>11} {'projected':>11}  encodings")
+    for g in report["groups"]:
+        encodings = ", ".join(f"{e}={c}" for e, c in sorted(g["encodings"].items()))
+        flag = f"  <- {g['non_compact']} not compact" if g["non_compact"] else ""
+        print(f"{g['group']:<28} {str(g['type']):<6} {g['keys']:>10} {g['sampled']:>8} "
+              f"{_human(g['avg_bytes']):>10} {_human(g['p99_bytes']):>10} "
+              f"{_human(g['total_bytes']):>11} {_human(g['projected_bytes']):>11}  {encodings}{flag}")
+    print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report memory usage of RedisData/RedisCache by key group")
+    parser.add_argument("--store", choices=("data", "cache", "both"), default="both")
+    parser.add_argument("--sample", type=float, default=1.0, help="fraction of keys to measure (0-1)")
+    parser.add_argument("--rate", type=float, default=1000, help="maximum Redis commands per second")
+    parser.add_argument("--growth", type=float, default=10, help="growth factor for projections")
+    parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    args = parser.parse_args(argv)
+
+    if ENGINE != "redis":
+        print("The memory report needs the redis storage engine (MEMORY USAGE and OBJECT ENCODING)")
+        sys.exit(2)
+
+    stores = []
+    if args.store in ("data", "both"):
+        stores.append(("RedisData", get_data_store()))
+    if args.store in ("cache", "both"):
+        stores.append(("RedisCache", get_cache_store()))
+
+    reports = {name: analyze(store, args.sample, args.rate, growth=args.growth) for name, store in stores}
+
+    if args.json:
+        try:
+            from ujson import dumps
+        except ImportError:
+            from json import dumps
+        print(dumps(reports, indent=2))
+        return
+
+    for name, report in reports.items():
+        print_report(name, report)
+
+
+if __name__ == "__main__":
+    main()
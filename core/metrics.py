@@ -0,0 +1,61 @@
+# coding=utf-8
+import threading
+
+from .util import Singleton, after_fork
+
+
+class Metrics(metaclass=Singleton):
+    """
+    Per-worker metrics registry, exported via /api/metrics.
+
+    Counters only go up, summaries keep count, sum and max of observed values.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.summaries = {}
+
+        # Metrics are per worker
+        after_fork(self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.summaries = {}
+
+    def inc(self, name: str, amount: int=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            summary = self.summaries.get(name)
+            if summary is None:
+                self.summaries[name] = [1, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                if value > summary[2]:
+                    summary[2] = value
+
+    def export(self) -> dict:
+        with self._lock:
+            summaries = {
+                name: {
+                    "count": count,
+                    "sum": total,
+                    "avg": total / count,
+                    "max": maximum,
+                }
+                for name, (count, total, maximum) in self.summaries.items()
+            }
+
+            return {
+                "counters": dict(self.counters),
+                "summaries": summaries,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.summaries = {}
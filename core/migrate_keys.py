@@ -0,0 +1,65 @@
+# coding=utf-8
+import argparse
+import logging
+
+from . import keys
+from .storage import get_data_store
+from .util import is_valid_id
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+"""
+Moves RedisData from the old key names to the ones in core/keys.py:
+    user:<id> -> user:{<id>}
+    auth:by_token, auth:by_user -> deleted, every user has to log in again (tokens are now <user_id>.<secret>)
+
+RedisCache doesn't need migrating, it's regenerated on startup.
+Run with the server stopped: python -m core.migrate_keys
+"""
+
+
+def migrate_users(rd, dry_run: bool=False) -> int:
+    count = 0
+
+    for key in rd.scan_iter(match="user:*"):
+        key = key.decode("utf-8")
+        user_id = key.split(":", maxsplit=1)[1]
+        # Already migrated keys (and old cache hashes in the same database) are skipped
+        if not user_id.isdigit() or not is_valid_id(int(user_id)):
+            continue
+
+        count += 1
+        if dry_run:
+            continue
+
+        # The new key is in a different slot, so this can't be a RENAME on a cluster
+        user = rd.hgetall(key)
+        if user:
+            rd.hmset(keys.user(int(user_id)), user)
+        rd.delete(key)
+
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate RedisData to cluster-friendly key names")
+    parser.add_argument("--dry-run", action="store_true", help="only count the keys that would be migrated")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    rd = get_data_store()
+
+    count = migrate_users(rd, args.dry_run)
+    log.info(f"{'Would migrate' if args.dry_run else 'Migrated'} {count} users")
+
+    if not args.dry_run:
+        rd.delete("auth:by_token")
+        rd.delete("auth:by_user")
+        log.info("Deleted old tokens")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,57 @@
 # coding=utf-8
+import atexit
+import logging
 import time
-from passlib.hash import pbkdf2_sha512
+from secrets import compare_digest
 
-from .util import is_email, gen_id, gen_token, Singleton, decode
-from .exceptions import ForbiddenArgument, LoginFailed, UsernameAlreadyExists, EmailAlreadyRegistered
-from .input_limits import UserLimits
-from .config import SALT, ROUNDS
+from .util import is_email, gen_id, gen_token, Singleton, decode, is_valid_id
+from .exceptions import ForbiddenArgument, LoginFailed, UsernameAlreadyExists, EmailAlreadyRegistered, \
+    StorageUnavailable
+from .input_limits import UserLimits, BlogLimits
+from .passwords import hash_password, verify_password
 from .cachemanager import CacheGenerator
-from .types_ import FieldUpdateType
+from .login_throttle import LoginThrottle
+from .signed_tokens import SignedTokens, is_signed_token, MODE as TOKEN_MODE
+from .outbox import Outbox, ENABLED as OUTBOX_ENABLED
+from .types_ import Role
+from .worker_cache import CoalescingLRU, CounterBuffer
+from .config import server_config
+from .replicas import pin_reads, primary_reads
+from .read_pins import ReadPins
+from .unit_of_work import deferred, on_rollback, after_commit
+from . import keys
 
-from .redis import RedisData, RedisCache
+from .storage import get_data_store, get_cache_store
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+def _delete_claims(store, claims: list):
+    """
+    Deletes keys claimed with SET NX, as long as they still hold the value they were claimed with
+
+    :param claims: list of (key, value)
+    """
+    pipe = store.pipeline(transaction=False)
+    for key, _ in claims:
+        pipe.get(key)
+    owned = [key for (key, value), current in zip(claims, pipe.execute()) if current == str(value).encode()]
+
+    if owned:
+        # Different slots, no multi-key DEL
+        pipe = store.pipeline(transaction=False)
+        for key in owned:
+            pipe.delete(key)
+        pipe.execute()
 
 
 class Users(metaclass=Singleton):
     """
-    Users are available in:
+    Users are available in (see core/keys.py):
 
-        RedisData under user:<id> (Hash)
+        RedisData under user:{<id>} (Hash)
             username: str
             fullname: str (name and surname split with '|')
             about: str
@@ -26,67 +61,100 @@ class Users(metaclass=Singleton):
             reg_on: int
 
         RedisCache provides links:
-            user:by_username (Hash)
-                <username>:<user_id>
-            user:by_email (Hash)
-                <email>:<user_id>
+            idx:username:<username> (String)
+                <user_id>
+            idx:email:<email> (String)
+                <user_id>
+
 
+        RedisData under ver:{<id>} (String)
+            <version: int> - bumped by every profile write, missing means 0
 
     Tokens are available in:
 
-        RedisData under multiple keys:
-            auth:by_token (Hash)
-                <token>: <userid>
-            auth:by_user (Hash)
-                <userid>: <token: str>
+        RedisData under auth:{<id>} (String)
+            <token: str>
+
+        Tokens look like <user_id>.<secret>, so the user (and the slot of auth:{<id>}) is known
+        from the token alone.
+
+        With [Tokens] mode=signed, new tokens are signed instead (see core/signed_tokens.py)
+        and nothing is stored. Stored tokens keep working until they're replaced.
+
+    Writes are queued in the request's unit of work and sent together at its end (see core/unit_of_work.py).
 
     """
     USER_ATTR_WHITELIST = ("username", "fullname", "about", "email", "password", "role", "reg_on")
+    # Fields the user gets to see of their own profile
+    PROFILE_FIELDS = ("username", "fullname", "about", "email", "role", "reg_on")
+    # Seconds clients are told to wait while the RedisCache index is generated
+    CACHE_RETRY_AFTER = 5
 
     def __init__(self):
-        self.rd = RedisData()
-        self.rc = RedisCache()
+        self.rd = get_data_store()
+        self.rc = get_cache_store()
         self.cache = CacheGenerator()
+        self.throttle = LoginThrottle()
+        self.outbox = Outbox()
+        self.read_pins = ReadPins()
+        self.signed_tokens = SignedTokens() if TOKEN_MODE == "signed" else None
 
     @staticmethod
     def _hash_password(password: str) -> str:
         """
-        Hashes the password with sha512 and a custom salt
+        Hashes the password with pbkdf2_sha512 and a random salt (see core/passwords.py)
         """
-        # return pbkdf2_sha512.encrypt(password, rounds=ROUNDS, salt=SALT)
-        return pbkdf2_sha512.using(rounds=ROUNDS, salt=SALT).hash(password)
+        return hash_password(password)
 
     @staticmethod
     def _is_valid_userid(user_id: int):
-        # !! HARDCODED ID LENGTH !!
-        # see gen_id() for explanation
-        return isinstance(user_id, int) and len(str(user_id)) == 20
+        # see IdGenerator (and is_valid_id for legacy ids)
+        return is_valid_id(user_id)
 
     def _verify_password(self, password: str, user_id: int) -> bool:
         """
-        Verifies that the password is correct
+        Verifies that the password is correct.
+        Hashes made with outdated parameters are transparently replaced.
         """
         hashed = self._get_hashed_password(user_id)
-        return pbkdf2_sha512.verify(password, hashed)
+        if hashed is None and self.rd.replicas:
+            # A new user may not have reached the replica yet
+            with primary_reads():
+                hashed = self._get_hashed_password(user_id)
+        if hashed is None:
+            # The index link of a registration that isn't committed yet (or was discarded), no such user yet
+            return False
+
+        is_correct, new_hash = verify_password(password, hashed)
+
+        if new_hash is not None:
+            deferred(self.rd).hset(keys.user(user_id), "password", new_hash)
+
+        return is_correct
 
     def _change_token(self, user_id: int, new_token: str):
         if not self._is_valid_userid(user_id):
             raise ForbiddenArgument("invalid user_id")
 
         # TODO token expiration
-        current_token = self.rd.hget("auth:by_user", user_id)
+        # Overwriting invalidates the old token
+        deferred(self.rd).set(keys.user_token(user_id), new_token)
+        self._pin_user_reads(user_id)
 
-        pipe = self.rd.pipeline()
-        # Old token needs to be deleted first
-        pipe.hdel("auth:by_token", current_token)
-        pipe.hset("auth:by_token", new_token, user_id)
-        # Can be overwritten
-        pipe.hset("auth:by_user", user_id, new_token)
+    @staticmethod
+    def _new_token(user_id: int) -> str:
+        return f"{user_id}.{gen_token()}"
 
-        pipe.execute()
+    def _issue_token(self, user_id: int) -> str:
+        if self.signed_tokens is not None:
+            return self.signed_tokens.issue(user_id)
+
+        new_token = self._new_token(user_id)
+        self._change_token(user_id, new_token)
+        return new_token
 
     def _user_exists(self, username: str) -> bool:
-        return self.rc.hexists("user:by_username", username)
+        return bool(self.rc.exists(keys.username_index(username)))
 
     @staticmethod
     def _validate_user_fields(fields: dict):
@@ -104,7 +172,7 @@ class Users(metaclass=Singleton):
                     raise ForbiddenArgument("invalid username")
 
             elif k == "fullname":
-                if len(v) > UserLimits.FULLNAME_MAX_LENGTH or len(v) < UserLimits.USERNAME_MIN_LENGTH:
+                if len(v) > UserLimits.FULLNAME_MAX_LENGTH or len(v) < UserLimits.FULLNAME_MIN_LENGTH:
                     raise ForbiddenArgument("invalid full name")
 
             elif k == "email":
@@ -129,11 +197,9 @@ class Users(metaclass=Singleton):
         # Verify fields
         self._validate_user_fields(payload)
 
-        # Check if users already exist
-        if self.rc.hexists("user:by_username", username):
+        # Cheap check first, so taken usernames don't cost a password hash
+        if self._user_exists(username):
             raise UsernameAlreadyExists
-        if self.rc.hexists("user:by_email", email):
-            raise EmailAlreadyRegistered
 
         payload.update({
             "password": self._hash_password(password),
@@ -142,16 +208,41 @@ class Users(metaclass=Singleton):
             # about defaults to empty
         })
 
-        # Generate id and set info
         user_id = gen_id()
-        self.rd.hmset(f"user:{user_id}", payload)
 
-        # Generate and return token
-        new_token = gen_token()
-        self._change_token(user_id, new_token)
+        # Claim username and email (so others can't register with the same ones)
+        # The index keys are in different slots, so they are claimed one by one and released on failure
+        pipe = self.rc.pipeline(transaction=False)
+        self.cache.is_ready(pipe)
+        pipe.set(keys.username_index(username), user_id, nx=True)
+        pipe.set(keys.email_index(email), user_id, nx=True)
+        ready, username_claimed, email_claimed = pipe.execute()
+
+        if not ready or not username_claimed or not email_claimed:
+            if username_claimed:
+                self.rc.delete(keys.username_index(username))
+            if email_claimed:
+                self.rc.delete(keys.email_index(email))
+
+            if not ready:
+                raise self._cache_not_ready()
+            if not username_claimed:
+                raise UsernameAlreadyExists
+            raise EmailAlreadyRegistered
+
+        # The user is only written at the commit, without it the links would block both values for good
+        on_rollback(self.rd, lambda: _delete_claims(self.rc, [(keys.username_index(username), user_id),
+                                                              (keys.email_index(email), user_id)]))
 
-        # UPDATE CACHE for this user (so others can't register with the same username or email)
-        self.cache.cache_single_user(user_id)
+        # User and their token share a slot, so they are written together
+        rd = deferred(self.rd)
+        rd.hmset(keys.user(user_id), payload)
+        if self.signed_tokens is None:
+            new_token = self._new_token(user_id)
+            rd.set(keys.user_token(user_id), new_token)
+        else:
+            new_token = self.signed_tokens.issue(user_id)
+        self._pin_user_reads(user_id)
 
         return new_token
 
@@ -161,6 +252,7 @@ class Users(metaclass=Singleton):
         Logs in the user with the provided email and password.
 
         :param: primary: Primary identification (email or username)
+        :raise: LoginThrottled if the account is locked after too many failed logins
         :return: Token to be used on sequential requests
         """
         # Validate fields
@@ -169,30 +261,89 @@ class Users(metaclass=Singleton):
 
         self._validate_user_fields({"password": password})
 
-        # Get user_id from email
-        user_id = decode(self.rc.hget("user:by_email", primary))
-        # User didn't pass email, but username
-        if not user_id:
-            user_id = decode(self.rc.hget("user:by_username", primary))
+        # Get user_id from email or username (user didn't pass email) in one round trip
+        pipe = self.rc.pipeline(transaction=False)
+        pipe.get(keys.email_index(primary))
+        pipe.get(keys.username_index(primary))
+        self.cache.is_ready(pipe)
+        by_email, by_username, ready = decode(pipe.execute())
+        user_id = by_email or by_username
 
-        # If user_id is still None that means incorrect credentials were sent
+        # Without the index (RedisCache lost its data) existing users would look unknown
+        if not user_id and not ready:
+            raise self._cache_not_ready()
+
+        # If user_id is still None that means incorrect credentials were sent.
+        # The name is throttled like an account, so locked accounts can't be told apart from unknown names
         if not user_id:
+            self.throttle.check(self.throttle.unknown(primary))
+            self.throttle.failed(self.throttle.unknown(primary))
             raise LoginFailed("wrong password/email")
 
+        # Locked accounts are rejected before the (expensive) password check
+        failures = self.throttle.check(user_id)
+
         if not self._verify_password(password, user_id):
+            self.throttle.failed(user_id)
             raise LoginFailed("wrong password/email")
 
-        new_token = gen_token()
-        self._change_token(user_id, new_token)
+        if failures:
+            self.throttle.succeeded(user_id)
 
-        return new_token
+        return self._issue_token(user_id)
+
+    def logout_user(self, token: str):
+        """
+        Invalidates the token (must be verified first)
+        """
+        if is_signed_token(token):
+            if self.signed_tokens is not None:
+                self.signed_tokens.revoke(token)
+            return
+
+        user_id, _, _ = token.partition(".")
+        deferred(self.rd).delete(keys.user_token(user_id))
 
-    def verify_token(self, token: str) -> str:
+    def verify_token(self, token: str) -> int:
         """
         Returns a userid from the provided token - used on requests with restricted access to verify user
-        :return: user id
+        Signed tokens are verified without any round trip.
+
+        :return: user id or None if the token is invalid
         """
-        return decode(self.rd.hget("auth:by_token", token))
+        if not token:
+            return None
+        if is_signed_token(token):
+            user_id = self.signed_tokens.verify(token) if self.signed_tokens is not None else None
+            if user_id is not None:
+                self.read_pins.apply(user_id)
+            return user_id
+
+        user_id, _, secret = token.partition(".")
+        if not secret or not user_id.isdigit():
+            return None
+
+        # Before the token is read, a user who just logged in is pinned to the primary already
+        self.read_pins.apply(user_id)
+        token = token.encode("utf-8")
+        current = self.rd.get(keys.user_token(user_id))
+        if current is None or not compare_digest(current, token):
+            # A new token may not have reached the replica yet (client without the read pin cookie)
+            if not self.rd.replicas:
+                return None
+            with primary_reads():
+                current = self.rd.get(keys.user_token(user_id))
+            if current is None or not compare_digest(current, token):
+                return None
+
+        return int(user_id)
+
+    def _pin_user_reads(self, user_id: int):
+        """
+        Pins the reads of the current session and, with replicas, of the user (clients without the pin cookie)
+        """
+        pin_reads()
+        self.read_pins.pin(user_id)
 
     def _get_user_attr(self, user_id: int, attr: str) -> str:
         """
@@ -211,7 +362,13 @@ class Users(metaclass=Singleton):
         if attr not in Users.USER_ATTR_WHITELIST:
             raise ForbiddenArgument("invalid attribute")
 
-        return decode(self.rd.hget(f"user:{user_id}", attr))
+        return decode(self.rd.hget(keys.user(user_id), attr))
+
+    def _cache_not_ready(self) -> StorageUnavailable:
+        # The index is incomplete (RedisCache was wiped or lost its data), a claim could duplicate a username.
+        # It's generated again in the background, unless that is running already
+        self.cache.ensure_generated()
+        return StorageUnavailable("RedisCache index", Users.CACHE_RETRY_AFTER)
 
     def _set_user_field(self, user_id: int, field: str, value: str, data):
         """
@@ -220,52 +377,111 @@ class Users(metaclass=Singleton):
         :param: user_id - ID of the user you want to modify
         :param: field - the field you want to update
         :param: value - what value to set the field to
-        :param: data - user fields before update for caching
+        :param: data - previous values of username/email (index links to release)
         """
         if field not in Users.USER_ATTR_WHITELIST:
             raise ForbiddenArgument("invalid field")
 
         # Do an assortment of checks
-        if field == "username" and self.rc.hexists("user:by_username", value):
-            raise UsernameAlreadyExists("username taken")
-        if field == "email" and self.rc.hexists("user:by_email", value):
-            raise EmailAlreadyRegistered("email already registered")
+        if field in ("username", "email"):
+            index_key = keys.username_index(value) if field == "username" else keys.email_index(value)
+
+            # Claiming the new value links it right away (the owner comes back if it's taken)
+            pipe = self.rc.pipeline(transaction=False)
+            self.cache.is_ready(pipe)
+            pipe.set(index_key, user_id, nx=True)
+            pipe.get(index_key)
+            ready, claimed, owner = pipe.execute()
+
+            if not ready:
+                if claimed:
+                    self.rc.delete(index_key)
+                raise self._cache_not_ready()
+            if not claimed:
+                if owner != str(user_id).encode():
+                    if field == "username":
+                        raise UsernameAlreadyExists("username taken")
+                    raise EmailAlreadyRegistered("email already registered")
+                # The user's own link (their current value, or a previous one whose release is still pending):
+                # the release may delete it before the new value is written, so it's claimed again at the commit
+                deferred(self.rc).set(index_key, user_id, nx=True)
+            else:
+                # A new link whose value is never written would block it for good
+                on_rollback(self.rd, lambda: _delete_claims(self.rc, [(index_key, user_id)]))
+
+            # Only a successful claim makes the previous link stale, the outbox consumer releases it.
+            # The event is published with the commit, an update that's discarded releases nothing
+            if OUTBOX_ENABLED and str(data[field]) != value:
+                self.outbox.release_link(user_id, field, str(data[field]), deferred(self.rc))
         if field == "password":
             # Hash password
             value = self._hash_password(value)
         if field == "reg_on":
             raise ForbiddenArgument("can't update reg_on via _set_user_field")
 
-        response = decode(self.rd.hset(f"user:{user_id}", field, value))
+        # The version shares the slot of the user, both change together (with the other fields at the commit)
+        rd = deferred(self.rd)
+        rd.hset(keys.user(user_id), field, value)
+        rd.incr(keys.user_version(user_id))
 
-        # Update cache if needed
-        if field == "username":
-            prev = data["username"]
-            self.cache.cache_user_field_update(user_id, FieldUpdateType.USERNAME_UPDATE, prev, value)
-        elif field == "email":
-            prev = data["email"]
-            self.cache.cache_user_field_update(user_id, FieldUpdateType.EMAIL_UPDATE, prev, value)
+        # A new password logs out every session
+        if field == "password" and self.signed_tokens is not None:
+            self.signed_tokens.revoke_user(user_id)
 
-        return response
+        # Update cache if needed (without the outbox), once the new value is stored - before it,
+        # the previous link is still the user's current value and wouldn't be released
+        if field in ("username", "email") and not OUTBOX_ENABLED:
+            release = (user_id, field, str(data[field]), time.time())
+            after_commit(lambda: self.cache.release_user_links([release]))
 
     def update_user(self, user_id: int, fields: dict):
         if not self._is_valid_userid(user_id):
             raise ForbiddenArgument("invalid user_id")
 
         self._validate_user_fields(fields)
-        # _set_user_field needs user data before update for caching
-        user_data = self.get_user_info(user_id)
-
-        # Iterates though fields and sets them in db
-        update = all([self._set_user_field(user_id, f, v, user_data) for f, v in fields.items()])
-        return update
+        # _set_user_field needs the previous username/email to release their index links,
+        # other fields are written without reading anything
+        linked = [f for f in ("username", "email") if f in fields]
+        previous = {}
+        if linked:
+            values = deferred(self.rd).hmget(keys.user(user_id), linked).get()
+            previous = dict(zip(linked, decode(values)))
+
+        # Iterates though fields and queues them, they're written together at the commit
+        for f, v in fields.items():
+            self._set_user_field(user_id, f, v, previous)
+        self._pin_user_reads(user_id)
 
     ###################
     # GETTER FUNCTIONS
     # THESE NEED ID'S
     ###################
+    def get_profile_version(self, user_id: int) -> int:
+        """
+        Current version of the user's profile, one small read (see get_profile)
+        """
+        return int(self.rd.get(keys.user_version(user_id)) or 0)
+
+    def get_profile(self, user_id: int) -> tuple:
+        """
+        The user's profile (PROFILE_FIELDS only) and its version, read together
+
+        :return: (version, profile)
+        """
+        pipe = self.rd.pipeline()
+        pipe.hmget(keys.user(user_id), Users.PROFILE_FIELDS)
+        pipe.get(keys.user_version(user_id))
+        values, version = pipe.execute()
+
+        profile = {field: decode(value) for field, value in zip(Users.PROFILE_FIELDS, values)}
+        # role defaults to USER when it isn't set
+        if profile["role"] is None:
+            profile["role"] = Role.USER
+
+        return int(version or 0), profile
+
     def get_user_info(self, user_id: int) -> dict:
-        data = decode(self.rd.hgetall(f"user:{user_id}"))
+        data = decode(self.rd.hgetall(keys.user(user_id)))
         # passing password is not good even if hashed, so we remove it
         try:
             del data["password"]
@@ -286,17 +502,69 @@ class Users(metaclass=Singleton):
     def get_email(self, user_id: int) -> str:
         return self._get_user_attr(user_id, "email")
 
+    def get_role(self, user_id: int) -> int:
+        # role defaults to USER when it isn't set
+        role = self._get_user_attr(user_id, "role")
+        return Role.USER if role is None else role
+
     def _get_hashed_password(self, user_id: int) -> str:
         return self._get_user_attr(user_id, "password")
 
 
 class Blogs(metaclass=Singleton):
+    """
+    Blogs are available in:
+
+        RedisData under blog:<id> (Hash)
+            title: str
+            content: str
+            date: str
+            views: int (flushed periodically from every worker)
+
+        RedisCache under blogs:by_id (Sorted set) - ids in creation order, for pagination
+            (see keys.blog_index_member, generated on startup)
+
+    Idempotency keys of batch uploads are available in:
+
+        RedisData under idem:blog:<key> (String, expires after IDEMPOTENCY_TTL)
+            <blog_id>
+    """
+    # Seconds for which a client can safely retry a batch upload
+    IDEMPOTENCY_TTL = 86400
+
+    # Per-worker cache of single posts
+    POST_CACHE_SIZE = server_config.getint("BlogCache", "size", fallback=1024)
+    POST_CACHE_TTL = server_config.getfloat("BlogCache", "ttl", fallback=5)
+    # Seconds between flushes of view counts to RedisData
+    VIEW_FLUSH_INTERVAL = server_config.getfloat("BlogCache", "view_flush_interval", fallback=10)
 
     def __init__(self):
-        self.rd = RedisData()
-        self.rc = RedisCache()
+        self.rd = get_data_store()
+        self.rc = get_cache_store()
+
+        self.post_cache = CoalescingLRU(self.POST_CACHE_SIZE, self.POST_CACHE_TTL)
+        self.views = CounterBuffer(self.VIEW_FLUSH_INTERVAL, self._flush_views)
+        atexit.register(self.flush_views)
+
+    @staticmethod
+    def _validate_blog_fields(title: str, content: str, date: str):
+        """
+        :raise: ForbiddenArgument if invalid
+        """
+        if not isinstance(title, str) or \
+                not BlogLimits.TITLE_MIN_LENGTH <= len(title) <= BlogLimits.TITLE_MAX_LENGTH:
+            raise ForbiddenArgument("invalid title")
+
+        if not isinstance(content, str) or \
+                not BlogLimits.CONTENT_MIN_LENGTH <= len(content) <= BlogLimits.CONTENT_MAX_LENGTH:
+            raise ForbiddenArgument("invalid content")
+
+        if not isinstance(date, (str, int)) or len(str(date)) > BlogLimits.DATE_MAX_LENGTH:
+            raise ForbiddenArgument("invalid date")
+
+    def upload_blog(self, title: str, content: str, date: str) -> int:
+        self._validate_blog_fields(title, content, date)
 
-    def upload_blog(self, title: str, content: str, date: str) -> str:
         # Package form as gotten from api_blueprint.py
         blogpack = {
             "title": title,
@@ -306,25 +574,210 @@ class Blogs(metaclass=Singleton):
 
         # Generates blog ID
         blogid = gen_id()
-        # Stores data inside Redis Data
-        self.rd.hmset(f"blog:{blogid}", blogpack)
+        # Stores data inside Redis Data and links it in the index
+        deferred(self.rd).hmset(keys.blog(blogid), blogpack)
+        deferred(self.rc).zadd(keys.BLOG_INDEX, keys.blog_index_member(blogid), 0)
+        pin_reads()
 
-    def get_blog(self):
-        bpack = {}
+        return blogid
+
+    def upload_blogs(self, posts: list) -> list:
+        """
+        Uploads many blogs at once. Posts with an idempotency key that was already used
+        (in this batch or an earlier one) aren't stored again, the existing id is returned instead.
+        If the post of an earlier upload with the key was never stored, this one is stored under its id.
 
-        # Searches for every key with blog:... and gets it's data
-        for id in self.rd.scan_iter(match="blog:*"):
-            blog = decode(self.rd.hgetall(id))
-            title = blog.get("title")
-            content = blog.get("content")
-            date = blog.get("date")
-            id = id.decode('utf-8')
-
-            bpack[id] = {
-                "title": title,
-                "content": content,
+        :param posts: list of dicts with title, content, date and an optional key (idempotency key)
+        :raise: ForbiddenArgument if any of the posts is invalid (nothing is stored)
+        :return: list of dicts (id, key, duplicate) in the same order as posts
+        """
+        if not isinstance(posts, list) or not 0 < len(posts) <= BlogLimits.BATCH_MAX_POSTS:
+            raise ForbiddenArgument("invalid amount of posts")
+
+        for index, post in enumerate(posts):
+            if not isinstance(post, dict):
+                raise ForbiddenArgument(f"post {index}: invalid post")
+            try:
+                self._validate_blog_fields(post.get("title"), post.get("content"), post.get("date"))
+            except ForbiddenArgument as e:
+                raise ForbiddenArgument(f"post {index}: {e}")
+
+            key = post.get("key")
+            if key is not None and (not isinstance(key, str) or
+                                    not 0 < len(key) <= BlogLimits.IDEMPOTENCY_KEY_MAX_LENGTH):
+                raise ForbiddenArgument(f"post {index}: invalid key")
+
+        results = [{"id": gen_id(), "key": post.get("key"), "duplicate": False} for post in posts]
+
+        # Keys repeated inside the batch point to their first occurrence
+        first_with_key = {}
+        for result in results:
+            key = result["key"]
+            if key is None:
+                continue
+            if key in first_with_key:
+                result["id"] = first_with_key[key]["id"]
+                result["duplicate"] = True
+            else:
+                first_with_key[key] = result
+
+        # Claim keys atomically, a failed claim means the key was used by an earlier upload.
+        # A claim without its post (the earlier upload failed or crashed before storing it, or is being stored
+        # right now) is completed instead: the post is stored under the claimed id, so a retry can neither
+        # lose it nor store it twice. Claims that expire while they are checked are simply claimed again.
+        unclaimed = dict(first_with_key)
+        claims = []
+        for _ in range(3):
+            if not unclaimed:
+                break
+
+            pipe = self.rd.pipeline(transaction=False)
+            for key, result in unclaimed.items():
+                pipe.set(keys.blog_idempotency(key), result["id"], ex=self.IDEMPOTENCY_TTL, nx=True)
+            replies = pipe.execute()
+            claims.extend((keys.blog_idempotency(key), result["id"])
+                          for (key, result), ok in zip(unclaimed.items(), replies) if ok)
+            taken = [key for key, ok in zip(unclaimed, replies) if not ok]
+            if not taken:
+                break
+
+            pipe = self.rd.pipeline(transaction=False)
+            for key in taken:
+                pipe.get(keys.blog_idempotency(key))
+            existing = dict(zip(taken, decode(pipe.execute())))
+
+            found = [key for key in taken if existing[key] is not None]
+            if found:
+                pipe = self.rd.pipeline(transaction=False)
+                for key in found:
+                    pipe.exists(keys.blog(existing[key]))
+
+                for key, stored in zip(found, pipe.execute()):
+                    first_with_key[key]["id"] = existing[key]
+                    first_with_key[key]["duplicate"] = bool(stored)
+
+            unclaimed = {key: first_with_key[key] for key in taken if existing[key] is None}
+
+        # The posts are only stored at the commit, a discarded upload gives its keys back
+        if claims:
+            on_rollback(self.rd, lambda: _delete_claims(self.rd, claims))
+
+        # Repeats inside the batch follow their first occurrence
+        for result in results:
+            key = result["key"]
+            if key is not None and result is not first_with_key[key]:
+                result["id"] = first_with_key[key]["id"]
+
+        # All new posts are stored in one round trip, with the commit
+        rd = deferred(self.rd)
+        index = []
+        for post, result in zip(posts, results):
+            if not result["duplicate"]:
+                rd.hmset(keys.blog(result["id"]), {
+                    "title": post["title"],
+                    "content": post["content"],
+                    "date": post["date"]
+                })
+                index.extend((keys.blog_index_member(result["id"]), 0))
+        if index:
+            deferred(self.rc).zadd(keys.BLOG_INDEX, *index)
+        pin_reads()
+
+        return results
+
+    def get_blog(self, before: int=None, limit: int=None) -> dict:
+        """
+        Returns blogs, newest first. Blog ids are time-sortable, so they are used as a cursor directly:
+        one page is a range of the blogs:by_id index, however many blogs there are.
+
+        :param before: only return blogs older than this blog id
+        :param limit: maximum amount of blogs returned
+        """
+        if before is not None and not is_valid_id(before):
+            raise ForbiddenArgument("invalid cursor")
+
+        newest = "+" if before is None else f"({keys.blog_index_member(before)}"
+        if limit is None:
+            members = self.rc.zrevrangebylex(keys.BLOG_INDEX, newest, "-")
+        else:
+            members = self.rc.zrevrangebylex(keys.BLOG_INDEX, newest, "-", 0, max(limit, 0))
+        ids = [keys.parse_blog_index_member(member) for member in members]
+
+        # ... and gets their data in one round trip
+        pipe = self.rd.pipeline(transaction=False)
+        for blog_id in ids:
+            pipe.hgetall(keys.blog(blog_id))
+
+        bpack = {}
+        for blog_id, blog in zip(ids, pipe.execute()):
+            blog = decode(blog)
+            if not blog:
+                continue
+
+            bpack[f"blog:{blog_id}"] = {
+                "title": blog.get("title"),
+                "content": blog.get("content"),
                 # Since intiger won't work, it's a string
-                "date": str(date)
+                "date": str(blog.get("date"))
             }
 
         return bpack
+
+    def _load_single_blog(self, blog_id: int):
+        blog = decode(self.rd.hgetall(keys.blog(blog_id)))
+        if not blog:
+            return None
+
+        return {
+            "title": blog.get("title"),
+            "content": blog.get("content"),
+            "date": str(blog.get("date")),
+            "views": blog.get("views", 0)
+        }
+
+    def get_single_blog(self, blog_id: int):
+        """
+        Returns one blog (through the per-worker cache) and counts the view
+
+        :return: dict (title, content, date, views) or None if it doesn't exist
+        """
+        if not is_valid_id(blog_id):
+            raise ForbiddenArgument("invalid blog id")
+
+        blog = self.post_cache.get(blog_id, self._load_single_blog)
+        if blog is None:
+            return None
+
+        self._count_view(blog_id)
+
+        # Cached entries are shared, views not yet flushed by this worker are added on a copy
+        blog = dict(blog)
+        blog["views"] += self.views.pending(blog_id)
+        return blog
+
+    def _count_view(self, blog_id: int):
+        try:
+            self.views.add(blog_id)
+        except Exception:
+            # Counting a view must never fail the request, the counts are retried with the next flush
+            log.warning("Flushing blog views failed", exc_info=True)
+
+    def flush_views(self):
+        try:
+            self.views.flush()
+        except Exception:
+            log.warning("Flushing blog views failed", exc_info=True)
+
+    def _flush_views(self, counts: dict):
+        # HINCRBY would create a hash with only views for a blog deleted in the meantime
+        ids = list(counts)
+        pipe = self.rd.pipeline(transaction=False)
+        for blog_id in ids:
+            pipe.exists(keys.blog(blog_id))
+        existing = [blog_id for blog_id, exists in zip(ids, pipe.execute()) if exists]
+
+        if existing:
+            pipe = self.rd.pipeline(transaction=False)
+            for blog_id in existing:
+                pipe.hincrby(keys.blog(blog_id), "views", counts[blog_id])
+            pipe.execute()
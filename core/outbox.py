@@ -0,0 +1,251 @@
+# coding=utf-8
+import logging
+import os
+import socket
+import threading
+import time
+
+from . import keys
+from .cachemanager import CacheGenerator
+from .config import server_config
+from .metrics import Metrics
+from .storage import get_cache_store
+from .util import Singleton, after_fork
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+"""
+Write-behind outbox for RedisCache index maintenance.
+
+Writes that make an index link stale (a changed username or email) don't clean it up themselves,
+they append an event to a Redis Stream in RedisCache (see core/keys.py) once the new link is claimed.
+A consumer group applies the events in batches (see CacheGenerator.release_user_links).
+
+Uniqueness doesn't depend on the outbox: new links are still claimed synchronously with SET NX,
+the outbox only releases old ones, so a stale link keeps its value taken a little longer, never shorter.
+
+Events that fail are retried (claimed again after RETRY_IDLE seconds) up to MAX_DELIVERIES times,
+then moved to the dead letter stream. Events of a crashed consumer are claimed by the others the same way.
+
+Every worker runs a consumer thread (started by the first publish), or run a dedicated one with
+python -m core.outbox and set [Outbox] consumer_thread=false.
+"""
+
+ENABLED = server_config.getboolean("Outbox", "enabled", fallback=True)
+CONSUMER_THREAD = server_config.getboolean("Outbox", "consumer_thread", fallback=True)
+BATCH_SIZE = server_config.getint("Outbox", "batch_size", fallback=100)
+# Milliseconds a read waits for new events
+BLOCK_MS = server_config.getint("Outbox", "block_ms", fallback=1000)
+# Seconds before a pending event is retried (or taken over from another consumer)
+RETRY_IDLE = server_config.getfloat("Outbox", "retry_idle", fallback=10)
+MAX_DELIVERIES = server_config.getint("Outbox", "max_deliveries", fallback=5)
+# Seconds after which a release of a link that is still the user's current value is dropped
+# (the update that published it failed, or hasn't been written yet - then it's retried until this passes)
+GRACE = server_config.getfloat("Outbox", "grace", fallback=30)
+# Approximate maximum length of the stream
+MAX_LENGTH = server_config.getint("Outbox", "max_length", fallback=100000)
+
+GROUP = "cache"
+
+
+def _pairs(fields: list) -> dict:
+    return {fields[i].decode(): fields[i + 1].decode() for i in range(0, len(fields), 2)}
+
+
+class Outbox(metaclass=Singleton):
+    """
+    Publishes events to the outbox stream
+    """
+    def __init__(self):
+        self.rc = get_cache_store()
+        self.metrics = Metrics()
+        self._consumer = None
+        self._consumer_lock = threading.Lock()
+
+        # Threads don't survive a fork
+        after_fork(self._after_fork)
+
+    def _after_fork(self):
+        self._consumer = None
+        self._consumer_lock = threading.Lock()
+
+    def release_link(self, user_id: int, field: str, previous: str, pipe=None):
+        """
+        Publishes that user's index link for field=previous is no longer needed
+
+        :param pipe: RedisCache pipeline (or deferred(RedisCache), see core/unit_of_work.py) to add the event to,
+            it's executed by the caller
+        """
+        event = ("type", "release", "user_id", user_id, "field", field, "value", previous,
+                 "at", int(time.time()))
+
+        target = pipe if pipe is not None else self.rc
+        target.execute_command("XADD", keys.OUTBOX, "MAXLEN", "~", MAX_LENGTH, "*", *event)
+
+        self.metrics.inc("outbox.published")
+        if CONSUMER_THREAD:
+            self.ensure_consumer()
+
+    def ensure_consumer(self):
+        """
+        Starts the consumer thread of this process if it isn't running
+        """
+        if self._consumer is not None and self._consumer.is_alive():
+            return
+
+        with self._consumer_lock:
+            if self._consumer is not None and self._consumer.is_alive():
+                return
+
+            consumer = OutboxConsumer()
+            self._consumer = threading.Thread(target=consumer.run, name="outbox-consumer", daemon=True)
+            self._consumer.start()
+
+
+class OutboxConsumer:
+    """
+    Member of the consumer group, applies events in batches
+    """
+    def __init__(self, name: str=None):
+        self.rc = get_cache_store()
+        self.cache = CacheGenerator()
+        self.metrics = Metrics()
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+
+        self._stop = threading.Event()
+        self._next_claim = 0
+
+    def stop(self):
+        self._stop.set()
+
+    def _create_group(self):
+        try:
+            self.rc.execute_command("XGROUP", "CREATE", keys.OUTBOX, GROUP, "0", "MKSTREAM")
+        except Exception as e:
+            # The group already exists
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def run(self):
+        log.info(f"Outbox consumer {self.name} started")
+
+        while not self._stop.is_set():
+            try:
+                self._create_group()
+                while not self._stop.is_set():
+                    self.step()
+            except Exception:
+                # RedisCache is unavailable or was wiped (the group is gone), start over
+                log.exception("Outbox consumer failed, restarting in 5 seconds")
+                self._stop.wait(5)
+
+    def step(self) -> int:
+        """
+        Applies one batch, retried events first
+
+        :return: amount of applied events
+        """
+        applied = 0
+        if time.time() >= self._next_claim:
+            self._next_claim = time.time() + RETRY_IDLE / 2
+            applied += self._apply(self._claim_stale())
+
+        started = time.time()
+        reply = self.rc.execute_command("XREADGROUP", "GROUP", GROUP, self.name, "COUNT", BATCH_SIZE,
+                                        "BLOCK", BLOCK_MS, "STREAMS", keys.OUTBOX, ">")
+        entries = reply[0][1] if reply else []
+        applied += self._apply(entries)
+
+        # Some engines don't block (see MemoryStorage), don't spin
+        if not entries:
+            self._stop.wait(max(BLOCK_MS / 1000 - (time.time() - started), 0))
+
+        return applied
+
+    def _claim_stale(self) -> list:
+        """
+        Takes over events that weren't acknowledged for RETRY_IDLE seconds (failed or their consumer died)
+        """
+        pending = self.rc.execute_command("XPENDING", keys.OUTBOX, GROUP, "-", "+", BATCH_SIZE)
+        min_idle = int(RETRY_IDLE * 1000)
+
+        stale = [(entry_id, deliveries) for entry_id, _, idle, deliveries in pending if idle >= min_idle]
+        if not stale:
+            return []
+
+        dead = [entry_id for entry_id, deliveries in stale if deliveries >= MAX_DELIVERIES]
+        retry = [entry_id for entry_id, deliveries in stale if deliveries < MAX_DELIVERIES]
+
+        claimed = []
+        if retry:
+            claimed = self.rc.execute_command("XCLAIM", keys.OUTBOX, GROUP, self.name, min_idle, *retry)
+            self.metrics.inc("outbox.retried", len(claimed))
+        if dead:
+            self._dead_letter(dead, min_idle)
+
+        return claimed
+
+    def _dead_letter(self, entry_ids: list, min_idle: int):
+        entries = self.rc.execute_command("XCLAIM", keys.OUTBOX, GROUP, self.name, min_idle, *entry_ids)
+
+        pipe = self.rc.pipeline(transaction=False)
+        for entry_id, fields in filter(None, entries):
+            if fields:
+                log.error(f"Outbox event {entry_id.decode()} failed {MAX_DELIVERIES} times: {_pairs(fields)}")
+                pipe.execute_command("XADD", keys.OUTBOX_DEAD, "MAXLEN", "~", MAX_LENGTH, "*", *fields)
+            pipe.execute_command("XACK", keys.OUTBOX, GROUP, entry_id)
+        pipe.execute()
+
+        self.metrics.inc("outbox.dead", len(entries))
+
+    def _apply(self, entries: list) -> int:
+        if not entries:
+            return 0
+
+        releases = []
+        release_ids = []
+        done = []
+        # Older Redis versions return nil for claimed entries that were trimmed, they can't be acknowledged
+        for entry_id, fields in filter(None, entries):
+            # Trimmed from the stream, nothing left to do
+            if not fields:
+                done.append(entry_id)
+                continue
+
+            event = _pairs(fields)
+            if event.get("type") == "release":
+                releases.append((int(event["user_id"]), event["field"], event["value"], int(event["at"])))
+                release_ids.append(entry_id)
+            else:
+                log.warning(f"Unknown outbox event {entry_id.decode()}: {event}")
+                done.append(entry_id)
+
+        try:
+            if releases:
+                finished = self.cache.release_user_links(releases, GRACE)
+                done.extend(entry_id for entry_id, ok in zip(release_ids, finished) if ok)
+        except Exception:
+            log.exception("Applying outbox events failed, they'll be retried")
+
+        if done:
+            self.rc.execute_command("XACK", keys.OUTBOX, GROUP, *done)
+            self.metrics.inc("outbox.applied", len(done))
+
+        return len(done)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    consumer = OutboxConsumer()
+
+    try:
+        consumer.run()
+    except KeyboardInterrupt:
+        consumer.stop()
+
+
+if __name__ == "__main__":
+    main()
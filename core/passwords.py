@@ -0,0 +1,103 @@
+# coding=utf-8
+import argparse
+import statistics
+import time
+from passlib.hash import pbkdf2_sha512
+
+from .config import SALT, ROUNDS
+from .live_config import LiveConfig, MIN_ROUNDS, MAX_ROUNDS
+
+
+"""
+Password hashing.
+
+Hashes are stored in passlib's format, which contains all parameters needed to verify them:
+    $pbkdf2-sha512$<rounds>$<salt>$<checksum>
+
+Every hash gets its own random salt. When the rounds change (or a hash still uses the old global SALT),
+the password is rehashed with the current parameters the next time it is verified, so cost can be adjusted
+without forcing password resets. Rounds are read from the live config (see core/live_config.py),
+so they can be changed without a restart as well.
+
+Calibration (recommends ROUNDS for this host):
+    python -m core.passwords --target-ms 250
+"""
+
+
+def hash_password(password: str) -> str:
+    """
+    Hashes the password with pbkdf2_sha512, the current rounds and a random salt
+    """
+    return pbkdf2_sha512.using(rounds=LiveConfig().get("rounds")).hash(password)
+
+
+def needs_rehash(hashed: str) -> bool:
+    """
+    True if the hash wasn't made with the current parameters
+    """
+    parsed = pbkdf2_sha512.from_string(hashed)
+    # Hashes from before per-user salts all share the configured global salt
+    return parsed.rounds != LiveConfig().get("rounds") or (bool(SALT) and parsed.salt == SALT)
+
+
+def verify_password(password: str, hashed: str) -> tuple:
+    """
+    Verifies the password against a stored hash
+
+    :return: (is the password correct, new hash to store or None)
+    """
+    if not pbkdf2_sha512.verify(password, hashed):
+        return False, None
+
+    if needs_rehash(hashed):
+        return True, hash_password(password)
+
+    return True, None
+
+
+def measure_rounds(rounds: int, samples: int=5) -> float:
+    """
+    Median time (in seconds) to hash a password with the given amount of rounds on this host
+    """
+    hasher = pbkdf2_sha512.using(rounds=rounds)
+
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        hasher.hash("calibration password")
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
+
+
+def calibrate(target_ms: float, samples: int=5) -> int:
+    """
+    Recommends the amount of rounds for which hashing takes about `target_ms` on this host,
+    within the bounds the live config accepts (MIN_ROUNDS, MAX_ROUNDS)
+    """
+    # PBKDF2 time is linear in rounds: measure once, scale, then correct with a second measurement
+    rounds = 10000
+    for _ in range(2):
+        elapsed = measure_rounds(rounds, samples)
+        rounds = min(max(int(rounds * (target_ms / 1000) / elapsed), MIN_ROUNDS), MAX_ROUNDS)
+
+    # Round to a nice number
+    return rounds - rounds % 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recommend PBKDF2 rounds for a target hashing latency")
+    parser.add_argument("--target-ms", type=float, default=250, help="target time to hash one password")
+    parser.add_argument("--samples", type=int, default=5, help="measurements per step")
+    args = parser.parse_args(argv)
+
+    rounds = calibrate(args.target_ms, args.samples)
+    current = measure_rounds(ROUNDS, args.samples) * 1000
+
+    print(f"Current: rounds={ROUNDS} takes {round(current, 1)} ms")
+    print(f"Recommended for {args.target_ms} ms: rounds={rounds}")
+    print("Set it in data/auth.ini, [Crypto] rounds - hashes are upgraded on the next login")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+# coding=utf-8
+import atexit
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from .config import server_config, DATA_DIR
+from .util import Singleton, after_fork
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+"""
+Sampling request profiler.
+
+A profiled request registers its thread, a sampler thread (one per worker, only awake while something
+is profiled) takes the thread's stack from sys._current_frames() every INTERVAL_MS. Unprofiled requests
+cost a random number and a header lookup (see eledina/flask_util.py, install_profiler).
+
+Stacks are written in the collapsed format (one "frame;frame;frame <count>" line per stack), which
+flamegraph.pl, speedscope and most other flame graph tools read directly:
+    <DIRECTORY>/requests/<time>-<pid>-<endpoint>.folded   one file per profiled request (the newest KEEP are kept)
+    <DIRECTORY>/aggregate-<pid>.folded                     all profiled requests of the worker, rooted at the endpoint
+
+Requests are profiled at random (SAMPLE_RATE) or when an admin asks for it with the X-Profile header,
+at most MAX_PER_MINUTE per worker either way.
+"""
+
+ENABLED = server_config.getboolean("Profiler", "enabled", fallback=False)
+# Fraction of requests profiled at random
+SAMPLE_RATE = server_config.getfloat("Profiler", "sample_rate", fallback=0.0)
+INTERVAL_MS = server_config.getfloat("Profiler", "interval_ms", fallback=5)
+MAX_PER_MINUTE = server_config.getint("Profiler", "max_per_minute", fallback=60)
+DIRECTORY = server_config.get("Profiler", "directory", fallback=os.path.join(DATA_DIR, "profiles"))
+# Seconds between writes of the aggregated stacks
+FLUSH_INTERVAL = server_config.getfloat("Profiler", "flush_interval", fallback=10)
+# Per-request files kept
+KEEP = server_config.getint("Profiler", "keep", fallback=1000)
+
+# Deeper stacks (runaway recursion) are cut off
+_MAX_DEPTH = 128
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame) -> str:
+    """
+    Stack of a frame in the collapsed format, outermost frame first
+    """
+    names = []
+    while frame is not None and len(names) < _MAX_DEPTH:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+class RequestProfile:
+    __slots__ = ("name", "started", "samples", "file_name")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.time()
+        # collapsed stack: count
+        self.samples = {}
+
+        timestamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime(self.started))
+        millis = int(self.started * 1000) % 1000
+        self.file_name = f"{timestamp}.{millis:03d}-{os.getpid()}-{name}.folded"
+
+    def add(self, stack: str):
+        self.samples[stack] = self.samples.get(stack, 0) + 1
+
+
+class Profiler(metaclass=Singleton):
+    """
+    Samples the stacks of profiled requests of this worker
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # thread id: RequestProfile
+        self._active = {}
+        self._wakeup = threading.Event()
+        self._sampler = None
+
+        self._aggregate = {}
+        self._next_flush = time.time() + FLUSH_INTERVAL
+        self._written = 0
+
+        self._window_start = 0
+        self._window_count = 0
+
+        after_fork(self._after_fork)
+        atexit.register(self.flush)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._active = {}
+        self._wakeup = threading.Event()
+        self._sampler = None
+        # The parent's stacks belong to the parent
+        self._aggregate = {}
+
+    def should_sample(self, requested: bool=False) -> bool:
+        """
+        Decides whether to profile a request, within MAX_PER_MINUTE
+
+        :param requested: an admin asked for the profile
+        """
+        if not requested and (SAMPLE_RATE <= 0 or random.random() >= SAMPLE_RATE):
+            return False
+
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= 60:
+                self._window_start = now
+                self._window_count = 0
+
+            if self._window_count >= MAX_PER_MINUTE:
+                return False
+
+            self._window_count += 1
+            return True
+
+    def start(self, name: str) -> RequestProfile:
+        """
+        Starts profiling the current thread
+        """
+        profile = RequestProfile(name)
+        with self._lock:
+            self._active[threading.get_ident()] = profile
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+                self._sampler.start()
+
+        self._wakeup.set()
+        return profile
+
+    def stop(self):
+        """
+        Stops profiling the current thread and writes the profile
+        """
+        with self._lock:
+            profile = self._active.pop(threading.get_ident(), None)
+        if profile is None:
+            return
+
+        try:
+            self._write_request(profile)
+        except OSError:
+            log.exception("Writing a request profile failed")
+
+        with self._lock:
+            for stack, count in profile.samples.items():
+                stack = f"{profile.name};{stack}"
+                self._aggregate[stack] = self._aggregate.get(stack, 0) + count
+
+        if time.time() >= self._next_flush:
+            self.flush()
+
+    def _sample(self):
+        interval = INTERVAL_MS / 1000
+
+        while True:
+            if not self._active:
+                self._wakeup.clear()
+                # Checked again, a request may have started in the meantime
+                if not self._active:
+                    self._wakeup.wait()
+
+            frames = sys._current_frames()
+            with self._lock:
+                active = list(self._active.items())
+
+            for thread_id, profile in active:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    profile.add(collapse(frame))
+
+            # Frames reference their locals, don't keep them alive until the next sample
+            del frames
+            time.sleep(interval)
+
+    @staticmethod
+    def _write(path: str, samples: dict):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(samples.items()):
+                f.write(f"{stack} {count}\n")
+        os.replace(tmp_path, path)
+
+    def _write_request(self, profile: RequestProfile):
+        directory = os.path.join(DIRECTORY, "requests")
+        os.makedirs(directory, exist_ok=True)
+        self._write(os.path.join(directory, profile.file_name), profile.samples)
+
+        self._written += 1
+        if self._written % 100 == 0:
+            self._prune(directory)
+
+    @staticmethod
+    def _prune(directory: str):
+        # Names start with the time, so the oldest sort first
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".folded"))
+        for name in names[:-KEEP]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def flush(self):
+        """
+        Writes the aggregated stacks of this worker
+        """
+        with self._lock:
+            self._next_flush = time.time() + FLUSH_INTERVAL
+            if not self._aggregate:
+                return
+            aggregate = dict(self._aggregate)
+
+        try:
+            os.makedirs(DIRECTORY, exist_ok=True)
+            self._write(os.path.join(DIRECTORY, f"aggregate-{os.getpid()}.folded"), aggregate)
+        except OSError:
+            log.exception("Writing aggregated profiles failed")
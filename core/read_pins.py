@@ -0,0 +1,108 @@
+# coding=utf-8
+import logging
+import threading
+import time
+
+from . import keys
+from .config import server_config
+from .replicas import READ_YOUR_WRITES, pin_session, primary_reads
+from .storage import get_data_store
+from .unit_of_work import deferred
+from .util import Singleton, after_fork, decode
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+"""
+Read pins of users, for API clients that send their token but no pin cookie (see core/replicas.py).
+
+A user's write adds them to rw:{pins} in RedisData (Sorted set, <user_id>: unix time until which their reads
+go to the primary). Every worker mirrors the current entries and refreshes its copy at most every
+SYNC_INTERVAL seconds, in the request that finds it due - one round trip per interval, not one per request.
+Writes handled by a worker pin the user in its copy right away; a write handled by another worker
+is seen within SYNC_INTERVAL, keep it well below READ_YOUR_WRITES.
+
+Only used with replicas, without them every read is consistent anyway.
+"""
+
+SYNC_INTERVAL = server_config.getfloat("Replicas", "pin_sync_interval", fallback=0.25)
+
+
+class ReadPins(metaclass=Singleton):
+    """
+    Pins users' reads after their writes, across workers
+    """
+    def __init__(self):
+        self.rd = get_data_store()
+
+        self._lock = threading.Lock()
+        # user_id: pinned until
+        self._pinned_until = {}
+        self._next_sync = 0
+
+        after_fork(self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._next_sync = 0
+
+    def pin(self, user_id: int):
+        """
+        Pins the user's reads for READ_YOUR_WRITES seconds, stored with the current unit of work
+        """
+        if not self.rd.replicas:
+            return
+
+        until = time.time() + READ_YOUR_WRITES
+        deferred(self.rd).zadd(keys.READ_PINS, user_id, until)
+        self._pinned_until[int(user_id)] = until
+
+    def apply(self, user_id):
+        """
+        Pins the reads of the current request to the primary if the user wrote something within READ_YOUR_WRITES
+        """
+        if not self.rd.replicas:
+            return
+
+        self._sync_if_due()
+        until = self._pinned_until.get(int(user_id))
+        if until is not None and until > time.time():
+            pin_session(until)
+
+    def _sync_if_due(self):
+        if time.time() < self._next_sync:
+            return
+
+        with self._lock:
+            # Another thread may have synced while this one was waiting
+            if time.time() < self._next_sync:
+                return
+            self._next_sync = time.time() + SYNC_INTERVAL
+
+            try:
+                self.sync()
+            except Exception:
+                # Reads go to replicas until the next sync works, like for clients without any pin
+                log.exception("Syncing read pins failed")
+
+    def sync(self):
+        """
+        Replaces the worker's copy of pins with the one in RedisData, drops ended pins there
+        """
+        now = time.time()
+
+        # Replicas may not have the newest pins
+        with primary_reads():
+            pipe = self.rd.pipeline(transaction=False)
+            pipe.zremrangebyscore(keys.READ_PINS, "-inf", now)
+            pipe.zrangebyscore(keys.READ_PINS, now, "+inf", withscores=True)
+            _, pins = pipe.execute()
+
+        pinned_until = {int(decode(member)): score for member, score in pins}
+        # Pins of this worker that weren't committed when the pins were read
+        for user_id, until in list(self._pinned_until.items()):
+            if until > now and until > pinned_until.get(user_id, 0):
+                pinned_until[user_id] = until
+        self._pinned_until = pinned_until
@@ -1,10 +1,28 @@
 # coding=utf-8
 import redis
 import os
+import time
 import logging
+import itertools
+from redis.client import Pipeline
+
+try:
+    from rediscluster import RedisCluster, StrictClusterPipeline
+    from rediscluster.exceptions import RedisClusterException
+except ImportError:
+    RedisCluster = StrictClusterPipeline = None
+    RedisClusterException = redis.ConnectionError
 
 from .config import redis_config
-from .util import Singleton
+from .circuit_breaker import CircuitBreaker
+from .exceptions import StorageUnavailable
+from .util import Singleton, after_fork
+from .tracing import TRACING_ENABLED, record_round_trip
+from .replicas import is_read_command, reads_pinned
+
+
+# Errors meaning the server can't be reached (see core/circuit_breaker.py)
+CONNECTION_ERRORS = (redis.ConnectionError, redis.TimeoutError, RedisClusterException)
 
 
 def get_redis_config(section):
@@ -16,6 +34,50 @@ def get_redis_config(section):
     return host, port, password, db
 
 
+def is_cluster(section) -> bool:
+    return redis_config.getboolean(section, "cluster", fallback=False)
+
+
+def get_cluster_config(section):
+    """
+    startup_nodes is a comma separated list of host:port, defaults to host and port of the section
+    """
+    host, port, password, _ = get_redis_config(section)
+    nodes = redis_config.get(section, "startup_nodes", fallback=f"{host}:{port}")
+
+    startup_nodes = []
+    for node in nodes.split(","):
+        node_host, _, node_port = node.strip().rpartition(":")
+        startup_nodes.append({"host": node_host, "port": int(node_port)})
+
+    return startup_nodes, password
+
+
+def get_replica_config(section):
+    """
+    replicas is a comma separated list of host:port, replicas use the password and db of the primary
+    """
+    replicas = redis_config.get(section, "replicas", fallback="")
+
+    nodes = []
+    for node in replicas.split(","):
+        if node.strip():
+            host, _, port = node.strip().rpartition(":")
+            nodes.append((host, int(port)))
+
+    return nodes
+
+
+def get_timeouts(section):
+    """
+    Seconds to wait for a connection and for a reply - a server that hangs must not hang the workers
+    """
+    connect_timeout = redis_config.getfloat(section, "connect_timeout", fallback=2)
+    socket_timeout = redis_config.getfloat(section, "socket_timeout", fallback=5)
+
+    return connect_timeout, socket_timeout
+
+
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
@@ -26,48 +88,311 @@ Database layout:
     Split into two parts, RedisData with pure and unlinked data and
                           RedisCache containing 'links' between data that can be generated on startup
 
+    Each of them can be a single server or a Redis Cluster (cluster=true in redis.ini, needs redis-py-cluster).
+    Key names are in core/keys.py.
 
 """
 
 
-class RedisData(redis.Redis, metaclass=Singleton):
+class TracedPipeline(Pipeline):
+    """
+    Pipeline that records its whole command stack as one round trip in the current trace
+    """
+    def execute(self, raise_on_error=True):
+        commands = [args for args, _ in self.command_stack]
+        started = time.perf_counter()
+        reply = super().execute(raise_on_error)
+        record_round_trip(commands, started, reply)
+
+        return reply
+
+
+class TracedRedis(redis.Redis):
+    """
+    Records every executed command in the trace of the current request (see core/tracing.py)
+    """
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        reply = super().execute_command(*args, **options)
+        record_round_trip([args], started, reply)
+
+        return reply
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TracedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+if RedisCluster is not None:
+    class ClusterClient(RedisCluster):
+        """
+        Redis Cluster client. Cluster pipelines can't be transactions,
+        pipeline() accepts the argument (like redis.Redis) and ignores it.
+
+        Everything that has to be atomic or pipelined together uses hash tags (see core/keys.py).
+        """
+        def pipeline(self, transaction=None, shard_hint=None):
+            return super().pipeline()
+
+    class TracedClusterPipeline(StrictClusterPipeline):
+        """
+        Cluster version of TracedPipeline
+        """
+        def execute(self, raise_on_error=True):
+            commands = [command.args for command in self.command_stack]
+            started = time.perf_counter()
+            reply = super().execute(raise_on_error)
+            record_round_trip(commands, started, reply)
+
+            return reply
+
+    class TracedClusterClient(ClusterClient):
+        """
+        Cluster version of TracedRedis
+        """
+        def execute_command(self, *args, **options):
+            started = time.perf_counter()
+            reply = super().execute_command(*args, **options)
+            record_round_trip([args], started, reply)
+
+            return reply
+
+        def pipeline(self, transaction=None, shard_hint=None):
+            pipe = super().pipeline()
+            # The pipeline is built by rediscluster, only its execute() is replaced
+            pipe.__class__ = TracedClusterPipeline
+            return pipe
+
+
+def _client_class(section):
+    """
+    Picks the base class of RedisData/RedisCache: a single server or a Redis Cluster (cluster=true)
+    """
+    if not is_cluster(section):
+        return TracedRedis if TRACING_ENABLED else redis.Redis
+
+    if RedisCluster is None:
+        log.critical(f"{section} is configured as a cluster, but redis-py-cluster is not installed, exiting!")
+        os._exit(4)
+
+    return TracedClusterClient if TRACING_ENABLED else ClusterClient
+
+
+class _GuardedPipelineMixin:
+    """
+    Pipelines run through the circuit breaker of their client
+    """
+    breaker = None
+
+    def execute(self, raise_on_error=True):
+        return self.breaker.call(super().execute, raise_on_error)
+
+
+_guarded_pipeline_classes = {}
+
+
+class CircuitBreaking:
+    """
+    Runs every command and pipeline through self.breaker (see core/circuit_breaker.py):
+    while the server is unreachable they raise StorageUnavailable right away.
+    """
+    breaker = None
+
+    def execute_command(self, *args, **options):
+        return self.breaker.call(super().execute_command, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super().pipeline(transaction, shard_hint)
+
+        # Pipelines come in several classes (traced, routed, cluster), each gets a guarded subclass
+        pipe_class = type(pipe)
+        guarded = _guarded_pipeline_classes.get(pipe_class)
+        if guarded is None:
+            guarded = type(f"Guarded{pipe_class.__name__}", (_GuardedPipelineMixin, pipe_class), {})
+            _guarded_pipeline_classes[pipe_class] = guarded
+
+        pipe.__class__ = guarded
+        pipe.breaker = self.breaker
+        return pipe
+
+
+class GuardedRedis(CircuitBreaking, redis.Redis):
+    pass
+
+
+class GuardedTracedRedis(CircuitBreaking, TracedRedis):
+    pass
+
+
+class _ReplicaPipelineMixin:
+    """
+    Pipelines made only of read commands are executed on a replica
+    """
+    router = None
+
+    def execute(self, raise_on_error=True):
+        replica = None
+        if all(is_read_command(args[0]) for args, _ in self.command_stack):
+            replica = self.router.pick_replica()
+
+        if replica is None:
+            return self.router.breaker.call(super().execute, raise_on_error)
+
+        stack = list(self.command_stack)
+        primary_pool, self.connection_pool = self.connection_pool, replica.connection_pool
+        try:
+            return replica.breaker.call(super().execute, raise_on_error)
+        except StorageUnavailable:
+            log.warning("Replica unreachable, pipeline sent to the primary")
+            self.connection_pool = primary_pool
+            self.command_stack = stack
+            # Only the primary's breaker guards the primary, an open one doesn't stop replica reads
+            return self.router.breaker.call(super().execute, raise_on_error)
+        finally:
+            self.connection_pool = primary_pool
+
+
+class RoutedPipeline(_ReplicaPipelineMixin, Pipeline):
+    pass
+
+
+class TracedRoutedPipeline(_ReplicaPipelineMixin, TracedPipeline):
+    pass
+
+
+class ReplicaRouting:
+    """
+    Sends read-only commands to replicas (round robin) and everything else to the primary.
+
+    Reads stay on the primary while the current session is pinned after a write (see core/replicas.py)
+    and when a replica can't be reached. Every replica has its own circuit breaker, replicas that are down
+    are skipped until their backoff passes.
+    """
+    replicas = ()
+
+    def connect_replicas(self, section):
+        nodes = get_replica_config(section)
+        if not nodes:
+            return
+        if is_cluster(section):
+            log.warning(f"{section}: replicas are ignored in cluster mode")
+            return
+
+        _, _, password, db = get_redis_config(section)
+        connect_timeout, socket_timeout = get_timeouts(section)
+        client_class = GuardedTracedRedis if TRACING_ENABLED else GuardedRedis
+
+        self.replicas = []
+        for host, port in nodes:
+            replica = client_class(host=host, port=port, password=password, db=db,
+                                   socket_connect_timeout=connect_timeout, socket_timeout=socket_timeout)
+            replica.breaker = CircuitBreaker(f"{section}@{host}:{port}", CONNECTION_ERRORS)
+            self.replicas.append(replica)
+        self._replica_counter = itertools.count()
+
+        for replica in self.replicas:
+            after_fork(replica.connection_pool.reset)
+        log.info(f"{section}: routing reads to {len(self.replicas)} replica(s)")
+
+    def pick_replica(self):
+        """
+        :return: the replica for the next read or None if it has to go to the primary
+        """
+        if not self.replicas or reads_pinned():
+            return None
+
+        # One round over the replicas, skipping those that are down
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._replica_counter) % len(self.replicas)]
+            if replica.breaker.retry_in() == 0:
+                return replica
+
+        return None
+
+    def execute_command(self, *args, **options):
+        if is_read_command(args[0]):
+            replica = self.pick_replica()
+            if replica is not None:
+                try:
+                    return replica.execute_command(*args, **options)
+                except StorageUnavailable:
+                    log.warning(f"Replica unreachable, {args[0]} sent to the primary")
+
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        if not self.replicas:
+            return super().pipeline(transaction, shard_hint)
+
+        pipeline_class = TracedRoutedPipeline if TRACING_ENABLED else RoutedPipeline
+        pipe = pipeline_class(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.router = self
+        return pipe
+
+    def scan_iter(self, match=None, count=None):
+        # Cursors are only valid on the server that returned them, so one replica does the whole scan
+        replica = self.pick_replica()
+        if replica is None:
+            return super().scan_iter(match=match, count=count)
+
+        return replica.scan_iter(match=match, count=count)
+
+
+def get_connection_kwargs(section) -> dict:
+    """
+    Arguments for the constructor of the class picked by _client_class
+    """
+    connect_timeout, socket_timeout = get_timeouts(section)
+    if is_cluster(section):
+        startup_nodes, password = get_cluster_config(section)
+        # There are no databases in a cluster
+        return dict(startup_nodes=startup_nodes, password=password,
+                    socket_connect_timeout=connect_timeout, socket_timeout=socket_timeout)
+
+    host, port, password, db = get_redis_config(section)
+    return dict(host=host, port=port, password=password, db=db,
+                socket_connect_timeout=connect_timeout, socket_timeout=socket_timeout)
+
+
+def _check_connection(client, section: str):
+    """
+    Creates the client's breaker and checks the connection.
+    An unreachable server doesn't stop the app: it starts degraded and reconnects (see core/circuit_breaker.py).
+    """
+    client.breaker = CircuitBreaker(section, CONNECTION_ERRORS)
+    try:
+        client.echo("Echo dis")
+    except StorageUnavailable:
+        log.error(f"{section} connection could not be established, starting degraded and retrying")
+    else:
+        log.info(f"{section} connection successful")
+
+    # Connections must not be shared with the parent process (pool.reset() doesn't close the parent's sockets)
+    after_fork(client.connection_pool.reset)
+
+
+# Reads are routed before the breaker of the primary is checked: replicas have their own breakers and keep
+# serving reads while the primary is down
+class RedisData(ReplicaRouting, CircuitBreaking, _client_class("RedisData"), metaclass=Singleton):
     def __init__(self):
         log.debug("Creating instance of RedisData")
-        d_host, d_port, d_pass, d_db = get_redis_config("RedisData")
-
-        super().__init__(host=d_host, port=d_port,
-                         password=d_pass, db=d_db,
-                         socket_connect_timeout=15)
 
         try:
-            self.echo("Echo dis")
-        except redis.ConnectionError:
-            log.critical("RedisData connection could not be established, exiting!")
-            # os._exit instead of builtin exit(), because flask prevents us from shutting down
-            os._exit(4)
-        else:
-            log.info("RedisData connection successful")
+            # A cluster client fetches slots from the startup nodes right away, it can't start without them
+            super().__init__(**get_connection_kwargs("RedisData"))
+        except RedisClusterException as e:
+            raise StorageUnavailable("RedisData", 0) from e
+
+        _check_connection(self, "RedisData")
+        self.connect_replicas("RedisData")
 
 
-class RedisCache(redis.Redis, metaclass=Singleton):
+class RedisCache(CircuitBreaking, _client_class("RedisCache"), metaclass=Singleton):
     def __init__(self):
         log.debug("Creating instance of RedisCache")
-        d_host, d_port, d_pass, d_db = get_redis_config("RedisCache")
-
-        super().__init__(host=d_host, port=d_port,
-                         password=d_pass, db=d_db,
-                         socket_connect_timeout=15)
 
         try:
-            self.echo("Echo dis")
-        except redis.ConnectionError:
-            log.critical("RedisCache connection could not be established, exiting!")
-            # see RedisData.__init__ for reasoning of os._exit
-            os._exit(4)
-        else:
-            log.info("RedisCache connection successful")
-
-
-# Make first instance to check connection
-RedisData()
-RedisCache()
+            super().__init__(**get_connection_kwargs("RedisCache"))
+        except RedisClusterException as e:
+            raise StorageUnavailable("RedisCache", 0) from e
+
+        _check_connection(self, "RedisCache")
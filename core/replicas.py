@@ -0,0 +1,95 @@
+# coding=utf-8
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from .config import server_config
+
+
+"""
+Read-your-writes for RedisData replicas.
+
+RedisData sends read-only commands to replicas (see core/redis.py). Replicas lag behind the primary,
+so right after a session writes something its reads are pinned to the primary for READ_YOUR_WRITES seconds.
+The pin lives in the current thread (the rest of the request) and is carried to the session's next requests
+by eledina.flask_util.install_read_your_writes (as a cookie), so it works no matter which worker gets them.
+Writes of a user also pin that user (see core/read_pins.py), for API clients that send their token but no cookies.
+"""
+
+# Seconds for which a session reads from the primary after writing, should be longer than the replication lag
+READ_YOUR_WRITES = server_config.getfloat("Replicas", "read_your_writes", fallback=5)
+
+# Commands that never modify data and can be answered by a replica
+# SCAN cursors are only valid on the server that returned them, scan_iter() picks one replica for the whole scan
+READ_COMMANDS = frozenset((
+    "GET", "MGET", "STRLEN", "EXISTS", "TTL", "PTTL", "TYPE",
+    "HGET", "HMGET", "HGETALL", "HEXISTS", "HKEYS", "HVALS", "HLEN",
+    "SMEMBERS", "SISMEMBER", "SCARD",
+    "ZSCORE", "ZCARD", "ZRANGE", "ZREVRANGE", "ZRANGEBYSCORE", "ZREVRANGEBYSCORE",
+    "LRANGE", "LLEN", "LINDEX",
+))
+
+_local = threading.local()
+
+
+def is_read_command(name) -> bool:
+    if isinstance(name, bytes):
+        name = name.decode()
+    return name.upper() in READ_COMMANDS
+
+
+def start_session(pinned_until: float=0):
+    """
+    Called at the start of a request with the pin carried over from the session's previous requests
+    """
+    # The pin comes from the client, it never lasts longer than a write of this moment would pin
+    if not math.isfinite(pinned_until):
+        pinned_until = 0
+    _local.pinned_until = min(pinned_until, time.time() + READ_YOUR_WRITES)
+    _local.wrote = False
+
+
+def end_session() -> float:
+    """
+    :return: unix time until which the session has to stay pinned (0 if it didn't write in this request)
+    """
+    wrote = getattr(_local, "wrote", False)
+    pinned_until = getattr(_local, "pinned_until", 0)
+    _local.pinned_until = 0
+    _local.wrote = False
+
+    return pinned_until if wrote else 0
+
+
+def pin_reads():
+    """
+    Marks that the current session wrote data, its reads go to the primary for the next READ_YOUR_WRITES seconds
+    """
+    _local.pinned_until = time.time() + READ_YOUR_WRITES
+    _local.wrote = True
+
+
+def pin_session(pinned_until: float):
+    """
+    Pins the reads of the current session until pinned_until (a pin found for its user), without marking a write
+    """
+    pinned_until = min(pinned_until, time.time() + READ_YOUR_WRITES)
+    _local.pinned_until = max(getattr(_local, "pinned_until", 0), pinned_until)
+
+
+def reads_pinned() -> bool:
+    return getattr(_local, "pinned_until", 0) > time.time()
+
+
+@contextmanager
+def primary_reads():
+    """
+    Sends reads inside the block to the primary, without pinning the session
+    """
+    pinned_until = getattr(_local, "pinned_until", 0)
+    _local.pinned_until = float("inf")
+    try:
+        yield
+    finally:
+        _local.pinned_until = pinned_until
@@ -0,0 +1,198 @@
+# coding=utf-8
+import base64
+import hashlib
+import hmac
+import logging
+import threading
+import time
+from secrets import compare_digest, token_urlsafe
+
+from . import keys
+from .config import auth_config, server_config
+from .storage import get_data_store
+from .unit_of_work import deferred, after_commit
+from .util import Singleton, after_fork, decode
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+"""
+Stateless access tokens.
+
+    v1.<user_id>.<token_id>.<issued_at>.<signature>
+
+The signature is a HMAC-SHA256 (with [Tokens] secret from auth.ini) of everything before it,
+so a token is verified with crypto only. issued_at is in milliseconds, tokens expire TTL seconds after it.
+
+Revocations are kept in RedisData (see core/keys.py) and mirrored in every worker:
+    revoked:{auth}:tokens (Sorted set) - <token_id>: expiry of the token
+    revoked:{auth}:users (Sorted set) - <user_id>: time (ms) before which all tokens of the user are revoked
+Entries are only needed until the revoked tokens expire, so both stay small.
+Workers refresh their copy every SYNC_INTERVAL seconds, revocations made by other workers apply within that time.
+"""
+
+VERSION = "v1"
+
+# stored: random token per user in RedisData (see Users), signed: tokens from this module
+MODE = server_config.get("Tokens", "mode", fallback="stored")
+TTL = server_config.getint("Tokens", "ttl", fallback=7 * 86400)
+SYNC_INTERVAL = server_config.getfloat("Tokens", "sync_interval", fallback=5)
+
+SECRET = auth_config.get("Tokens", "secret", fallback="").encode("utf-8")
+
+if MODE not in ("stored", "signed"):
+    raise ValueError(f"invalid token mode: {MODE}")
+if MODE == "signed" and len(SECRET) < 32:
+    raise ValueError("signed tokens need [Tokens] secret (at least 32 characters) in auth.ini")
+
+
+def is_signed_token(token: str) -> bool:
+    return token.startswith(VERSION + ".")
+
+
+class SignedTokens(metaclass=Singleton):
+    """
+    Issues, verifies and revokes signed tokens
+    """
+    def __init__(self):
+        self.rd = get_data_store()
+
+        self._lock = threading.Lock()
+        # token_id: expiry
+        self._revoked_tokens = {}
+        # user_id: revoked before
+        self._revoked_users = {}
+        self._next_sync = 0
+
+        after_fork(self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._next_sync = 0
+
+    @staticmethod
+    def _sign(payload: str) -> str:
+        digest = hmac.new(SECRET, payload.encode("utf-8"), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+    @staticmethod
+    def _parse(token: str):
+        """
+        :return: (user_id, token_id, issued_at) or None if the token is malformed or forged
+        """
+        payload, _, signature = token.rpartition(".")
+        parts = payload.split(".")
+        if len(parts) != 4 or parts[0] != VERSION:
+            return None
+
+        _, user_id, token_id, issued_at = parts
+        if not user_id.isdigit() or not issued_at.isdigit():
+            return None
+
+        if not compare_digest(SignedTokens._sign(payload), signature):
+            return None
+
+        return int(user_id), token_id, int(issued_at)
+
+    def issue(self, user_id: int) -> str:
+        payload = f"{VERSION}.{user_id}.{token_urlsafe(12)}.{int(time.time() * 1000)}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(self, token: str) -> int:
+        """
+        :return: user id or None if the token is invalid, expired or revoked
+        """
+        parsed = self._parse(token)
+        if parsed is None:
+            return None
+
+        user_id, token_id, issued_at = parsed
+        if issued_at / 1000 + TTL < time.time():
+            return None
+
+        self._sync_if_due()
+        if token_id in self._revoked_tokens:
+            return None
+        if issued_at < self._revoked_users.get(user_id, 0):
+            return None
+
+        return user_id
+
+    def revoke(self, token: str):
+        """
+        Revokes one token (logout)
+        """
+        parsed = self._parse(token)
+        if parsed is None:
+            return
+
+        _, token_id, issued_at = parsed
+        expires = issued_at / 1000 + TTL
+
+        self.rd.zadd(keys.REVOKED_TOKENS, token_id, expires)
+        self._revoked_tokens[token_id] = expires
+
+        self._prune()
+
+    def revoke_user(self, user_id: int):
+        """
+        Revokes all tokens of the user issued until now (password change).
+        Queued in the current unit of work, so it's stored together with the new password (or not at all).
+        """
+        now = int(time.time() * 1000)
+
+        deferred(self.rd).zadd(keys.REVOKED_USERS, user_id, now)
+
+        @after_commit
+        def _apply():
+            self._revoked_users[user_id] = now
+            self._prune()
+
+    def _prune(self):
+        # Revocations of tokens that expired anyway aren't needed
+        now = time.time()
+
+        pipe = self.rd.pipeline(transaction=False)
+        pipe.zrangebyscore(keys.REVOKED_TOKENS, "-inf", now)
+        pipe.zrangebyscore(keys.REVOKED_USERS, "-inf", (now - TTL) * 1000)
+        expired_tokens, expired_users = pipe.execute()
+
+        if expired_tokens or expired_users:
+            pipe = self.rd.pipeline(transaction=False)
+            if expired_tokens:
+                pipe.zrem(keys.REVOKED_TOKENS, *expired_tokens)
+            if expired_users:
+                pipe.zrem(keys.REVOKED_USERS, *expired_users)
+            pipe.execute()
+
+    def _sync_if_due(self):
+        if time.time() < self._next_sync:
+            return
+
+        with self._lock:
+            # Another thread may have synced while this one was waiting
+            if time.time() < self._next_sync:
+                return
+            self._next_sync = time.time() + SYNC_INTERVAL
+
+            try:
+                self.sync()
+            except Exception:
+                # Verification keeps working with the last known revocations
+                log.exception("Syncing revoked tokens failed")
+
+    def sync(self):
+        """
+        Replaces the worker's copy of revocations with the one in RedisData
+        """
+        now = time.time()
+
+        pipe = self.rd.pipeline(transaction=False)
+        pipe.zrangebyscore(keys.REVOKED_TOKENS, now, "+inf", withscores=True)
+        pipe.zrangebyscore(keys.REVOKED_USERS, (now - TTL) * 1000, "+inf", withscores=True)
+        tokens, users = pipe.execute()
+
+        self._revoked_tokens = {member.decode("utf-8"): score for member, score in tokens}
+        self._revoked_users = {decode(member): score for member, score in users}
@@ -0,0 +1,796 @@
+# coding=utf-8
+import atexit
+import fnmatch
+import logging
+import os
+import pickle
+import threading
+import time
+
+from .config import server_config, DATA_DIR
+from .exceptions import StorageError
+from .tracing import record_round_trip
+from .util import Singleton, after_fork
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+"""
+Storage backends.
+
+Models never talk to a concrete client, they get one from get_data_store()/get_cache_store().
+Both engines expose the same (redis-py compatible) subset of commands:
+
+    hashes:       hget, hmget, hgetall, hset, hsetnx, hmset, hdel, hexists, hincrby, hkeys, hlen
+    strings:      get, set (ex, px, nx, xx), incr, incrby, delete, exists, expire, ttl
+    sets:         sadd, srem, smembers, sismember, scard
+    sorted sets:  zadd (legacy member, score order), zrem, zscore, zcard, zrange, zrevrange, zrangebyscore,
+                  zrevrangebylex
+    hyperloglog:  pfadd, pfcount (the memory engine keeps exact sets, so its counts are exact)
+    keyspace:     scan, scan_iter, flushdb, echo, ping
+    pub/sub:      publish (the memory engine has no subscribers, it's one process anyway)
+    streams:      XADD, XLEN, XGROUP CREATE, XREADGROUP (new entries only), XACK, XPENDING, XCLAIM
+                  through execute_command() only - redis-py 2.10 has no stream methods
+    pipeline():   buffers any of the above and runs them in one go with execute()
+
+Engines (server.ini, [Storage] engine):
+    redis   RedisData/RedisCache from core/redis.py (default)
+    memory  MemoryData/MemoryCache - in-process, no network and no external service.
+            Data is per process, so use it with a single worker (tests, benchmarks, single-node deployments).
+            If [Storage] snapshot is enabled, data is loaded from and saved to DATA_DIR on start/exit.
+"""
+
+ENGINE = server_config.get("Storage", "engine", fallback="redis")
+SNAPSHOT = server_config.getboolean("Storage", "snapshot", fallback=False)
+
+
+def _encode(value) -> bytes:
+    """
+    Encodes a value the same way redis-py does before sending it
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value).encode()
+    if isinstance(value, bool):
+        # redis-py sends bools as their str representation as well
+        return str(value).encode()
+    if isinstance(value, int):
+        return str(value).encode()
+
+    return str(value).encode("utf-8")
+
+
+class _HyperLogLog(set):
+    """
+    Members added with PFADD, kept as they are (a separate type so other commands refuse them, like in Redis)
+    """
+
+
+class _ZSet(dict):
+    """
+    member: score
+    """
+    def ordered(self, desc: bool=False) -> list:
+        return sorted(self.items(), key=lambda p: (p[1], p[0]), reverse=desc)
+
+
+class _Stream:
+    """
+    Entries and consumer groups of a stream
+    """
+    def __init__(self):
+        # (ms, seq): [field, value, ...]
+        self.entries = {}
+        self.last_id = (0, 0)
+        # name: _StreamGroup
+        self.groups = {}
+
+
+class _StreamGroup:
+    def __init__(self, last_delivered: tuple):
+        self.last_delivered = last_delivered
+        # (ms, seq): [consumer, delivered at (ms), delivery count]
+        self.pending = {}
+
+
+def _stream_id(raw: bytes) -> tuple:
+    ms, _, seq = raw.decode().partition("-")
+    return int(ms), int(seq or 0)
+
+
+def _format_stream_id(id_: tuple) -> bytes:
+    return f"{id_[0]}-{id_[1]}".encode()
+
+
+class StorageCommands:
+    """
+    Command methods shared by MemoryStorage and MemoryPipeline.
+    Every method only builds the arguments and passes them to execute_command.
+    """
+    def execute_command(self, *args, **options):
+        raise NotImplementedError
+
+    # HASHES
+    def hget(self, name, key):
+        return self.execute_command("HGET", name, key)
+
+    def hmget(self, name, keys, *args):
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        return self.execute_command("HMGET", name, *keys, *args)
+
+    def hgetall(self, name):
+        return self.execute_command("HGETALL", name)
+
+    def hset(self, name, key, value):
+        return self.execute_command("HSET", name, key, value)
+
+    def hsetnx(self, name, key, value):
+        return self.execute_command("HSETNX", name, key, value)
+
+    def hmset(self, name, mapping: dict):
+        items = []
+        for pair in mapping.items():
+            items.extend(pair)
+        return self.execute_command("HMSET", name, *items)
+
+    def hdel(self, name, *keys):
+        return self.execute_command("HDEL", name, *keys)
+
+    def hexists(self, name, key):
+        return self.execute_command("HEXISTS", name, key)
+
+    def hincrby(self, name, key, amount=1):
+        return self.execute_command("HINCRBY", name, key, amount)
+
+    def hkeys(self, name):
+        return self.execute_command("HKEYS", name)
+
+    def hlen(self, name):
+        return self.execute_command("HLEN", name)
+
+    # STRINGS AND KEYS
+    def get(self, name):
+        return self.execute_command("GET", name)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        pieces = [name, value]
+        if ex is not None:
+            pieces.extend(("EX", int(ex)))
+        if px is not None:
+            pieces.extend(("PX", int(px)))
+        if nx:
+            pieces.append("NX")
+        if xx:
+            pieces.append("XX")
+        return self.execute_command("SET", *pieces)
+
+    def incr(self, name, amount=1):
+        return self.execute_command("INCRBY", name, amount)
+
+    def incrby(self, name, amount=1):
+        return self.execute_command("INCRBY", name, amount)
+
+    def delete(self, *names):
+        return self.execute_command("DEL", *names)
+
+    def exists(self, name):
+        return self.execute_command("EXISTS", name)
+
+    def expire(self, name, time_):
+        return self.execute_command("EXPIRE", name, int(time_))
+
+    def ttl(self, name):
+        return self.execute_command("TTL", name)
+
+    # SETS
+    def sadd(self, name, *values):
+        return self.execute_command("SADD", name, *values)
+
+    def srem(self, name, *values):
+        return self.execute_command("SREM", name, *values)
+
+    def smembers(self, name):
+        return self.execute_command("SMEMBERS", name)
+
+    def sismember(self, name, value):
+        return self.execute_command("SISMEMBER", name, value)
+
+    def scard(self, name):
+        return self.execute_command("SCARD", name)
+
+    # HYPERLOGLOG
+    def pfadd(self, name, *values):
+        return self.execute_command("PFADD", name, *values)
+
+    def pfcount(self, *sources):
+        return self.execute_command("PFCOUNT", *sources)
+
+    # SORTED SETS
+    def zadd(self, name, *args, **kwargs):
+        # Same argument order as redis.Redis: member1, score1, member2, score2, ... or member=score
+        pieces = []
+        for member, score in zip(args[::2], args[1::2]):
+            pieces.extend((score, member))
+        for member, score in kwargs.items():
+            pieces.extend((score, member))
+        return self.execute_command("ZADD", name, *pieces)
+
+    def zrem(self, name, *values):
+        return self.execute_command("ZREM", name, *values)
+
+    def zscore(self, name, value):
+        return self.execute_command("ZSCORE", name, value)
+
+    def zcard(self, name):
+        return self.execute_command("ZCARD", name)
+
+    def zrange(self, name, start, end, desc=False, withscores=False):
+        return self.execute_command("ZREVRANGE" if desc else "ZRANGE", name, start, end,
+                                    withscores=withscores)
+
+    def zrevrange(self, name, start, end, withscores=False):
+        return self.execute_command("ZREVRANGE", name, start, end, withscores=withscores)
+
+    def zrangebyscore(self, name, min_, max_, start=None, num=None, withscores=False):
+        return self.execute_command("ZRANGEBYSCORE", name, min_, max_,
+                                    start=start, num=num, withscores=withscores)
+
+    def zrevrangebylex(self, name, max_, min_, start=None, num=None):
+        return self.execute_command("ZREVRANGEBYLEX", name, max_, min_, start=start, num=num)
+
+    # KEYSPACE
+    def flushdb(self):
+        return self.execute_command("FLUSHDB")
+
+    def echo(self, value):
+        return self.execute_command("ECHO", value)
+
+    def ping(self):
+        return self.execute_command("PING")
+
+    def publish(self, channel, message):
+        return self.execute_command("PUBLISH", channel, message)
+
+
+class MemoryStorage(StorageCommands):
+    """
+    In-process storage engine implementing the commands the models use.
+    Values are stored and returned as bytes, exactly like replies from redis-py.
+    """
+    snapshot_name = None
+    # No replicas, every read is consistent (see core/replicas.py)
+    replicas = ()
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data = {}
+        # key: unix time of expiry
+        self._expires = {}
+
+        if SNAPSHOT and self.snapshot_name:
+            self._snapshot_path = os.path.join(DATA_DIR, self.snapshot_name)
+            self._load_snapshot()
+            atexit.register(self.save_snapshot)
+
+        after_fork(self._after_fork)
+
+    def _after_fork(self):
+        # The lock could have been held by another thread of the parent while forking
+        self._lock = threading.RLock()
+        log.warning(f"{type(self).__name__} was forked, every worker now has its own copy of the data - "
+                    "use the memory engine with one worker only")
+
+    # SNAPSHOTS
+    def _load_snapshot(self):
+        if not os.path.isfile(self._snapshot_path):
+            return
+
+        with open(self._snapshot_path, "rb") as f:
+            self._data, self._expires = pickle.load(f)
+        log.info(f"Loaded {len(self._data)} keys from {self._snapshot_path}")
+
+    def save_snapshot(self):
+        with self._lock:
+            dump = pickle.dumps((self._data, self._expires), protocol=pickle.HIGHEST_PROTOCOL)
+
+        tmp_path = self._snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(dump)
+        os.replace(tmp_path, self._snapshot_path)
+
+    # EXECUTION
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        with self._lock:
+            reply = self._run(args, options)
+
+        record_round_trip([args], started, reply)
+        return reply
+
+    def _run(self, args, options):
+        handler = getattr(self, f"_cmd_{args[0].lower()}", None)
+        if handler is None:
+            raise StorageError(f"command {args[0]} is not supported by the memory engine")
+
+        return handler(*[_encode(a) for a in args[1:]], **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MemoryPipeline(self)
+
+    # HELPERS
+    def _alive(self, key: bytes):
+        """
+        Returns the value at key, deleting it first if it has expired
+        """
+        deadline = self._expires.get(key)
+        if deadline is not None and deadline <= time.time():
+            del self._expires[key]
+            self._data.pop(key, None)
+            return None
+
+        return self._data.get(key)
+
+    def _typed(self, key: bytes, type_, create: bool=False):
+        value = self._alive(key)
+        if value is None:
+            if not create:
+                return None
+            value = self._data[key] = type_()
+        elif type(value) is not type_:
+            raise StorageError("WRONGTYPE Operation against a key holding the wrong kind of value")
+
+        return value
+
+    def _cleanup(self, key: bytes):
+        # Redis deletes empty containers
+        if not self._data.get(key, True):
+            del self._data[key]
+            self._expires.pop(key, None)
+
+    # HASHES
+    def _cmd_hget(self, name, key):
+        h = self._typed(name, dict)
+        return h.get(key) if h else None
+
+    def _cmd_hmget(self, name, *keys):
+        h = self._typed(name, dict) or {}
+        return [h.get(k) for k in keys]
+
+    def _cmd_hgetall(self, name):
+        return dict(self._typed(name, dict) or {})
+
+    def _cmd_hset(self, name, key, value):
+        h = self._typed(name, dict, create=True)
+        created = key not in h
+        h[key] = value
+        return int(created)
+
+    def _cmd_hsetnx(self, name, key, value):
+        h = self._typed(name, dict, create=True)
+        if key in h:
+            return False
+        h[key] = value
+        return True
+
+    def _cmd_hmset(self, name, *items):
+        h = self._typed(name, dict, create=True)
+        h.update(zip(items[::2], items[1::2]))
+        return True
+
+    def _cmd_hdel(self, name, *keys):
+        h = self._typed(name, dict)
+        if not h:
+            return 0
+        removed = sum(h.pop(k, None) is not None for k in keys)
+        self._cleanup(name)
+        return removed
+
+    def _cmd_hexists(self, name, key):
+        h = self._typed(name, dict)
+        return bool(h) and key in h
+
+    def _cmd_hincrby(self, name, key, amount):
+        h = self._typed(name, dict, create=True)
+        value = int(h.get(key, b"0")) + int(amount)
+        h[key] = _encode(value)
+        return value
+
+    def _cmd_hkeys(self, name):
+        return list(self._typed(name, dict) or ())
+
+    def _cmd_hlen(self, name):
+        return len(self._typed(name, dict) or ())
+
+    # STRINGS AND KEYS
+    def _cmd_get(self, name):
+        return self._typed(name, bytes)
+
+    def _cmd_set(self, name, value, *flags):
+        flags = list(flags)
+        exists = self._alive(name) is not None
+        if b"NX" in flags and exists:
+            return None
+        if b"XX" in flags and not exists:
+            return None
+
+        self._data[name] = value
+        self._expires.pop(name, None)
+
+        if b"EX" in flags:
+            self._expires[name] = time.time() + int(flags[flags.index(b"EX") + 1])
+        elif b"PX" in flags:
+            self._expires[name] = time.time() + int(flags[flags.index(b"PX") + 1]) / 1000
+        return True
+
+    def _cmd_incrby(self, name, amount):
+        value = int(self._typed(name, bytes) or b"0") + int(amount)
+        self._data[name] = _encode(value)
+        return value
+
+    def _cmd_del(self, *names):
+        removed = 0
+        for name in names:
+            if self._alive(name) is not None:
+                del self._data[name]
+                self._expires.pop(name, None)
+                removed += 1
+        return removed
+
+    def _cmd_exists(self, name):
+        return self._alive(name) is not None
+
+    def _cmd_expire(self, name, seconds):
+        if self._alive(name) is None:
+            return False
+        self._expires[name] = time.time() + int(seconds)
+        return True
+
+    def _cmd_ttl(self, name):
+        if self._alive(name) is None:
+            return -2
+        deadline = self._expires.get(name)
+        if deadline is None:
+            return -1
+        return max(int(round(deadline - time.time())), 0)
+
+    # SETS
+    def _cmd_sadd(self, name, *values):
+        s = self._typed(name, set, create=True)
+        before = len(s)
+        s.update(values)
+        return len(s) - before
+
+    def _cmd_srem(self, name, *values):
+        s = self._typed(name, set)
+        if not s:
+            return 0
+        before = len(s)
+        s.difference_update(values)
+        self._cleanup(name)
+        return before - len(s)
+
+    def _cmd_smembers(self, name):
+        return set(self._typed(name, set) or ())
+
+    def _cmd_sismember(self, name, value):
+        s = self._typed(name, set)
+        return bool(s) and value in s
+
+    def _cmd_scard(self, name):
+        return len(self._typed(name, set) or ())
+
+    # HYPERLOGLOG
+    def _cmd_pfadd(self, name, *values):
+        hll = self._alive(name)
+        created = hll is None
+        hll = self._typed(name, _HyperLogLog, create=True)
+        before = len(hll)
+        hll.update(values)
+        return int(created or len(hll) > before)
+
+    def _cmd_pfcount(self, *sources):
+        union = set()
+        for name in sources:
+            union.update(self._typed(name, _HyperLogLog) or ())
+        return len(union)
+
+    # SORTED SETS
+    def _cmd_zadd(self, name, *pieces):
+        z = self._typed(name, _ZSet, create=True)
+        added = 0
+        for score, member in zip(pieces[::2], pieces[1::2]):
+            added += member not in z
+            z[member] = float(score)
+        return added
+
+    def _cmd_zrem(self, name, *members):
+        z = self._typed(name, _ZSet)
+        if not z:
+            return 0
+        removed = sum(z.pop(m, None) is not None for m in members)
+        self._cleanup(name)
+        return removed
+
+    def _cmd_zscore(self, name, member):
+        z = self._typed(name, _ZSet)
+        return z.get(member) if z else None
+
+    def _cmd_zcard(self, name):
+        return len(self._typed(name, _ZSet) or ())
+
+    @staticmethod
+    def _slice(pairs, start: int, end: int, withscores: bool):
+        end = len(pairs) if end == -1 else end + 1
+        pairs = pairs[start:end]
+        return pairs if withscores else [m for m, _ in pairs]
+
+    def _cmd_zrange(self, name, start, end, withscores=False):
+        z = self._typed(name, _ZSet) or _ZSet()
+        return self._slice(z.ordered(), int(start), int(end), withscores)
+
+    def _cmd_zrevrange(self, name, start, end, withscores=False):
+        z = self._typed(name, _ZSet) or _ZSet()
+        return self._slice(z.ordered(desc=True), int(start), int(end), withscores)
+
+    def _cmd_zrangebyscore(self, name, min_, max_, start=None, num=None, withscores=False):
+        z = self._typed(name, _ZSet) or _ZSet()
+        low, high = float(min_), float(max_)
+        pairs = [(m, s) for m, s in z.ordered() if low <= s <= high]
+        if start is not None and num is not None:
+            pairs = pairs[start:start + num]
+        return pairs if withscores else [m for m, _ in pairs]
+
+    @staticmethod
+    def _in_lex_range(member: bytes, min_: bytes, max_: bytes) -> bool:
+        # Bounds are - / + (no bound), [value (inclusive) or (value (exclusive)
+        if min_ != b"-":
+            if member < min_[1:] or (min_[:1] == b"(" and member == min_[1:]):
+                return False
+        if max_ != b"+":
+            if member > max_[1:] or (max_[:1] == b"(" and member == max_[1:]):
+                return False
+        return True
+
+    def _cmd_zrevrangebylex(self, name, max_, min_, start=None, num=None):
+        # Only meaningful when every member has the same score, like in Redis
+        z = self._typed(name, _ZSet) or _ZSet()
+        members = [m for m, _ in z.ordered(desc=True) if self._in_lex_range(m, min_, max_)]
+        if start is not None and num is not None:
+            members = members[start:start + num]
+        return members
+
+    # KEYSPACE
+    def _cmd_scan(self, cursor, *args):
+        # The whole keyspace is returned in one step, the cursor is always 0 afterwards
+        match = args[args.index(b"MATCH") + 1].decode() if b"MATCH" in args else None
+        keys = [k for k in list(self._data) if self._alive(k) is not None]
+        if match is not None:
+            keys = [k for k in keys if fnmatch.fnmatchcase(k.decode(errors="replace"), match)]
+        return 0, keys
+
+    def scan(self, cursor=0, match=None, count=None):
+        pieces = [cursor]
+        if match is not None:
+            pieces.extend(("MATCH", match))
+        if count is not None:
+            pieces.extend(("COUNT", count))
+        return self.execute_command("SCAN", *pieces)
+
+    def scan_iter(self, match=None, count=None):
+        _, keys = self.scan(match=match, count=count)
+        yield from keys
+
+    # STREAMS
+    def _stream_group(self, name, group):
+        stream = self._typed(name, _Stream)
+        if stream is None or group not in stream.groups:
+            raise StorageError("NOGROUP No such key or consumer group")
+        return stream, stream.groups[group]
+
+    def _cmd_xadd(self, name, *args):
+        args = list(args)
+        maxlen = None
+        if args[0].upper() == b"MAXLEN":
+            args.pop(0)
+            if args[0] in (b"~", b"="):
+                args.pop(0)
+            maxlen = int(args.pop(0))
+
+        stream = self._typed(name, _Stream, create=True)
+        raw_id, fields = args[0], args[1:]
+        if raw_id == b"*":
+            ms = int(time.time() * 1000)
+            last_ms, last_seq = stream.last_id
+            id_ = (last_ms, last_seq + 1) if ms <= last_ms else (ms, 0)
+        else:
+            id_ = _stream_id(raw_id)
+            if id_ <= stream.last_id:
+                raise StorageError("ERR The ID specified in XADD is equal or smaller than the target stream top item")
+
+        stream.entries[id_] = list(fields)
+        stream.last_id = id_
+
+        if maxlen is not None:
+            for old in sorted(stream.entries)[:max(len(stream.entries) - maxlen, 0)]:
+                del stream.entries[old]
+
+        return _format_stream_id(id_)
+
+    def _cmd_xlen(self, name):
+        stream = self._typed(name, _Stream)
+        return len(stream.entries) if stream else 0
+
+    def _cmd_xgroup(self, subcommand, name, group, start, *flags):
+        if subcommand.upper() != b"CREATE":
+            raise StorageError(f"XGROUP {subcommand.decode()} is not supported by the memory engine")
+
+        stream = self._typed(name, _Stream, create=b"MKSTREAM" in (f.upper() for f in flags))
+        if stream is None:
+            raise StorageError("ERR The XGROUP subcommand requires the key to exist")
+        if group in stream.groups:
+            raise StorageError("BUSYGROUP Consumer Group name already exists")
+
+        stream.groups[group] = _StreamGroup(stream.last_id if start == b"$" else _stream_id(start))
+        return True
+
+    def _cmd_xreadgroup(self, *args):
+        # GROUP <group> <consumer> [COUNT n] [BLOCK ms] STREAMS <key> >
+        # BLOCK is ignored, an empty read returns immediately
+        upper = [a.upper() for a in args]
+        group, consumer = args[upper.index(b"GROUP") + 1], args[upper.index(b"GROUP") + 2]
+        count = int(args[upper.index(b"COUNT") + 1]) if b"COUNT" in upper else None
+        streams = upper.index(b"STREAMS")
+        name, start = args[streams + 1], args[streams + 2]
+        if start != b">":
+            raise StorageError("only new entries (>) can be read with the memory engine")
+
+        stream, state = self._stream_group(name, group)
+        ids = [i for i in sorted(stream.entries) if i > state.last_delivered][:count]
+        if not ids:
+            return None
+
+        now = int(time.time() * 1000)
+        for id_ in ids:
+            state.pending[id_] = [consumer, now, 1]
+        state.last_delivered = ids[-1]
+
+        return [[name, [[_format_stream_id(i), list(stream.entries[i])] for i in ids]]]
+
+    def _cmd_xack(self, name, group, *ids):
+        _, state = self._stream_group(name, group)
+        return sum(state.pending.pop(_stream_id(i), None) is not None for i in ids)
+
+    def _cmd_xpending(self, name, group, start=None, end=None, count=None, consumer=None):
+        # Only the extended form: XPENDING <key> <group> <start> <end> <count> [consumer]
+        _, state = self._stream_group(name, group)
+        if start is None:
+            raise StorageError("only the extended form of XPENDING is supported by the memory engine")
+
+        low = (0, 0) if start == b"-" else _stream_id(start)
+        high = (float("inf"), 0) if end == b"+" else _stream_id(end)
+        now = int(time.time() * 1000)
+
+        reply = []
+        for id_ in sorted(state.pending):
+            owner, delivered_at, deliveries = state.pending[id_]
+            if low <= id_ <= high and (consumer is None or owner == consumer):
+                reply.append([_format_stream_id(id_), owner, now - delivered_at, deliveries])
+        return reply[:int(count)]
+
+    def _cmd_xclaim(self, name, group, consumer, min_idle, *ids):
+        stream, state = self._stream_group(name, group)
+        now = int(time.time() * 1000)
+
+        reply = []
+        for raw_id in ids:
+            id_ = _stream_id(raw_id)
+            entry = state.pending.get(id_)
+            if entry is None or now - entry[1] < int(min_idle):
+                continue
+
+            state.pending[id_] = [consumer, now, entry[2] + 1]
+            # Entries trimmed from the stream are returned without fields
+            fields = stream.entries.get(id_)
+            reply.append([raw_id, list(fields) if fields is not None else None])
+        return reply
+
+    def _cmd_flushdb(self):
+        self._data.clear()
+        self._expires.clear()
+        return True
+
+    def _cmd_echo(self, value):
+        return value
+
+    def _cmd_ping(self):
+        return True
+
+    # PUB/SUB
+    def _cmd_publish(self, channel, message):
+        # Nobody can subscribe to an in-process engine
+        return 0
+
+
+class MemoryPipeline(StorageCommands):
+    """
+    Buffers commands and runs them on the engine under one lock acquisition (atomically)
+    """
+    def __init__(self, storage: MemoryStorage):
+        self.storage = storage
+        self.command_stack = []
+
+    def execute_command(self, *args, **options):
+        self.command_stack.append((args, options))
+        return self
+
+    def execute(self, raise_on_error=True):
+        stack, self.command_stack = self.command_stack, []
+        if not stack:
+            return []
+
+        started = time.perf_counter()
+        replies = []
+        with self.storage._lock:
+            for args, options in stack:
+                try:
+                    replies.append(self.storage._run(args, options))
+                except StorageError as e:
+                    if raise_on_error:
+                        raise
+                    replies.append(e)
+
+        record_round_trip([args for args, _ in stack], started, replies)
+        return replies
+
+    def reset(self):
+        self.command_stack = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.reset()
+
+    def __len__(self):
+        return len(self.command_stack)
+
+
+class MemoryData(MemoryStorage, metaclass=Singleton):
+    snapshot_name = "memory_data.pickle"
+
+
+class MemoryCache(MemoryStorage, metaclass=Singleton):
+    # RedisCache can be regenerated on startup, so it is never snapshotted
+    snapshot_name = None
+
+
+def get_data_store():
+    """
+    Returns the store for pure and unlinked data (RedisData layout)
+    """
+    if ENGINE == "memory":
+        return MemoryData()
+
+    from .redis import RedisData
+    return RedisData()
+
+
+def get_cache_store():
+    """
+    Returns the store for links between data, generated on startup (RedisCache layout)
+    """
+    if ENGINE == "memory":
+        return MemoryCache()
+
+    from .redis import RedisCache
+    return RedisCache()
+
+
+if ENGINE not in ("redis", "memory"):
+    raise StorageError(f"unknown storage engine: {ENGINE}")
+
+# Make first instance to check connection
+get_data_store()
+get_cache_store()
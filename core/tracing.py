@@ -0,0 +1,161 @@
+# coding=utf-8
+import re
+import threading
+import time
+
+from .config import server_config
+
+
+"""
+Redis command tracing.
+
+Every command that goes through RedisData/RedisCache (directly or via a pipeline) is recorded
+into the trace of the current request (if there is one). A trace counts commands, round trips
+and payload bytes, keeps the slowest commands and groups commands by key pattern
+(blog:123 -> blog:*), so N+1 access patterns are easy to spot.
+"""
+
+TRACING_ENABLED = server_config.getboolean("Tracing", "enabled", fallback=True)
+# Requests issuing more commands than this are flagged
+COMMAND_BUDGET = server_config.getint("Tracing", "command_budget", fallback=50)
+# How many of the slowest commands to keep per request
+SLOWEST_KEPT = server_config.getint("Tracing", "slowest_kept", fallback=5)
+# Attach the X-Redis-Trace header to responses
+DEBUG_HEADER = server_config.getboolean("Tracing", "debug_header", fallback=False)
+
+_local = threading.local()
+
+_NUMBERS = re.compile(r"\d+")
+_HASH_TAG = re.compile(r"{[^}]*}")
+
+
+def key_pattern(key) -> str:
+    """
+    Turns a concrete key into its pattern: blog:2018123 -> blog:*
+    """
+    if isinstance(key, bytes):
+        key = key.decode(errors="replace")
+    key = _HASH_TAG.sub("{*}", str(key))
+    return _NUMBERS.sub("*", key)
+
+
+def payload_size(obj) -> int:
+    """
+    Approximates the amount of bytes a command argument or reply takes on the wire
+    """
+    if obj is None:
+        return 0
+    if isinstance(obj, (bytes, str)):
+        return len(obj)
+    if isinstance(obj, (int, float)):
+        return len(str(obj))
+    if isinstance(obj, dict):
+        return sum(payload_size(k) + payload_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sum(payload_size(a) for a in obj)
+
+    return 0
+
+
+class CommandTrace:
+    """
+    Holds the Redis statistics of one request
+    """
+    __slots__ = ("commands", "round_trips", "bytes_out", "bytes_in", "time_spent", "slowest", "patterns")
+
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.time_spent = 0.0
+
+        # list of (elapsed, command name, key pattern)
+        self.slowest = []
+        # <command> <pattern>: count
+        self.patterns = {}
+
+    def record(self, commands: list, elapsed: float, reply):
+        """
+        Records one round trip
+
+        :param commands: list of command argument tuples sent in this round trip
+        :param elapsed: time the round trip took in seconds
+        :param reply: parsed reply (or list of replies for pipelines)
+        """
+        self.round_trips += 1
+        self.commands += len(commands)
+        self.time_spent += elapsed
+        self.bytes_in += payload_size(reply)
+
+        # Pipelined commands share the round trip time
+        per_command = elapsed / len(commands) if commands else elapsed
+
+        for args in commands:
+            self.bytes_out += payload_size(args)
+
+            name = str(args[0]).upper()
+            pattern = key_pattern(args[1]) if len(args) > 1 else ""
+            label = f"{name} {pattern}".strip()
+
+            self.patterns[label] = self.patterns.get(label, 0) + 1
+            self._add_slow(per_command, label)
+
+    def _add_slow(self, elapsed: float, label: str):
+        if len(self.slowest) < SLOWEST_KEPT:
+            self.slowest.append((elapsed, label))
+            self.slowest.sort(reverse=True)
+        elif elapsed > self.slowest[-1][0]:
+            self.slowest[-1] = (elapsed, label)
+            self.slowest.sort(reverse=True)
+
+    @property
+    def over_budget(self) -> bool:
+        return self.commands > COMMAND_BUDGET
+
+    def repeated_patterns(self, threshold: int=5) -> dict:
+        """
+        Returns command patterns repeated at least `threshold` times - likely N+1 queries
+        """
+        return {p: c for p, c in self.patterns.items() if c >= threshold}
+
+    def header_value(self) -> str:
+        """
+        Compact representation used for the X-Redis-Trace debug header
+        """
+        slowest = ",".join(f"{label}={round(elapsed * 1000, 3)}ms" for elapsed, label in self.slowest)
+        return (f"commands={self.commands}; round_trips={self.round_trips}; "
+                f"bytes_out={self.bytes_out}; bytes_in={self.bytes_in}; "
+                f"time={round(self.time_spent * 1000, 3)}ms; slowest={slowest}")
+
+
+def start_trace() -> CommandTrace:
+    """
+    Starts a new trace for the current thread (request)
+    """
+    trace = CommandTrace()
+    _local.trace = trace
+    return trace
+
+
+def end_trace():
+    """
+    Stops tracing in the current thread and returns the finished trace (or None)
+    """
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    return trace
+
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+
+def record_round_trip(commands: list, started: float, reply):
+    """
+    Records a round trip into the current trace, if tracing is active.
+    `started` is a time.perf_counter() value from before the command was sent.
+    """
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace.record(commands, time.perf_counter() - started, reply)
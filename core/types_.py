@@ -13,11 +13,13 @@ class JsonStatus:
 
     INVALID_ARGUMENT = "invalid_argument"
     WRONG_LOGIN_INFO = "wrong_login_info"
+    TOO_MANY_ATTEMPTS = "too_many_attempts"
 
     USER_ALREADY_EXISTS = "user_already_exists"
     EMAIL_ALREADY_REGISTERED = "email_registered"
 
 
 class FieldUpdateType:
-    USERNAME_UPDATE = "user:by_username"
-    EMAIL_UPDATE = "user:by_email"
+    # Prefixes of the index links in RedisCache (see core/keys.py)
+    USERNAME_UPDATE = "idx:username"
+    EMAIL_UPDATE = "idx:email"
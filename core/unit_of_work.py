@@ -0,0 +1,230 @@
+# coding=utf-8
+import logging
+import threading
+
+from .config import server_config
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+"""
+Per-request unit of work.
+
+Models queue commands with deferred(store).<command>(...) instead of sending them one at a time.
+Everything queued for a store is sent as one pipeline at a commit point:
+    - Reply.get(): a queued reply is needed, commands queued before it go in the same round trip
+    - commit(): at the end of every request (eledina.flask_util.install_unit_of_work), before the response
+      is sent - a client never gets an answer to a write that wasn't stored
+Requests failing with a server error discard what they queued.
+
+Writes whose reply isn't needed are queued and never waited for, reads are queued and only waited for
+when their value is used. Commands sent to the store directly don't see queued writes, a method that reads
+what it queued reads it through deferred() as well.
+
+Some commands can't wait for the commit (SET NX claims of index links and idempotency keys, their result
+decides the response). Their undo is registered with on_rollback for the store of the writes they come with,
+it runs when the unit is discarded before that store's batch was sent - a commit failing in a later store
+keeps the claims of the batches already stored.
+Work that must only see committed writes (or only happen if they were stored) is registered with after_commit.
+
+Outside of a request (scripts, benchmarks, background threads) no unit is active and commands run right away.
+"""
+
+ENABLED = server_config.getboolean("Storage", "unit_of_work", fallback=True)
+
+_local = threading.local()
+
+
+class Reply:
+    """
+    Reply of a queued command, available after the commit of its store
+    """
+    __slots__ = ("_batch", "_value")
+
+    _PENDING = object()
+
+    def __init__(self, batch=None, value=_PENDING):
+        self._batch = batch
+        self._value = value
+
+    def get(self):
+        """
+        Commits the store of the command if it wasn't yet
+
+        :return: the reply of the command
+        """
+        if self._value is Reply._PENDING:
+            self._batch.execute()
+        return self._value
+
+
+class _Batch:
+    """
+    Commands queued for one store, sent as one pipeline
+    """
+    def __init__(self, store):
+        self.store = store
+        self.pipe = None
+        self.replies = []
+        # Pipelines sent successfully so far
+        self.executed = 0
+
+    def queue(self, name: str, *args, **kwargs) -> Reply:
+        if self.pipe is None:
+            self.pipe = self.store.pipeline()
+
+        getattr(self.pipe, name)(*args, **kwargs)
+        reply = Reply(self)
+        self.replies.append(reply)
+        return reply
+
+    def execute(self):
+        pipe, replies = self.pipe, self.replies
+        self.pipe, self.replies = None, []
+        if pipe is None:
+            return
+
+        values = pipe.execute()
+        self.executed += 1
+        for reply, value in zip(replies, values):
+            reply._value = value
+
+    def discard(self):
+        self.pipe, self.replies = None, []
+
+
+class _Queue:
+    """
+    Store-like object returned by deferred(): command methods queue the command and return a Reply
+    """
+    __slots__ = ("_batch",)
+
+    def __init__(self, batch: _Batch):
+        self._batch = batch
+
+    def __getattr__(self, name: str):
+        def command(*args, **kwargs):
+            return self._batch.queue(name, *args, **kwargs)
+        return command
+
+
+class _Immediate:
+    """
+    Same as _Queue, but runs the command right away (no unit of work is active)
+    """
+    __slots__ = ("_store",)
+
+    def __init__(self, store):
+        self._store = store
+
+    def __getattr__(self, name: str):
+        def command(*args, **kwargs):
+            return Reply(value=getattr(self._store, name)(*args, **kwargs))
+        return command
+
+
+def begin():
+    """
+    Starts the unit of work of the current thread (request)
+    """
+    _local.batches = {} if ENABLED else None
+    _local.rollbacks = []
+    _local.after_commit = []
+
+
+def on_rollback(store, fn):
+    """
+    Registers fn() to undo something already sent to a store, if the writes queued for `store` after this
+    are never sent: the unit is discarded before its commit, or the commit fails before that store's batch.
+    A batch that is stored keeps its claims, even if the batch of another store fails after it.
+    (Outside of a unit commands aren't queued, so there is nothing to undo)
+
+    :param store: store of the queued writes the undone command belongs to
+    """
+    if getattr(_local, "batches", None) is not None:
+        batch = _batch(store)
+        _local.rollbacks.append((batch, batch.executed, fn))
+    return fn
+
+
+def after_commit(fn):
+    """
+    Registers fn() to run once the unit is committed (right away outside of a unit), it's dropped on discard
+    """
+    if getattr(_local, "batches", None) is None:
+        fn()
+    else:
+        _local.after_commit.append(fn)
+    return fn
+
+
+def deferred(store):
+    """
+    :param store: RedisData/RedisCache (get_data_store()/get_cache_store())
+    :return: object with the command methods of the store, returning a Reply instead of the reply
+    """
+    if getattr(_local, "batches", None) is None:
+        return _Immediate(store)
+
+    return _Queue(_batch(store))
+
+
+def _batch(store) -> _Batch:
+    batches = _local.batches
+    batch = batches.get(id(store))
+    if batch is None:
+        batch = batches[id(store)] = _Batch(store)
+    return batch
+
+
+def commit():
+    """
+    Sends everything queued in the current unit of work, one pipeline per store
+    """
+    batches = getattr(_local, "batches", None)
+    if batches is None:
+        return
+
+    try:
+        for batch in batches.values():
+            batch.execute()
+    except Exception:
+        # The rest isn't sent either, the request fails
+        discard()
+        raise
+
+    # Committed, nothing to undo anymore (the teardown discards the unit)
+    callbacks, _local.after_commit = _local.after_commit, []
+    _local.rollbacks = []
+    for fn in callbacks:
+        try:
+            fn()
+        except Exception:
+            # The writes are stored, the response stands
+            log.exception(f"After commit callback {getattr(fn, '__name__', fn)} failed")
+
+
+def discard():
+    """
+    Drops everything queued and ends the unit of work
+    """
+    batches = getattr(_local, "batches", None)
+    rollbacks = getattr(_local, "rollbacks", [])
+    _local.batches = None
+    _local.rollbacks, _local.after_commit = [], []
+    if batches:
+        for batch in batches.values():
+            if batch.pipe is not None:
+                log.debug(f"Discarding {len(batch.replies)} queued command(s)")
+            batch.discard()
+
+    # Newest first, like nested undos; writes sent since the registration don't need one
+    for batch, executed, fn in reversed(rollbacks):
+        if batch.executed != executed:
+            continue
+        try:
+            fn()
+        except Exception:
+            log.exception(f"Rollback {getattr(fn, '__name__', fn)} failed")
@@ -1,8 +1,9 @@
 # coding=utf-8
-import uuid
+import os
 import secrets
 import re
-import datetime
+import threading
+import time
 
 
 class Singleton(type):
@@ -17,21 +18,161 @@ class Singleton(type):
         return cls._instances[cls]
 
 
-def gen_id(id_size=12) -> int:
+_after_fork_hooks = []
+
+
+def after_fork(fn):
     """
-    Generate a 'unique' id:
-        random_bits+seconds_since_year_zero_padded
+    Registers fn to run in child processes right after fork (prefork servers, see gunicorn.conf.py).
+    State that must not be shared between workers (connections, locks, per-worker ids) is reset this way.
+    """
+    _after_fork_hooks.append(fn)
+    return fn
+
+
+def _run_after_fork_hooks():
+    for fn in _after_fork_hooks:
+        fn()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_run_after_fork_hooks)
 
-    The actual ID size is id_size + 8 (by default this makes the ID 20 digits long)
+
+class IdGenerator:
+    """
+    Generates time-sortable 64-bit ids (Snowflake-style), without any coordination between workers
+    once they have their worker id:
+
+        | 1 bit unused | 41 bits milliseconds since EPOCH | 10 bits worker id | 12 bits sequence |
+
+    Ids are ordered by creation time, so they can be used as their own time index (see id_timestamp, id_from_time).
+    Every worker needs its own worker id, otherwise ids generated in the same millisecond can collide -
+    gen_id() uses the id leased by the process (see core/worker_ids.py).
     """
-    today = datetime.datetime.now()
-    year = datetime.datetime(year=today.year, month=1, day=1)
+    # 2018-01-01 00:00:00 UTC in milliseconds, lasts for ~69 years
+    EPOCH = 1514764800000
+
+    WORKER_BITS = 10
+    SEQUENCE_BITS = 12
+
+    MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+    MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+    TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+    # Wait for the clock instead of failing if it goes back by at most this many ms (NTP adjustments)
+    MAX_CLOCK_DRIFT = 50
+
+    def __init__(self, worker_id: int):
+        if not 0 <= worker_id <= self.MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be between 0 and {self.MAX_WORKER_ID}")
+
+        self.worker_id = worker_id
+        self._last_timestamp = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _now() -> int:
+        return int(time.time() * 1000)
+
+    def next(self) -> int:
+        with self._lock:
+            timestamp = self._now()
+
+            if timestamp < self._last_timestamp:
+                drift = self._last_timestamp - timestamp
+                if drift > self.MAX_CLOCK_DRIFT:
+                    raise RuntimeError(f"clock moved backwards by {drift}ms, refusing to generate ids")
+                time.sleep(drift / 1000)
+                timestamp = self._now()
+
+            if timestamp == self._last_timestamp:
+                self._sequence = (self._sequence + 1) & self.MAX_SEQUENCE
+                # Sequence exhausted for this millisecond, wait for the next one
+                if self._sequence == 0:
+                    while timestamp <= self._last_timestamp:
+                        timestamp = self._now()
+            else:
+                self._sequence = 0
+
+            self._last_timestamp = timestamp
+
+            return ((timestamp - self.EPOCH) << self.TIMESTAMP_SHIFT) | \
+                   (self.worker_id << self.SEQUENCE_BITS) | \
+                   self._sequence
+
+
+_id_generator = None
+_id_generator_lock = threading.Lock()
+
+
+@after_fork
+def _reset_id_generator():
+    global _id_generator, _id_generator_lock
+    # Every worker leases its own worker id (see core/worker_ids.py)
+    _id_generator = None
+    _id_generator_lock = threading.Lock()
 
-    # Pad to be fixed 8 chars (the biggest number is 31556926, which has 8 digits)
-    td = str(int((today - year).total_seconds())).zfill(8)
-    gen = str(uuid.uuid4().int)[:id_size]
 
-    return int(gen + td)
+def gen_id() -> int:
+    """
+    Generate a unique, time-sortable id (see IdGenerator) with the worker id leased by this process
+    """
+    global _id_generator
+    # Imported here, core.worker_ids needs the storage, which imports this module
+    from .worker_ids import WorkerIdLease
+
+    worker_id = WorkerIdLease().acquire()
+    generator = _id_generator
+    if generator is None or generator.worker_id != worker_id:
+        with _id_generator_lock:
+            # One generator per worker id, two would generate the same ids in the same millisecond
+            if _id_generator is None or _id_generator.worker_id != worker_id:
+                _id_generator = IdGenerator(worker_id)
+            generator = _id_generator
+
+    return generator.next()
+
+
+# Ids generated by the old gen_id (12 random digits + seconds since the start of the year) are 20 digits long
+# and therefore always bigger than any IdGenerator id
+LEGACY_ID_MIN = 10 ** 19
+
+
+def is_valid_id(some_id: int) -> bool:
+    if not isinstance(some_id, int):
+        return False
+
+    return 0 < some_id < (1 << 63) or len(str(some_id)) == 20
+
+
+def is_legacy_id(some_id: int) -> bool:
+    return some_id >= LEGACY_ID_MIN
+
+
+def id_timestamp(some_id: int) -> float:
+    """
+    Unix time (in seconds) at which the id was generated
+    """
+    if is_legacy_id(some_id):
+        raise ValueError("legacy ids don't contain a timestamp")
+
+    return ((some_id >> IdGenerator.TIMESTAMP_SHIFT) + IdGenerator.EPOCH) / 1000
+
+
+def id_from_time(timestamp: float) -> int:
+    """
+    Smallest id that can be generated at unix time `timestamp` - a lower bound for range queries
+    """
+    return (int(timestamp * 1000) - IdGenerator.EPOCH) << IdGenerator.TIMESTAMP_SHIFT
+
+
+def id_sort_key(some_id: int) -> int:
+    """
+    Sort key for ids in creation order - legacy ids are older than every IdGenerator id, but not ordered
+    """
+    return -1 if is_legacy_id(some_id) else some_id
 
 
 def gen_token():
@@ -0,0 +1,206 @@
+# coding=utf-8
+import threading
+import time
+from collections import OrderedDict
+
+from .util import after_fork
+
+
+"""
+Per-worker (in-process) helpers that save Redis round trips.
+Nothing here is shared between workers, so everything is either short-lived or periodically flushed.
+"""
+
+
+class _Flight:
+    """
+    A load in progress, other threads asking for the same key wait for it
+    """
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class CoalescingLRU:
+    """
+    Read-through LRU cache with a TTL.
+
+    Concurrent misses for the same key are coalesced: only the first thread calls the loader,
+    the others wait for its result, so a hot key triggers one read no matter how many requests ask for it.
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        # key: (expires at, value)
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, loader):
+        """
+        Returns the cached value for key or loads it with loader(key)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            flight = self._inflight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._inflight[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader(key)
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            with self._lock:
+                self._entries[key] = (time.time() + self.ttl, flight.value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+
+            return flight.value
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CounterBuffer:
+    """
+    Accumulates counter increments in memory and hands them to flush_fn({key: amount})
+    at most once every flush_interval seconds, instead of one write per increment.
+    """
+    def __init__(self, flush_interval: float, flush_fn):
+        self.flush_interval = flush_interval
+        self.flush_fn = flush_fn
+
+        self._counts = {}
+        self._next_flush = time.time() + flush_interval
+        self._lock = threading.Lock()
+
+    def add(self, key, amount: int=1):
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + amount
+            due = time.time() >= self._next_flush
+
+        if due:
+            self.flush()
+
+    def pending(self, key) -> int:
+        """
+        Increments of key that weren't flushed yet
+        """
+        return self._counts.get(key, 0)
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            self._next_flush = time.time() + self.flush_interval
+
+        if not counts:
+            return
+
+        try:
+            self.flush_fn(counts)
+        except Exception:
+            # Put them back, they'll be retried with the next flush
+            with self._lock:
+                for key, amount in counts.items():
+                    self._counts[key] = self._counts.get(key, 0) + amount
+            raise
+
+
+class SetBuffer:
+    """
+    Collects distinct members per key in memory and hands them to flush_fn({key: members})
+    at most once every flush_interval seconds. A member seen again before the flush costs nothing.
+
+    At most max_pending members are kept (over all keys): while flushes fail, new members are dropped
+    (and counted in dropped) instead of growing the worker's memory until the store is back.
+    """
+    def __init__(self, flush_interval: float, flush_fn, max_pending: int=100000):
+        self.flush_interval = flush_interval
+        self.flush_fn = flush_fn
+        self.max_pending = max_pending
+
+        self.dropped = 0
+        self._reset()
+        # Members of the parent are its own to flush, a child starts empty (and with a lock nobody holds)
+        after_fork(self._reset)
+
+    def _reset(self):
+        self._members = {}
+        self._pending = 0
+        self._next_flush = time.time() + self.flush_interval
+        self._lock = threading.Lock()
+
+    def add(self, key, member):
+        with self._lock:
+            members = self._members.get(key)
+            if members is None:
+                members = self._members[key] = set()
+            if member not in members:
+                if self._pending >= self.max_pending:
+                    self.dropped += 1
+                else:
+                    members.add(member)
+                    self._pending += 1
+            due = time.time() >= self._next_flush
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._members = self._members, {}
+            self._pending = 0
+            self._next_flush = time.time() + self.flush_interval
+
+        if not pending:
+            return
+
+        try:
+            self.flush_fn(pending)
+        except Exception:
+            # Put them back (as many as fit), they'll be retried with the next flush
+            with self._lock:
+                for key, members in pending.items():
+                    current = self._members.setdefault(key, set())
+                    for member in members - current:
+                        if self._pending >= self.max_pending:
+                            self.dropped += 1
+                            continue
+                        current.add(member)
+                        self._pending += 1
+            raise
@@ -0,0 +1,147 @@
+# coding=utf-8
+import atexit
+import logging
+import os
+import random
+import secrets
+import socket
+import threading
+import time
+
+from . import keys
+from .config import server_config
+from .storage import get_data_store
+from .util import Singleton, IdGenerator, after_fork
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+"""
+Worker ids for IdGenerator, leased from RedisData.
+
+Every process generating ids holds a lease on one of the 1024 worker ids, ids:worker:<n> (String, owner),
+claimed with SET NX and renewed by a background thread every LEASE_TTL / 3 seconds.
+A process only uses its id while the lease is certainly its own: until LEASE_MARGIN seconds before the lease
+could have expired (LEASE_TTL after the last renewal). After that it leases an id again on its next gen_id.
+Two processes never hold the same id at the same time, no matter how workers are recycled or servers added.
+
+[IDs] worker_id pins the id of a process, it's leased like any other (and fails while someone else holds it).
+"""
+
+# Seconds a lease lasts without renewal
+LEASE_TTL = server_config.getint("IDs", "lease_ttl", fallback=60)
+# Seconds before that when the process stops using the id (clock differences between servers, slow renewals)
+LEASE_MARGIN = server_config.getfloat("IDs", "lease_margin", fallback=LEASE_TTL / 4)
+
+# Random ids tried per round trip
+_CANDIDATES_PER_TRY = 8
+
+
+class WorkerIdLease(metaclass=Singleton):
+    """
+    The leased worker id of this process
+    """
+    def __init__(self):
+        self.rd = get_data_store()
+        self.configured = server_config.getint("IDs", "worker_id", fallback=None)
+
+        self._reset()
+        after_fork(self._reset)
+        atexit.register(self.release)
+
+    def _reset(self):
+        # A forked child doesn't own the lease of its parent
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self.worker_id = None
+        self.valid_until = 0
+        self._lock = threading.Lock()
+        self._renewer = None
+
+    def acquire(self) -> int:
+        """
+        :raise: StorageUnavailable if RedisData can't be reached, RuntimeError if no id can be leased
+        :return: worker id of this process, valid at least until valid_until
+        """
+        with self._lock:
+            if self.worker_id is not None and time.time() < self.valid_until:
+                return self.worker_id
+
+            self.worker_id = None
+            started = time.time()
+            worker_id = self._lease()
+
+            self.worker_id = worker_id
+            self.valid_until = started + LEASE_TTL - LEASE_MARGIN
+            log.info(f"Leased worker id {worker_id}")
+
+            if self._renewer is None:
+                self._renewer = threading.Thread(target=self._renew, name="worker-id-lease", daemon=True)
+                self._renewer.start()
+
+            return worker_id
+
+    def _lease(self) -> int:
+        if self.configured is not None:
+            if not self.rd.set(keys.worker_id_lease(self.configured), self.owner, ex=LEASE_TTL, nx=True):
+                raise RuntimeError(f"worker_id {self.configured} is leased by another process")
+            return self.configured
+
+        candidates = list(range(IdGenerator.MAX_WORKER_ID + 1))
+        random.shuffle(candidates)
+
+        for start in range(0, len(candidates), _CANDIDATES_PER_TRY):
+            batch = candidates[start:start + _CANDIDATES_PER_TRY]
+
+            pipe = self.rd.pipeline(transaction=False)
+            for worker_id in batch:
+                pipe.set(keys.worker_id_lease(worker_id), self.owner, ex=LEASE_TTL, nx=True)
+            won = [worker_id for worker_id, ok in zip(batch, pipe.execute()) if ok]
+
+            if won:
+                # One is enough, the others were only just claimed by this process.
+                # Different slots, no multi-key DEL
+                if len(won) > 1:
+                    pipe = self.rd.pipeline(transaction=False)
+                    for worker_id in won[1:]:
+                        pipe.delete(keys.worker_id_lease(worker_id))
+                    pipe.execute()
+                return won[0]
+
+        raise RuntimeError("every worker id is leased")
+
+    def _renew(self):
+        while True:
+            time.sleep(LEASE_TTL / 3)
+
+            with self._lock:
+                worker_id = self.worker_id
+                # A lease that may have expired could belong to someone else by now, it's not renewed
+                if worker_id is None or time.time() >= self.valid_until:
+                    continue
+
+            renewed = time.time()
+            try:
+                self.rd.expire(keys.worker_id_lease(worker_id), LEASE_TTL)
+            except Exception:
+                log.warning(f"Renewing the lease of worker id {worker_id} failed", exc_info=True)
+                continue
+
+            with self._lock:
+                if self.worker_id == worker_id:
+                    self.valid_until = renewed + LEASE_TTL - LEASE_MARGIN
+
+    def release(self):
+        """
+        Gives the id back (on exit), so recycled workers don't use up ids
+        """
+        with self._lock:
+            worker_id, self.worker_id = self.worker_id, None
+            if worker_id is None or time.time() >= self.valid_until:
+                return
+
+        try:
+            self.rd.delete(keys.worker_id_lease(worker_id))
+        except Exception:
+            log.warning(f"Releasing worker id {worker_id} failed", exc_info=True)
@@ -0,0 +1,162 @@
+# coding=utf-8
+import os
+import threading
+import time
+from functools import wraps
+from flask import abort, g
+
+from core.config import server_config
+from core.metrics import Metrics
+from core.util import after_fork
+
+
+"""
+Adaptive concurrency limiting (load shedding) for the API.
+
+Every route has a cost class. Expensive routes (PBKDF2: login, register, password changes) have to get
+a slot from the worker's AdaptiveLimiter, requests that don't get one are answered right away with
+503 and Retry-After. Cheap routes are never shed - their latency is what the limiter protects.
+
+The limit follows AIMD: every request that took longer than the target of its class
+(cheap routes included, they slow down first when the CPU is saturated) shrinks the limit by BACKOFF,
+at most once per EXPENSIVE_TARGET_MS. Expensive requests finishing in time while the limit is in use
+grow it by 1/limit, so by about one slot per round of requests.
+"""
+
+ENABLED = server_config.getboolean("Admission", "enabled", fallback=True)
+# Latency (ms) above which a request counts as a sign of overload, per cost class
+CHEAP_TARGET_MS = server_config.getfloat("Admission", "cheap_target_ms", fallback=100)
+EXPENSIVE_TARGET_MS = server_config.getfloat("Admission", "expensive_target_ms", fallback=1000)
+# Threads of a worker (see gunicorn.conf.py), more requests than that never run at once
+THREADS = int(os.environ.get("ELEDINA_THREADS", 4))
+# Concurrent expensive requests per worker. By default they start at half of the threads and never take
+# all of them, so cheap requests always find a free thread; a limit above the threads couldn't be reached
+MIN_LIMIT = server_config.getint("Admission", "min_limit", fallback=1)
+MAX_LIMIT = min(server_config.getint("Admission", "max_limit", fallback=max(THREADS - 1, 1)), THREADS)
+INITIAL_LIMIT = min(max(server_config.getint("Admission", "initial_limit", fallback=THREADS // 2), MIN_LIMIT),
+                    MAX_LIMIT)
+BACKOFF = server_config.getfloat("Admission", "backoff", fallback=0.75)
+# Seconds clients are told to wait after a 503
+RETRY_AFTER = server_config.getint("Admission", "retry_after", fallback=1)
+
+CHEAP = "cheap"
+EXPENSIVE = "expensive"
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit, shared by the threads of a worker
+    """
+    def __init__(self, initial: int, minimum: int, maximum: int, backoff: float, cooldown: float):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.cooldown = cooldown
+
+        self.inflight = 0
+        self._last_decrease = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        self.inflight = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.inflight >= int(self.limit):
+                return False
+
+            self.inflight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def on_sample(self, latency: float, target: float, increase: bool=True):
+        """
+        Adjusts the limit after a request finished
+
+        :param latency: seconds the request took
+        :param target: seconds it should have taken at most
+        :param increase: whether the request used a slot (only those grow the limit)
+        """
+        with self._lock:
+            if latency > target:
+                # A burst of slow requests is one overload, not many
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self._last_decrease = now
+                    self.limit = max(self.limit * self.backoff, self.minimum)
+            # Only grow a limit that is actually used, an idle worker would grow it forever
+            elif increase and self.inflight + 1 >= self.limit / 2:
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+
+
+limiter = AdaptiveLimiter(INITIAL_LIMIT, MIN_LIMIT, MAX_LIMIT, BACKOFF, EXPENSIVE_TARGET_MS / 1000)
+metrics = Metrics()
+
+
+@after_fork
+def _reset_limiter():
+    # Every worker limits on its own
+    limiter.reset()
+
+
+def _send_503():
+    info = {
+        "message": "Server is busy, try again later",
+        "try_in": RETRY_AFTER,
+    }
+    abort(503, info)
+
+
+def expensive(when=None):
+    """
+    Marks a route as expensive, it's shed when the worker is overloaded.
+    Must be placed after parse_body (the body is available) and the rate limits (they're cheaper).
+
+    :param when: function getting the body, only requests for which it returns True are expensive
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def inner(*args, **kwargs):
+            if not ENABLED or (when is not None and not when(kwargs.get("body"))):
+                return fn(*args, **kwargs)
+
+            if not limiter.try_acquire():
+                metrics.inc(f"admission.shed.{fn.__name__}")
+                _send_503()
+
+            g.admission_cost = EXPENSIVE
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                limiter.release()
+                limiter.on_sample(time.perf_counter() - started, EXPENSIVE_TARGET_MS / 1000)
+                metrics.observe("admission.limit", limiter.limit)
+
+        return inner
+    return decorator
+
+
+def install_admission(blueprint):
+    """
+    Measures the latency of cheap requests of the blueprint, expensive ones are measured by @expensive
+    """
+    if not ENABLED:
+        return
+
+    @blueprint.before_request
+    def _start_timer():
+        g.admission_started = time.perf_counter()
+
+    @blueprint.after_request
+    def _sample_latency(response):
+        started = g.get("admission_started")
+        if started is not None and g.get("admission_cost", CHEAP) == CHEAP:
+            limiter.on_sample(time.perf_counter() - started, CHEAP_TARGET_MS / 1000, increase=False)
+
+        return response
@@ -1,18 +1,22 @@
 # coding=utf-8
-from flask import Blueprint, request, abort
+import math
+from flask import Blueprint, request, abort, make_response
 from functools import wraps
 from random import randint
-try:
-    from ujson import loads
-except ImportError:
-    from json import loads
 
 from ..flask_util import jsonify_response
+from .admission import expensive, install_admission
 from .bucket import ip_rate_limit, token_rate_limit
-from core.exceptions import UsernameAlreadyExists, ForbiddenArgument, LoginFailed, EmailAlreadyRegistered
+from . import schemas
+from .schemas import parse_body, limit_body
+from core.exceptions import UsernameAlreadyExists, ForbiddenArgument, LoginFailed, EmailAlreadyRegistered, \
+    LoginThrottled, StorageUnavailable
 from core.models import Users, Blogs
+from core.analytics import Analytics, STANDARD_ERROR
 from core.cachemanager import CacheGenerator
-from core.types_ import JsonStatus
+from core.live_config import LiveConfig
+from core.metrics import Metrics
+from core.types_ import JsonStatus, Role
 
 
 __version__ = "0.1.0"
@@ -25,7 +29,11 @@ api = Blueprint("api", __name__,
 
 users = Users()
 blogs = Blogs()
-CacheGenerator().generate_cache()
+analytics = Analytics()
+CacheGenerator().generate_cache_when_available()
+
+# Sheds expensive routes under overload (see admission.py)
+install_admission(api)
 
 
 # AUTHENTICATION
@@ -40,12 +48,27 @@ def require_token(fn):
         user_id = users.verify_token(token)
         if not token or not user_id:
             abort(403, "Invalid token")
+        analytics.record_user(int(user_id))
 
         # See this \/
         return fn(int(user_id), *args, **kwargs)
     return inner
 
 
+def require_admin(fn):
+    """
+    Must be placed after require_token
+    :raise: HTTP 403 if the user is not an admin
+    """
+    @wraps(fn)
+    def inner(user_id, *args, **kwargs):
+        if users.get_role(user_id) != Role.ADMIN:
+            abort(403, "Admins only")
+
+        return fn(user_id, *args, **kwargs)
+    return inner
+
+
 #################
 # ERROR HANDLERS
 # These error handlers catch abort() calls and return json alongside a http status
@@ -87,14 +110,59 @@ def conflict(error):
     return jsonify_response(payload, 409)
 
 
+@api.errorhandler(413)
+def payload_too_large(_):
+    payload = {
+        "message": "Request body too large.",
+    }
+
+    return jsonify_response(payload, 413)
+
+
 @api.errorhandler(429)
 def rate_limit(error):
+    # _send_429 passes a dict as the description
+    info = error.description if isinstance(error.description, dict) else {}
+    try_in = max(float(info.get("try_in") or 1), 0)
+
+    payload = {
+        "message": str(info.get("message") or "Too many requests."),
+        "try_in": try_in
+    }
+
+    response = jsonify_response(payload, 429)
+    response.headers["Retry-After"] = str(math.ceil(try_in))
+    return response
+
+
+@api.errorhandler(503)
+def service_unavailable(error):
+    # _send_503 passes a dict as the description
+    info = error.description if isinstance(error.description, dict) else {}
+    try_in = max(float(info.get("try_in") or 1), 0)
+
     payload = {
-        "message": str(error.get("message")) or "Too many requests.",
-        "try_in": float(error.get("try_in"))
+        "message": str(info.get("message") or "Service unavailable."),
+        "try_in": try_in
     }
 
-    return jsonify_response(payload, 429)
+    response = jsonify_response(payload, 503)
+    response.headers["Retry-After"] = str(math.ceil(try_in))
+    return response
+
+
+@api.errorhandler(StorageUnavailable)
+def storage_unavailable(error):
+    # Redis is down, fail fast instead of tying up the worker (see core/circuit_breaker.py)
+    try_in = max(error.retry_after, 1)
+    payload = {
+        "message": "Storage is unavailable, try again later.",
+        "try_in": try_in
+    }
+
+    response = jsonify_response(payload, 503)
+    response.headers["Retry-After"] = str(math.ceil(try_in))
+    return response
 
 
 #############
@@ -139,9 +207,92 @@ def ping(_user_id: int):
     return jsonify_response(payload)
 
 
+@api.route("/metrics")
+@require_token
+@require_admin
+def metrics(_user_id: int):
+    """
+    /metrics: per-worker metrics (Redis command traces, ...)
+
+    Fields: none
+    Statuses: none
+
+    :return: JSON(counters, summaries)
+    """
+    return jsonify_response(Metrics().export())
+
+
+@api.route("/stats")
+@require_token
+@require_admin
+def stats(_user_id: int):
+    """
+    /stats: distinct users and IPs of today (UTC), the last 7 and 30 days and the current hour, see core/analytics.py
+    Estimates, with a standard error of 0.81 %
+
+    Fields: none
+    Statuses:
+        OK: everything ok
+
+    :return: JSON(status, users, ips, standard_error)
+    """
+    payload = {
+        "status": JsonStatus.OK,
+        **analytics.stats(),
+        "standard_error": STANDARD_ERROR,
+    }
+
+    return jsonify_response(payload)
+
+
+@api.route("/admin/config", methods=["GET", "POST"])
+@limit_body(schemas.USER_BODY_MAX)
+@require_token
+@require_admin
+@parse_body(schemas.LIVE_CONFIG, schemas.USER_BODY_MAX)
+def admin_config(_user_id: int, body: dict):
+    """
+    /admin/config: runtime parameters (rate limits, rounds, user input limits), see core/live_config.py
+    POST changes them in every worker without a restart
+
+    Fields (POST):
+        <parameter>: int - new value
+        reset: list - parameters to set back to the config files
+
+    Statuses:
+        INVALID_ARGUMENT: unknown parameter or invalid value
+        OK: everything ok
+
+    :return: JSON(status, values, overrides)
+    """
+    live_config = LiveConfig()
+
+    if body is not None:
+        reset = body.pop("reset", [])
+        try:
+            live_config.set_overrides(body, reset)
+        except ValueError as e:
+            payload = {
+                "status": JsonStatus.INVALID_ARGUMENT,
+                "message": str(e)
+            }
+
+            return jsonify_response(payload, 400)
+
+    payload = {
+        "status": JsonStatus.OK,
+        "values": live_config.values(),
+        "overrides": live_config.overrides(),
+    }
+
+    return jsonify_response(payload)
+
+
 @api.route("/register", methods=["POST"])
 @ip_rate_limit
-def register():
+@parse_body(schemas.REGISTER, schemas.USER_BODY_MAX)
+@expensive()
+def register(body: dict):
     """
     /register: Register a user and generate an access token
 
@@ -153,28 +304,28 @@ def register():
         password: str
 
     Statuses:
+        INVALID_ARGUMENT: one/more of the passed fields is incorrect
         USER_ALREADY_EXISTS: username is taken
         OK: everything ok, user registered
 
     :return: JSON(status, [token, ])
     """
-    body = loads(request.data)
+    username = body["username"]
+    email = body["email"]
+    password = body["password"]
 
-    try:
-        username = body["username"]
-        name = body["name"]
-        surname = body["surname"]
-        email = body["email"]
-        password = body["password"]
-
-        fullname = f"{name}|{surname}"
-    except KeyError:
-        abort(400, dict(description="Invalid fields!"))
-        return
+    fullname = f"{body['name']}|{body['surname']}"
 
     # Additionally verifies data
     try:
         token = users.register_user(username, fullname, email, password)
+    except ForbiddenArgument:
+        payload = {
+            "status": JsonStatus.INVALID_ARGUMENT,
+        }
+
+        return jsonify_response(payload, 400)
+
     except UsernameAlreadyExists:
         payload = {
             "status": JsonStatus.USER_ALREADY_EXISTS,
@@ -200,7 +351,9 @@ def register():
 
 @api.route("/login", methods=["POST"])
 @ip_rate_limit
-def login():
+@parse_body(schemas.LOGIN, schemas.USER_BODY_MAX)
+@expensive()
+def login(body: dict):
     """
     /login: Login the user and generate an access token
 
@@ -211,18 +364,13 @@ def login():
     Statuses:
         INVALID_ARGUMENT: one/more of the passed fields is incorrect
         WRONG_LOGIN_INFO: any of the login arguments are incorrect
+        TOO_MANY_ATTEMPTS: the account is locked after too many failed logins (HTTP 429, see try_in)
         OK: everything went ok, new token generated
 
     :return: JSON(status, [token, ])
     """
-    body = loads(request.data)
-
-    try:
-        primary = body["primary"]
-        password = body["password"]
-    except KeyError:
-        abort(400, dict(description="Missing fields!"))
-        return
+    primary = body["primary"]
+    password = body["password"]
 
     try:
         new_token = users.login_user(primary, password)
@@ -238,6 +386,15 @@ def login():
         }
         return jsonify_response(payload, 403)
 
+    except LoginThrottled as e:
+        payload = {
+            "status": JsonStatus.TOO_MANY_ATTEMPTS,
+            "try_in": e.retry_after
+        }
+        response = jsonify_response(payload, 429)
+        response.headers["Retry-After"] = str(int(e.retry_after) + 1)
+        return response
+
     else:
         payload = {
             "status": JsonStatus.OK,
@@ -246,14 +403,40 @@ def login():
         return jsonify_response(payload)
 
 
+@api.route("/logout", methods=["POST"])
+@require_token
+def logout(_: int):
+    """
+    /logout: Invalidate the current token
+
+    Statuses:
+        OK: the token can't be used anymore
+
+    :return: JSON(status)
+    """
+    users.logout_user(request.headers.get("Authorization"))
+
+    payload = {
+        "status": JsonStatus.OK
+    }
+    return jsonify_response(payload)
+
+
 @api.route("/user", methods=["GET", "PATCH"])
+@limit_body(schemas.USER_BODY_MAX)
 @require_token
 @token_rate_limit
-def user_manage(user_id: int):
+@parse_body(schemas.USER_UPDATE, schemas.USER_BODY_MAX)
+# Only password changes hash anything
+@expensive(when=lambda body: body is not None and "password" in body)
+def user_manage(user_id: int, body: dict):
     """
     /user: Get or update user data
 
-    Fields (any of):
+    GET returns the profile with an ETag (its version), send it back in If-None-Match to get a 304
+    while the profile didn't change.
+
+    Fields (PATCH, any of):
         username: str
         fullname: str
         email: str
@@ -267,9 +450,12 @@ def user_manage(user_id: int):
         USER_ALREADY_EXISTS: username or email is already registered
         OK: everything ok, user fields updated
 
-    :return: JSON(status)
+    :return: JSON(status, [user, ])
     """
-    data = loads(request.data)
+    if request.method == "GET":
+        return _user_profile(user_id)
+
+    data = body
 
     # TODO high rate-limiting for username and other changes
     if request.method == "PATCH":
@@ -327,29 +513,153 @@ def user_manage(user_id: int):
             return jsonify_response(payload)
 
 
+def _user_profile(user_id: int):
+    # Revalidation only needs the version, the profile isn't read or encoded
+    if request.if_none_match:
+        etag = f"{user_id}-{users.get_profile_version(user_id)}"
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
+
+    version, profile = users.get_profile(user_id)
+    payload = {
+        "status": JsonStatus.OK,
+        "user": profile
+    }
+
+    response = jsonify_response(payload)
+    response.set_etag(f"{user_id}-{version}")
+    # Clients have to revalidate, profiles change
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
 @api.route("/blog/new", methods=["POST"])
 @ip_rate_limit
-def blog_new():
-    print(request.data)
-    body = loads(request.data)
+@parse_body(schemas.BLOG_NEW, schemas.BLOG_BODY_MAX)
+def blog_new(body: dict):
+    """
+    /blog/new: Upload a blog
 
+    Fields:
+        title: str
+        content: str
+        date: str
+
+    Statuses:
+        INVALID_ARGUMENT: one of the fields is invalid
+        OK: blog uploaded
+
+    :return: JSON(status, [id, ])
+    """
     title = body.get("title")
     content = body.get("content")
     date = body.get("date")
 
     # Class and function imported from models.py
-    blogs.upload_blog(title, content, date)
+    try:
+        blog_id = blogs.upload_blog(title, content, date)
+    except ForbiddenArgument as e:
+        payload = {
+            "status": JsonStatus.INVALID_ARGUMENT,
+            "message": str(e)
+        }
+        return jsonify_response(payload, 400)
+
     blogpack = {
         "status": JsonStatus.OK,
+        # Ids are 64-bit, which JavaScript numbers can't hold
+        "id": str(blog_id)
     }
     return jsonify_response(blogpack)
-    # CacheGenerator().blog_cache()
+
+
+@api.route("/blog/batch", methods=["POST"])
+@ip_rate_limit
+@parse_body(schemas.BLOG_BATCH, schemas.BLOG_BATCH_BODY_MAX)
+def blog_batch(body: dict):
+    """
+    /blog/batch: Upload many blogs at once, safe to retry
+
+    Fields:
+        posts: list of
+            title: str
+            content: str
+            date: str
+            key: str (optional) - idempotency key, a post with an already used key is not stored again
+
+    Statuses:
+        INVALID_ARGUMENT: one of the posts is invalid, nothing was stored
+        OK: posts uploaded
+
+    :return: JSON(status, [posts: list of (id, key, duplicate), ])
+    """
+    try:
+        results = blogs.upload_blogs(body.get("posts"))
+    except ForbiddenArgument as e:
+        payload = {
+            "status": JsonStatus.INVALID_ARGUMENT,
+            "message": str(e)
+        }
+        return jsonify_response(payload, 400)
+
+    for result in results:
+        result["id"] = str(result["id"])
+
+    payload = {
+        "status": JsonStatus.OK,
+        "posts": results
+    }
+    return jsonify_response(payload)
+
+
+@api.route("/blog/<int:blog_id>", methods=["GET"])
+@ip_rate_limit
+def blog_single(blog_id: int):
+    """
+    /blog/<id>: One blog
+
+    Fields: none
+    Statuses: none
+
+    :return: JSON(title, content, date, views)
+    """
+    try:
+        blog = blogs.get_single_blog(blog_id)
+    except ForbiddenArgument:
+        blog = None
+
+    if blog is None:
+        abort(404)
+
+    return jsonify_response(blog)
 
 
 @api.route("/blog/list", methods=["GET"])
 @ip_rate_limit
 def blog_get():
+    """
+    /blog/list: blogs, newest first
+
+    Query parameters (optional):
+        before: int - blog id to continue from (cursor)
+        limit: int - maximum amount of blogs
+
+    :return: JSON(blog:<id>: {title, content, date})
+    """
+    before = request.args.get("before", type=int)
+    limit = request.args.get("limit", type=int)
+
     # Class and function imported from models.py
-    bpack = blogs.get_blog()
+    try:
+        bpack = blogs.get_blog(before, limit)
+    except ForbiddenArgument:
+        payload = {
+            "status": JsonStatus.INVALID_ARGUMENT,
+        }
+
+        return jsonify_response(payload, 400)
 
     return jsonify_response(bpack)
@@ -3,6 +3,10 @@ import time
 from functools import wraps
 from flask import request, abort
 
+from core.analytics import Analytics
+from core.live_config import LiveConfig
+from core.util import after_fork
+
 
 class Bucket:
     __slots__ = ("last_cooldown", "_size", "_cooldown", "current_bucket")
@@ -33,6 +37,26 @@ class Bucket:
 ip_buckets = {}
 user_buckets = {}
 
+# Sizes are tunable at runtime (see core/live_config.py)
+live_config = LiveConfig()
+analytics = Analytics()
+
+
+@after_fork
+def _reset_buckets():
+    # Every worker rate-limits on its own
+    ip_buckets.clear()
+    user_buckets.clear()
+
+
+@live_config.on_change
+def _resize_buckets(values: dict):
+    # Existing buckets keep their state and take the new size, so shedding load applies right away
+    for buckets, prefix in ((ip_buckets, "ip_bucket"), (user_buckets, "token_bucket")):
+        for bucket in list(buckets.values()):
+            bucket._size = values[f"{prefix}_limit"]
+            bucket._cooldown = values[f"{prefix}_per"]
+
 
 def _send_429(bucket):
     """
@@ -49,22 +73,33 @@ def _send_429(bucket):
     abort(429, info)
 
 
+def ip_bucket_action(ip: str):
+    """
+    Takes a request from the bucket of ip
+
+    :return: the bucket if ip has no requests left in this time period, None otherwise
+    """
+    # Add a bucket if not present
+    if not ip_buckets.get(ip):
+        b = Bucket(live_config.get("ip_bucket_limit"), live_config.get("ip_bucket_per"))
+        b.action()
+        ip_buckets[ip] = b
+        return None
+
+    # Otherwise, verify that the user has some requests left in this time period
+    bucket = ip_buckets[ip]
+    return bucket if not bucket.action() else None
+
+
 def ip_rate_limit(fn):
     @wraps(fn)
     def inner(*args, **kwargs):
         ip = request.remote_addr
+        analytics.record_ip(ip)
 
-        # Add a bucket if not present
-        if not ip_buckets.get(ip):
-            b = Bucket()
-            b.action()
-            ip_buckets[ip] = b
-        # Otherwise, verify that the user has some requests left in this time period
-        else:
-            bucket = ip_buckets[ip]
-
-            if not bucket.action():
-                _send_429(bucket)
+        bucket = ip_bucket_action(ip)
+        if bucket is not None:
+            _send_429(bucket)
 
         return fn(*args, **kwargs)
 
@@ -76,7 +111,7 @@ def token_rate_limit(fn):
     def inner(user_id, *args, **kwargs):
         # Add a bucket if not present
         if not user_buckets.get(user_id):
-            b = Bucket()
+            b = Bucket(live_config.get("token_bucket_limit"), live_config.get("token_bucket_per"))
             b.action()
             user_buckets[user_id] = b
         # Otherwise, verify that the user has some requests left in this time period
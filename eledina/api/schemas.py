@@ -0,0 +1,237 @@
+# coding=utf-8
+from functools import wraps
+from flask import request, abort
+try:
+    from ujson import loads
+except ImportError:
+    from json import loads
+
+from core.input_limits import UserLimits, BlogLimits
+from core import live_config
+from core.live_config import LiveConfig
+from core.util import is_email
+from core.types_ import JsonStatus
+from ..flask_util import jsonify_response
+
+
+"""
+Request body parsing.
+
+parse_body() rejects bodies that are too big (before reading them) or don't match the endpoint's schema,
+before any Redis or hashing work starts. Schemas are compiled once into flat tuples of checks;
+limits come from core/input_limits.py and are read when compiling (see compile_all);
+user limits can change at runtime (see core/live_config.py), schemas are recompiled then.
+"""
+
+
+class SchemaError(Exception):
+    pass
+
+
+class Field:
+    """
+    Description of one body field
+
+    :param types: allowed type(s)
+    :param limits: (limits class, prefix) - lengths are read from <prefix>_MIN_LENGTH/<prefix>_MAX_LENGTH
+    :param min_length, max_length: explicit lengths (string length or amount of list items)
+    :param check: extra check, gets the value and returns False if it's invalid
+    """
+    __slots__ = ("types", "required", "limits", "min_length", "max_length", "check")
+
+    def __init__(self, types, required: bool=True, limits: tuple=None,
+                 min_length=None, max_length=None, check=None):
+        self.types = types
+        self.required = required
+        self.limits = limits
+        self.min_length = min_length
+        self.max_length = max_length
+        self.check = check
+
+    def compile(self, name: str) -> tuple:
+        min_length, max_length = self.min_length, self.max_length
+        if self.limits is not None:
+            limits, prefix = self.limits
+            min_length = getattr(limits, f"{prefix}_MIN_LENGTH", min_length)
+            max_length = getattr(limits, f"{prefix}_MAX_LENGTH", max_length)
+
+        # Ints have no length
+        if min_length is not None or max_length is not None:
+            min_length = min_length or 0
+            max_length = max_length if max_length is not None else float("inf")
+
+        return name, self.required, self.types, min_length, max_length, self.check
+
+
+class Schema:
+    """
+    Set of fields for one endpoint. validate() returns only the known fields.
+    """
+    registry = []
+
+    def __init__(self, **fields: Field):
+        self.fields = fields
+        self.compiled = ()
+        self.compile()
+
+        Schema.registry.append(self)
+
+    def compile(self):
+        self.compiled = tuple(field.compile(name) for name, field in self.fields.items())
+
+    def validate(self, body) -> dict:
+        if not isinstance(body, dict):
+            raise SchemaError("body must be a JSON object")
+
+        valid = {}
+        for name, required, types, min_length, max_length, check in self.compiled:
+            value = body.get(name)
+            # Optional fields sent empty are ignored, like before schemas (PATCH /api/user with "email": "")
+            if value is None or (value == "" and not required):
+                if required:
+                    raise SchemaError(f"missing field: {name}")
+                continue
+
+            if not isinstance(value, types) or isinstance(value, bool):
+                raise SchemaError(f"invalid type: {name}")
+            if min_length is not None and isinstance(value, (str, list)) \
+                    and not min_length <= len(value) <= max_length:
+                raise SchemaError(f"invalid length: {name}")
+            if check is not None and not check(value):
+                raise SchemaError(f"invalid value: {name}")
+
+            valid[name] = value
+
+        return valid
+
+
+def compile_all():
+    """
+    Recompiles every schema, needed after limits change
+    """
+    for schema in Schema.registry:
+        schema.compile()
+
+
+def _read_body(max_length: int) -> bytes:
+    # Declared length is checked before anything is read
+    if request.content_length is not None and request.content_length > max_length:
+        abort(413)
+
+    # Bodies without a declared length (chunked) are read up to the limit
+    data = request.stream.read(max_length + 1)
+    if len(data) > max_length:
+        abort(413)
+
+    return data
+
+
+def limit_body(max_length: int):
+    """
+    Rejects bodies declared (Content-Length) longer than max_length with 413, without reading anything.
+    Goes before require_token/require_admin on routes with a body, so an oversized request doesn't cost
+    their Redis round trips; parse_body enforces the limit on bodies without a declared length.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def inner(*args, **kwargs):
+            if request.content_length is not None and request.content_length > max_length:
+                abort(413)
+            return fn(*args, **kwargs)
+        return inner
+    return decorator
+
+
+def parse_body(schema: Schema, max_length: int):
+    """
+    Parses and validates the JSON body, passes it to the view as the `body` keyword argument.
+    Goes after the rate limits and require_token (they're cheaper than reading a body, so rejected clients
+    can't make the worker parse one) and before @expensive (it gets the body). Routes behind require_token
+    check the declared length before it with limit_body.
+
+    GET requests don't have a body, they get body=None.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def inner(*args, **kwargs):
+            if request.method in ("GET", "HEAD"):
+                return fn(*args, body=None, **kwargs)
+
+            data = _read_body(max_length)
+            try:
+                body = schema.validate(loads(data))
+            except SchemaError as e:
+                payload = {
+                    "status": JsonStatus.INVALID_ARGUMENT,
+                    "message": str(e)
+                }
+                return jsonify_response(payload, 400)
+            except ValueError:
+                payload = {
+                    "status": JsonStatus.INVALID_ARGUMENT,
+                    "message": "invalid JSON"
+                }
+                return jsonify_response(payload, 400)
+
+            return fn(*args, body=body, **kwargs)
+        return inner
+    return decorator
+
+
+#################
+# SCHEMAS
+#################
+# Bodies are small, this leaves enough room for JSON overhead and escaping
+USER_BODY_MAX = 4 * 1024
+BLOG_BODY_MAX = 8 * BlogLimits.CONTENT_MAX_LENGTH
+BLOG_BATCH_BODY_MAX = 16 * 1024 * 1024
+
+# The full name is built from name and surname, its total length is checked by Users
+NAME_PART_MAX_LENGTH = UserLimits.FULLNAME_MAX_LENGTH // 2
+
+REGISTER = Schema(
+    username=Field(str, limits=(UserLimits, "USERNAME")),
+    name=Field(str, min_length=1, max_length=NAME_PART_MAX_LENGTH),
+    surname=Field(str, min_length=1, max_length=NAME_PART_MAX_LENGTH),
+    email=Field(str, limits=(UserLimits, "EMAIL"), check=is_email),
+    password=Field(str, limits=(UserLimits, "PASSWORD")),
+)
+
+LOGIN = Schema(
+    # can be either email or username
+    primary=Field(str, limits=(UserLimits, "EMAIL")),
+    password=Field(str, limits=(UserLimits, "PASSWORD")),
+)
+
+USER_UPDATE = Schema(
+    username=Field(str, required=False, limits=(UserLimits, "USERNAME")),
+    fullname=Field(str, required=False, limits=(UserLimits, "FULLNAME")),
+    email=Field(str, required=False, limits=(UserLimits, "EMAIL"), check=is_email),
+    password=Field(str, required=False, limits=(UserLimits, "PASSWORD")),
+    passwordCurrent=Field(str, required=False, limits=(UserLimits, "PASSWORD")),
+)
+
+BLOG_NEW = Schema(
+    title=Field(str, limits=(BlogLimits, "TITLE")),
+    content=Field(str, limits=(BlogLimits, "CONTENT")),
+    date=Field((str, int), max_length=BlogLimits.DATE_MAX_LENGTH),
+)
+
+# Posts are validated one by one by Blogs.upload_blogs
+BLOG_BATCH = Schema(
+    posts=Field(list, min_length=1, max_length=BlogLimits.BATCH_MAX_POSTS),
+)
+
+# Values are checked by LiveConfig.set_overrides
+LIVE_CONFIG = Schema(
+    reset=Field(list, required=False, max_length=len(live_config.PARAMETERS)),
+    **{name: Field(int, required=False) for name in live_config.PARAMETERS}
+)
+
+
+def _recompile(_values: dict):
+    # User limits changed at runtime
+    compile_all()
+
+
+LiveConfig().on_change(_recompile)
@@ -0,0 +1,180 @@
+# coding=utf-8
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+"""
+Static asset pipeline.
+
+Build step (run on deploy, after static files change):
+    python -m eledina.assets [--source static] [--output static/dist]
+
+Every file in static/ is copied to static/dist/ with a content hash in its name (css/site.css -> css/site.1a2b3c4d5e6f.css)
+and text-like files get a precompressed .gz variant next to it. manifest.json maps original paths to fingerprinted ones.
+Templates use asset_url("css/site.css"), fingerprinted files are served with immutable, long-lived cache headers.
+
+A build keeps the fingerprinted files of the previous one: pages rendered (and cached by browsers) before
+a deploy still point at them. Files of older builds are deleted.
+"""
+
+MANIFEST_NAME = "manifest.json"
+HASH_LENGTH = 12
+
+# Only these are worth compressing, images and fonts already are
+COMPRESSIBLE = (".css", ".js", ".html", ".svg", ".json", ".txt", ".xml", ".map", ".ico", ".ttf", ".eot")
+# Files smaller than this aren't worth a separate variant
+MIN_COMPRESS_SIZE = 256
+
+
+def _fingerprint(name: str, digest: str) -> str:
+    root, ext = os.path.splitext(name)
+    return f"{root}.{digest[:HASH_LENGTH]}{ext}"
+
+
+def build_assets(source: str="static", output: str="static/dist") -> dict:
+    """
+    Fingerprints and precompresses every file in `source`, writes them and manifest.json to `output`
+
+    :return: the manifest
+    """
+    source = os.path.abspath(source)
+    output = os.path.abspath(output)
+
+    # Files of the previous build are kept, everything older is deleted after the build
+    previous = _built_files(output)
+    os.makedirs(output, exist_ok=True)
+
+    files = {}
+    for directory, dirs, filenames in os.walk(source):
+        # Never process our own output
+        dirs[:] = [d for d in dirs if os.path.join(directory, d) != output]
+
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, source).replace(os.sep, "/")
+
+            with open(path, "rb") as f:
+                content = f.read()
+
+            hashed = _fingerprint(name, hashlib.sha256(content).hexdigest())
+            target = os.path.join(output, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+
+            with open(target, "wb") as f:
+                f.write(content)
+
+            gzipped = False
+            if name.endswith(COMPRESSIBLE) and len(content) >= MIN_COMPRESS_SIZE:
+                # mtime=0 keeps builds reproducible
+                compressed = gzip.compress(content, compresslevel=9, mtime=0)
+                if len(compressed) < len(content):
+                    with open(target + ".gz", "wb") as f:
+                        f.write(compressed)
+                    gzipped = True
+
+            files[name] = {
+                "path": hashed,
+                "gzip": gzipped,
+            }
+
+    # Written to a temporary file first, running workers never read a half-written manifest
+    manifest_path = os.path.join(output, MANIFEST_NAME)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(files, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    removed = _remove_stale(output, previous | _built_files(output))
+
+    log.info(f"Built {len(files)} assets into {output}, removed {removed} files of older builds")
+    return files
+
+
+def _built_files(output: str) -> set:
+    """
+    Paths (relative to output) of the files of the build described by output's manifest.json
+    """
+    path = os.path.join(output, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return set()
+
+    with open(path) as f:
+        files = json.load(f)
+
+    built = set()
+    for entry in files.values():
+        built.add(entry["path"])
+        if entry["gzip"]:
+            built.add(entry["path"] + ".gz")
+    return built
+
+
+def _remove_stale(output: str, keep: set) -> int:
+    """
+    Deletes every file in output that isn't in keep (or the manifest), then empty directories
+    """
+    removed = 0
+    for directory, dirs, filenames in os.walk(output, topdown=False):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, output).replace(os.sep, "/")
+            if name != MANIFEST_NAME and name not in keep:
+                os.remove(path)
+                removed += 1
+
+        if directory != output and not os.listdir(directory):
+            os.rmdir(directory)
+
+    return removed
+
+
+class AssetManifest:
+    """
+    Loaded manifest.json of a build, empty if assets were never built
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.files = {}
+        # fingerprinted path: has a .gz variant
+        self.gzipped = {}
+        # Hash of the manifest, changes with every build that changes an asset ("" without a build)
+        self.version = ""
+
+        path = os.path.join(directory, MANIFEST_NAME)
+        if not os.path.isfile(path):
+            log.warning(f"Asset manifest {path} is missing, run python -m eledina.assets")
+            return
+
+        with open(path, "rb") as f:
+            content = f.read()
+        self.files = json.loads(content.decode("utf-8"))
+        self.version = hashlib.sha1(content).hexdigest()[:HASH_LENGTH]
+
+        self.gzipped = {entry["path"]: entry["gzip"] for entry in self.files.values()}
+
+    def resolve(self, name: str):
+        """
+        :return: fingerprinted path for the original asset path or None if it isn't in the build
+        """
+        entry = self.files.get(name)
+        return entry["path"] if entry else None
+
+    def has_gzip(self, hashed: str) -> bool:
+        return self.gzipped.get(hashed, False)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Fingerprint and precompress static assets")
+    parser.add_argument("--source", default="static")
+    parser.add_argument("--output", default=os.path.join("static", "dist"))
+    args = parser.parse_args()
+
+    build_assets(args.source, args.output)
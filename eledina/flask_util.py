@@ -1,10 +1,174 @@
 # coding=utf-8
+import logging
+import time
+from flask import g, request, current_app
 from flask.wrappers import Response
 try:
     from ujson import dumps
 except ImportError:
     from json import dumps
 
+from core import tracing, replicas, profiler, unit_of_work
+from core.metrics import Metrics
+
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
 
 def jsonify_response(json, resp_code: int=200):
     return Response(dumps(json), resp_code, mimetype="application/json")
+
+
+def install_command_tracing(app):
+    """
+    Traces Redis commands issued while handling each request (see core/tracing.py).
+
+    Per-request totals are exported to Metrics, requests over the command budget are logged
+    and, if enabled, the trace is attached to the response as the X-Redis-Trace header.
+    """
+    if not tracing.TRACING_ENABLED:
+        return
+
+    metrics = Metrics()
+
+    @app.before_request
+    def _start_trace():
+        tracing.start_trace()
+
+    @app.after_request
+    def _finish_trace(response):
+        trace = tracing.end_trace()
+        if trace is None:
+            return response
+
+        endpoint = request.endpoint or "unknown"
+
+        metrics.observe("redis.commands_per_request", trace.commands)
+        metrics.observe("redis.round_trips_per_request", trace.round_trips)
+        metrics.observe("redis.bytes_per_request", trace.bytes_out + trace.bytes_in)
+        metrics.observe(f"redis.commands.{endpoint}", trace.commands)
+
+        for pattern, count in trace.patterns.items():
+            metrics.inc(f"redis.pattern.{pattern}", count)
+
+        if trace.over_budget:
+            metrics.inc(f"redis.over_budget.{endpoint}")
+            log.warning(f"{request.method} {request.path} issued {trace.commands} Redis commands "
+                        f"in {trace.round_trips} round trips (budget: {tracing.COMMAND_BUDGET}), "
+                        f"repeated: {trace.repeated_patterns()}")
+
+        if tracing.DEBUG_HEADER:
+            response.headers["X-Redis-Trace"] = trace.header_value()
+
+        return response
+
+
+READ_PIN_COOKIE = "rw_pin"
+
+
+def install_read_your_writes(app):
+    """
+    Carries the replica read pin of a session between its requests (see core/replicas.py).
+
+    Requests that wrote something get a short-lived cookie with the time until which reads of the session
+    have to go to the primary, requests that bring it along are pinned until then (at most READ_YOUR_WRITES
+    from now, the cookie is not trusted further). Clients without cookies are pinned by user, see Users.verify_token.
+    """
+    @app.before_request
+    def _start_session():
+        try:
+            pinned_until = float(request.cookies.get(READ_PIN_COOKIE, 0))
+        except ValueError:
+            pinned_until = 0
+
+        replicas.start_session(pinned_until)
+
+    @app.after_request
+    def _end_session(response):
+        pinned_until = replicas.end_session()
+        if pinned_until:
+            response.set_cookie(READ_PIN_COOKIE, str(pinned_until),
+                                max_age=max(int(pinned_until - time.time()) + 1, 1), httponly=True)
+
+        return response
+
+
+def install_unit_of_work(app):
+    """
+    Commits the commands queued while handling a request before its response is sent (see core/unit_of_work.py).
+    Must be installed after the other hooks: after_request functions run in reverse order, so the commit
+    is traced and pins the session's reads like any other write.
+    """
+    @app.before_request
+    def _begin():
+        unit_of_work.begin()
+
+    @app.after_request
+    def _commit(response):
+        if response.status_code >= 500:
+            unit_of_work.discard()
+            return response
+
+        try:
+            unit_of_work.commit()
+        except Exception as e:
+            # The response would confirm writes that didn't happen, the error is the answer instead
+            # (StorageUnavailable gets its 503 from the API's error handler)
+            return current_app.make_response(current_app.handle_user_exception(e))
+
+        return response
+
+    @app.teardown_request
+    def _end(_):
+        unit_of_work.discard()
+
+
+PROFILE_HEADER = "X-Profile"
+
+
+def _is_admin_request() -> bool:
+    # Imported here, models connect to storage on import
+    from core.models import Users
+    from core.types_ import Role
+    from eledina.api.bucket import ip_bucket_action
+
+    # The header is sent by anyone: checking the token and role costs a request of the IP's rate limit
+    # (profiled API requests count twice), requests without a token are never checked
+    if not request.headers.get("Authorization") or ip_bucket_action(request.remote_addr) is not None:
+        return False
+
+    users = Users()
+    user_id = users.verify_token(request.headers.get("Authorization"))
+    return bool(user_id) and users.get_role(int(user_id)) == Role.ADMIN
+
+
+def install_profiler(app):
+    """
+    Profiles a sample of requests, or requests of admins sending the X-Profile header (see core/profiler.py).
+    Requested profiles get the name of their file in the X-Profile response header.
+    """
+    if not profiler.ENABLED:
+        return
+
+    sampler = profiler.Profiler()
+
+    @app.before_request
+    def _start_profile():
+        # Only requests asking for a profile pay for the token check
+        requested = PROFILE_HEADER in request.headers and _is_admin_request()
+        if sampler.should_sample(requested):
+            g.profile = sampler.start((request.endpoint or "unknown").replace(".", "_"))
+            g.profile_requested = requested
+
+    @app.after_request
+    def _profile_header(response):
+        if g.get("profile_requested"):
+            response.headers[PROFILE_HEADER] = g.profile.file_name
+        return response
+
+    # Teardown runs after the response is built, so its time is in the profile as well
+    @app.teardown_request
+    def _stop_profile(_):
+        if g.get("profile") is not None:
+            sampler.stop()
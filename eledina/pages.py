@@ -1,10 +1,17 @@
 # coding=utf-8
 import logging
-import time
+import mimetypes
 import os
-from flask import Blueprint, render_template, abort, g, request
+import time
+from flask import Blueprint, render_template, abort, g, request, make_response, current_app, \
+    send_from_directory, url_for
 
+from core.analytics import Analytics
+from core.config import server_config
+from core.exceptions import StorageUnavailable
 from core.models import Users
+from .templating import TemplateManifest, RenderedPageCache
+from .assets import AssetManifest, MANIFEST_NAME
 
 
 pages = Blueprint("pages", __name__,
@@ -19,11 +26,44 @@ valid_extensions = (
 )
 
 users = Users()
+analytics = Analytics()
+
+# Seconds between checks for changed templates (0 disables it)
+TEMPLATE_CHECK_INTERVAL = server_config.getfloat("Pages", "template_check_interval", fallback=2)
+# Serve pages rendered once for anonymous visitors
+CACHE_ANONYMOUS = server_config.getboolean("Pages", "cache_anonymous", fallback=True)
+
+# Fingerprinted, precompressed static files (see eledina/assets.py)
+ASSETS_DIR = os.path.join("static", "dist")
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Endpoints serving files, they don't need the user (before_request)
+FILE_ENDPOINTS = ("pages.asset", "pages.static")
+
+assets = AssetManifest(ASSETS_DIR)
+
+manifest = TemplateManifest("templates", valid_extensions, TEMPLATE_CHECK_INTERVAL)
+page_cache = RenderedPageCache(manifest, assets)
+
+
+@pages.app_template_global()
+def asset_url(name: str) -> str:
+    """
+    URL of the fingerprinted version of a static file, falls back to the plain file if assets weren't built
+    """
+    hashed = assets.resolve(name)
+    if hashed is None:
+        return url_for("static", filename=name)
+
+    return url_for("pages.asset", filename=hashed)
 
 
 # Set user before request
 @pages.before_request
 def before_request():
+    if request.endpoint in FILE_ENDPOINTS:
+        g.user = {}
+        return
+
     ######################################
     # 1. ADD ABILITY TO CHECK REQUEST TIME
     # via g.render_time()
@@ -31,6 +71,7 @@ def before_request():
     ######################################
     g.request_start_time = time.time()
     g.request_time = lambda: str(round(time.time() - g.request_start_time, 4))
+    analytics.record_ip(request.remote_addr)
 
     ###################################
     # 2. PARSE COOKIE TO GET USER ID
@@ -40,36 +81,73 @@ def before_request():
     access_token = request.cookies.get("accessToken")
 
     if access_token is not None:
-        # get user id
-        user_id = users.verify_token(access_token)
-        log.debug(f"From token got userid: {user_id}")
+        try:
+            # get user id
+            user_id = users.verify_token(access_token)
+            log.debug(f"From token got userid: {user_id}")
 
-        if not user_id:
-            return abort(403)
+            if not user_id:
+                return abort(403)
+            analytics.record_user(int(user_id))
+
+            user_info = users.get_user_info(int(user_id))
+        except StorageUnavailable:
+            # Degraded mode: Redis is down, everyone gets the (cached) anonymous pages
+            user_info = {}
 
-        user_info = users.get_user_info(int(user_id))
         # set 'g' to include logged in user info
         g.user = user_info
     else:
         g.user = {}
 
 
+# Fingerprinted assets never change, so they can be cached forever
+@pages.route("/assets/<path:filename>")
+def asset(filename: str):
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    # Quality 0 (gzip;q=0) means the client refuses it
+    if assets.has_gzip(filename) and request.accept_encodings["gzip"] > 0:
+        response = send_from_directory(ASSETS_DIR, filename + ".gz", mimetype=mimetype)
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers.pop("Content-Disposition", None)
+    else:
+        response = send_from_directory(ASSETS_DIR, filename, mimetype=mimetype)
+
+    # The manifest keeps its name, so it must be revalidated
+    response.headers["Cache-Control"] = "no-cache" if filename == MANIFEST_NAME else ASSET_CACHE_CONTROL
+    response.vary.add("Accept-Encoding")
+    return response
+
+
 # This renders all pages normally
 @pages.route("/")
 @pages.route("/<path:template>")
 def page_render(template=None):
-    if template is None:
-        # index.html route triggered
-        template = "index.html"
+    if manifest.refresh() and current_app.jinja_env.cache is not None:
+        # Jinja only checks templates for changes in debug mode
+        current_app.jinja_env.cache.clear()
+
+    # Only paths of existing templates are in the manifest (index.html is mapped to "")
+    name = manifest.resolve(template or "")
+    if name is None:
+        log.info(f"Template requested via page_render() was not found: {template}")
+        return abort(404)
 
-    if not template.endswith(".html") and not template.endswith(valid_extensions):
-        template += ".html"
+    # Logged in users get their own render
+    if g.user or not CACHE_ANONYMOUS:
+        return render_template(name)
 
-    t_full = os.path.join("templates", template)
-    # TODO check if this can be exploited
-    if not os.path.isfile(t_full):
-        log.info(f"Template requested via page_render() was not found: {t_full}")
-        return abort(404)
+    cached = page_cache.get(name)
+    if cached is None:
+        cached = page_cache.store(name, render_template(name))
+    body, etag = cached
+
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(body)
+    response.set_etag(etag)
 
-    return render_template(template)
+    return response
 
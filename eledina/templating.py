@@ -0,0 +1,149 @@
+# coding=utf-8
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from core.util import after_fork
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class TemplateManifest:
+    """
+    Map of every request path page_render() can serve to its template, built from the templates directory.
+
+    Resolving a page is a dict lookup instead of an os.path.isfile call per request.
+    `version` changes whenever any template is added, removed or modified - templates include and extend
+    each other, so one changed file can change every rendered page.
+    Templates are checked for changes by a background thread (one per worker), requests never touch the filesystem.
+    """
+    def __init__(self, root: str, extensions: tuple, check_interval: float):
+        """
+        :param root: templates directory
+        :param extensions: extensions that are served as-is (.html is appended to everything else)
+        :param check_interval: seconds between checks for changed templates, 0 disables checking
+        """
+        self.root = root
+        self.extensions = extensions
+        self.check_interval = check_interval
+
+        self.routes = {}
+        self.version = ""
+
+        self._signature = None
+        self._rebuilt = False
+        self._watcher = None
+        self._lock = threading.Lock()
+
+        self.rebuild()
+        # Threads don't survive a fork, every worker starts its own watcher
+        after_fork(self._after_fork)
+
+    def _after_fork(self):
+        self._watcher = None
+        self._lock = threading.Lock()
+
+    def _scan(self) -> tuple:
+        entries = []
+        for directory, _, files in os.walk(self.root):
+            for file in files:
+                path = os.path.join(directory, file)
+                name = os.path.relpath(path, self.root).replace(os.sep, "/")
+                stat = os.stat(path)
+                entries.append((name, stat.st_mtime_ns, stat.st_size))
+
+        return tuple(sorted(entries))
+
+    def rebuild(self, signature: tuple=None):
+        signature = signature or self._scan()
+        routes = {}
+
+        for name, _, _ in signature:
+            if name.endswith(".html"):
+                routes[name] = name
+                # /about serves about.html
+                routes[name[:-len(".html")]] = name
+            elif name.endswith(self.extensions):
+                routes[name] = name
+
+        if "index.html" in routes:
+            routes[""] = "index.html"
+
+        self.routes = routes
+        self.version = hashlib.sha1(repr(signature).encode()).hexdigest()[:16]
+        self._signature = signature
+
+        log.info(f"Template manifest built: {len(signature)} templates, version {self.version}")
+
+    def refresh(self) -> bool:
+        """
+        Called on every request, starts the watcher thread if needed (no filesystem access)
+        :return: True once after the watcher rebuilt the manifest
+        """
+        if self.check_interval <= 0:
+            return False
+
+        if self._watcher is None:
+            with self._lock:
+                if self._watcher is None:
+                    self._watcher = threading.Thread(target=self._watch, name="template-watcher", daemon=True)
+                    self._watcher.start()
+
+        if self._rebuilt:
+            self._rebuilt = False
+            return True
+        return False
+
+    def _watch(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                signature = self._scan()
+                if signature != self._signature:
+                    self.rebuild(signature)
+                    self._rebuilt = True
+            except OSError:
+                log.exception("Checking templates for changes failed")
+
+    def resolve(self, path: str):
+        """
+        :return: template name for the request path or None if there is no such template
+        """
+        return self.routes.get(path)
+
+
+class RenderedPageCache:
+    """
+    Rendered templates for anonymous visitors, valid for one manifest version and one asset build.
+    Entries are (body, etag), the ETag is derived from both: pages link fingerprinted assets,
+    a page cached by a browser before an asset build must not be revalidated after it.
+    """
+    def __init__(self, manifest: TemplateManifest, assets=None):
+        self.manifest = manifest
+        # eledina.assets.AssetManifest of the fingerprinted files pages link to
+        self.assets = assets
+        self._pages = {}
+
+    def _version(self) -> str:
+        assets_version = self.assets.version if self.assets is not None else ""
+        return f"{self.manifest.version}:{assets_version}"
+
+    def get(self, name: str):
+        entry = self._pages.get(name)
+        if entry is None or entry[0] != self._version():
+            return None
+
+        return entry[1], entry[2]
+
+    def store(self, name: str, body: str) -> tuple:
+        version = self._version()
+        etag = hashlib.sha1(f"{version}:{name}".encode()).hexdigest()[:20]
+
+        self._pages[name] = (version, body, etag)
+        return body, etag
+
+    def clear(self):
+        self._pages = {}
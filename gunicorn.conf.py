@@ -0,0 +1,56 @@
+# coding=utf-8
+import gc
+import multiprocessing
+import os
+
+"""
+gunicorn configuration for production servers:
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is preloaded in the master, so the cache is generated once and workers share the imported code
+and data copy-on-write. Per-worker state (Redis connections, rate-limit buckets, id generator, metrics)
+is reset in every forked worker through core.util.after_fork hooks.
+
+Every setting can be overridden with environment variables.
+"""
+
+bind = os.environ.get("ELEDINA_BIND", "127.0.0.1:8080")
+
+# Hashing passwords is CPU bound, so workers scale with cores, threads cover requests waiting on Redis
+workers = int(os.environ.get("ELEDINA_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("ELEDINA_THREADS", 4))
+
+preload_app = True
+
+timeout = 30
+graceful_timeout = 20
+keepalive = 5
+
+# Recycle workers now and then, with jitter so they don't all restart at once
+max_requests = int(os.environ.get("ELEDINA_MAX_REQUESTS", 10000))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.environ.get("ELEDINA_ACCESS_LOG", None)
+errorlog = "-"
+loglevel = os.environ.get("ELEDINA_LOG_LEVEL", "info")
+
+
+def when_ready(server):
+    # Everything imported so far is long-lived. Moving it out of the GC's reach keeps the
+    # collector from touching (and therefore copying) those pages in every worker.
+    gc.collect()
+    gc.freeze()
+    server.log.info("App preloaded, objects frozen for copy-on-write sharing")
+
+
+def post_fork(server, worker):
+    # Per-worker state was already reset by the core.util.after_fork hooks
+    server.log.info(f"Worker {worker.pid} booted")
+
+
+def post_worker_init(worker):
+    # gunicorn resets signal handlers in workers, so SIGHUP (reload the live config) is installed after that.
+    # A SIGHUP to the master restarts workers instead, they read the current live config on start as well.
+    from core.live_config import install_signal_handler
+    install_signal_handler()
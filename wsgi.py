@@ -0,0 +1,9 @@
+# coding=utf-8
+"""
+Production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is imported (preloaded) once in the master process, workers are forked from it.
+"""
+from app import app
+
+application = app